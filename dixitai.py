@@ -1,22 +1,194 @@
 import os
 import time
 import random
-import requests
 import urllib.parse
 import logging
+import logging.handlers
+import argparse
+import atexit
 import sys
+import sqlite3
+import shutil
+import socket
+import socketserver
+import hashlib
+import tempfile
+import threading
+import functools
+import itertools
+import queue
+import collections
+import io
+import json
+import re
+import csv
+import contextlib
+import math
+import mmap
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
 # ================= ⚙️ 配置区域 =================
 NUM_CARDS = 250
 OUTPUT_DIR = "cheap"
-DELAY_SECONDS = 12
+IMAGE_BACKEND = None          # None: 输出目录为 stable 时用 huggingface，否则 pollinations (按最终的 OUTPUT_DIR 决定)
+FALLBACK_BACKENDS = []        # 例如 ["huggingface"]: 主引擎超出延迟预算或失败时，对冲请求这些引擎
+HEDGE_AFTER_SECONDS = 60      # 主引擎多久没结果就启动下一个引擎 (两者取先完成者)
 COMPLEXITY_RATIO = 0.6 
 LOG_FILE = "dixit_generation.log"
+LOG_ASYNC = True               # 日志经队列交给后台线程格式化并写入，生成线程不做日志 I/O
+LOG_JSON = False               # 日志文件每行一条 JSON (控制台始终是纯文本)
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5           # 日志文件按大小轮转，保留几个旧文件
+LOG_URL_MAX_CHARS = 160        # 失败 URL 超过该长度时截去中间部分
+LOG_URL_REPEAT_EVERY = 10      # 同一 URL 反复失败时，每 N 次才记录一次
 TEXT_MAX_RETRIES = 5
 IMAGE_MAX_RETRIES = 5
 RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# API 地址 (可指向本地桩服务器做测试)
+TEXT_API_BASE = "https://text.pollinations.ai"
+IMAGE_API_BASE = "https://image.pollinations.ai"
+HF_API_BASE = "https://router.huggingface.co"
+USE_PROXY = True
+PROXY_URL = "http://127.0.0.1:7897"
+VERIFY_SSL = not USE_PROXY     # 经本地代理时必须关闭证书校验，否则代理会报错
 BACKOFF_BASE_SECONDS = 2
 BACKOFF_MAX_SECONDS = 30
+MIN_IMAGE_BYTES = 1024             # 小于该大小的图片视为无效
+DOWNLOAD_CHUNK_SIZE = 64 * 1024    # 流式下载的分块大小
+
+# 出图校验 (需要 Pillow，没有则跳过): 落盘前检查能否完整解码、是否空白、是否是服务端的占位图。
+# 截断/解码失败/占位图按可重试处理；空白或分辨率不足说明这个 seed 画坏了，直接换 seed 重画
+VALIDATE_IMAGES = True
+VALIDATE_WORKERS = 2                 # 校验进程数；0 则在下载线程里直接校验
+VALIDATE_MIN_SIZE = None             # 分辨率下限 (宽, 高)，例如 (512, 512)
+VALIDATE_MIN_ENTROPY = 2.0           # 灰度直方图熵 (bit) 下限，纯色图为 0
+VALIDATE_MIN_STDDEV = 3.0            # 灰度标准差下限
+VALIDATE_MAX_REROLLS = 2             # 出图不可用时最多换几次 seed
+PLACEHOLDER_DIR = "placeholders"     # 放入见过的占位图 (限流提示、水印图等)，与之近似的出图会被拒绝
+PLACEHOLDER_MAX_DISTANCE = 8         # 与占位图的 pHash 汉明距离阈值
+
+# 文案缓存: 相同 instruction + seed 不再重复请求文本 API
+PROMPT_CACHE_FILE = "prompt_cache.sqlite3"
+PROMPT_CACHE_MAX_BYTES = 20 * 1024 * 1024   # 超出后按最近最少使用淘汰
+TEXT_OFFLINE = False                        # True: 只用缓存/兜底 Prompt，完全不访问文本 API
+TEXT_BATCH_SIZE = 1                         # >1 时一次文本请求为多张卡片生成文案 (JSON 数组)
+
+# 运行日志 (位于输出目录内): 记录每张卡片的阶段状态，重跑时只补做未完成的阶段
+JOURNAL_FILE = "journal.sqlite3"
+
+# 牌组规划: 由主种子一次性排好整副牌的骨架与图片 seed，可复现、尽量不重复
+MASTER_SEED = 20240101
+DECK_PLAN_FILE = "deck_plan.json"   # 位于输出目录内
+PLAN_MAX_REDRAWS = 20               # 骨架撞车时最多重抽几次
+PLAN_SAMPLING = "bag"               # "bag" 不放回抽取 (用遍素材才重复，每轮份数按权重比例分配) / "alias" 严格按权重独立抽样
+PLAN_BAG_TOLERANCE = 0.05           # "bag" 每轮份数与权重比例的最大相对误差
+PLAN_BAG_MAX_COPIES = 10            # 权重比例不是小整数时，最小权重的素材每轮最多放几份 (越多越准，每轮越长)
+
+# 素材包: 内置的 "builtin-v1" / "builtin-v2"，或 JSON / YAML 文件路径 (YAML 需要 PyYAML)。
+# 多个包按顺序合并，同名条目权重相加；写成 ("包", 倍数) 可整体调整一个包的权重
+VOCAB_PACKS = ["builtin-v2"]
+
+# 查重: 感知哈希 (pHash) 汉明距离足够近的卡片视为重复，需要 Pillow
+PHASH_INDEX_FILE = "phash_index.json"   # 位于输出目录内
+DUPLICATE_MAX_DISTANCE = 6              # 64 位 pHash 的汉明距离阈值
+DEDUP_INLINE = False                    # 出图后立即查重，撞车就换 seed 重画
+DEDUP_MAX_REROLLS = 2                   # 行内查重最多重画几次
+DEDUP_WORKERS = os.cpu_count() or 1     # 批量计算哈希的进程数
+
+# 后处理: 网页缩略图 / Dixit 比例卡面 / 带出血的印刷版，多进程执行，需要 Pillow
+EXPORT_DIR = "export"                   # 位于输出目录内
+THUMBNAIL_SIZE = 256                    # 缩略图长边像素
+CARD_ASPECT = (2, 3)                    # Dixit 卡牌 80x120mm
+CARD_FIT = "crop"                       # "crop" 居中裁切 / "pad" 用边缘平均色补边
+PRINT_SIZE_MM = (80, 120)
+PRINT_BLEED_MM = 3                      # 每边出血
+PRINT_DPI = 300
+POSTPROCESS_WORKERS = os.cpu_count() or 1
+POSTPROCESS_INLINE = False              # 出图成功后立即提交后处理，与下载并行
+
+# 图集 / 联系表: 整副牌拼成少数几张大图 + JSON 坐标索引
+ATLAS_DIR = "atlas"                     # 位于输出目录内
+ATLAS_TILE = (256, 256)                 # 每张卡片的格子大小 (宽, 高)
+ATLAS_MAX_SIZE = 4096                   # 单页最大边长
+ATLAS_FORMAT = "png"                    # "png" (空格子透明) / "jpg"
+
+# 每个主机一个令牌桶: (初始速率 次/秒, 突发容量)
+# 速率会根据 429 / Retry-After 自动下调，成功后缓慢回升 (AIMD)
+RATE_LIMITS = {
+    "text.pollinations.ai": (0.5, 2),
+    "image.pollinations.ai": (0.1, 1),
+    "router.huggingface.co": (0.1, 1),
+}
+DEFAULT_RATE_LIMIT = (0.1, 1)
+RATE_MIN_PER_SECOND = 0.01     # 下调的下限
+RATE_PROBE_CEILING = 2.0       # 最多试探到初始速率的几倍
+RATE_DECREASE_FACTOR = 0.5     # 每次 429 速率乘以该系数
+RATE_INCREASE_STEP = 0.05      # 每次成功增加 (最大速率 × 该比例)
+
+# 自适应超时与对冲: 按端点统计最近的成功耗时
+TEXT_TIMEOUT = (5, 30)         # (连接, 读取) 超时；读取超时同时是自适应超时的上限
+IMAGE_TIMEOUT = (10, 120)
+LATENCY_WINDOW = 50            # 每个端点保留最近多少次耗时
+LATENCY_MIN_SAMPLES = 5        # 样本不足时使用静态超时、不做对冲
+TIMEOUT_P95_FACTOR = 3.0       # 读取超时 = p95 × 该系数
+MIN_READ_TIMEOUT = 5
+HEDGE_DUPLICATES = True        # 超过 p95 仍无结果时换一个 seed 再发一次，取先返回者
+
+# 指标: 每次运行结束写出 JSON / CSV / Prometheus 文本，`python dixitai.py stats` 汇总
+METRICS_DIR = "metrics"        # 位于输出目录内
+HISTOGRAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# 基准测试: `python dixitai.py bench` 启动本地桩服务器模拟三个 API，对比不同流水线设置
+BENCH_CARDS = 20
+BENCH_SEED = 7
+BENCH_RESULTS_FILE = "bench_results.json"
+BENCH_RATE_LIMIT = (5, 5)      # 桩服务器的令牌桶，代替线上的保守限速
+# 各端点的延迟 (对数正态分布: 中位数秒, sigma) 与故障概率
+# empty: 200 但内容为空; not_image: 200 但 Content-Type 不是图片; blank: 纯色图 (应被出图校验拦下);
+# cold_start: HF 冷启动 503 + estimated_time
+BENCH_PROFILE = {
+    "text": {"latency": (0.3, 0.5), "429": 0.05, "5xx": 0.03, "empty": 0.02},
+    "image": {"latency": (1.0, 0.6), "429": 0.05, "5xx": 0.05, "empty": 0.02, "not_image": 0.03, "blank": 0.03},
+    "hf": {"latency": (1.5, 0.4), "429": 0.02, "5xx": 0.03, "cold_start": 0.1, "empty": 0.02, "not_image": 0.02, "blank": 0.02},
+}
+# 场景名 -> 配置覆盖
+BENCH_SCENARIOS = {
+    "serial": {"PIPELINE_MODE": False},
+    "pipeline": {},
+    "batch4": {"TEXT_BATCH_SIZE": 4},
+    "wide": {"IMAGE_WORKERS": 6, "PREFETCH_CONCEPTS": 6},
+    "hf": {"IMAGE_BACKEND": "huggingface"},
+}
+
+# 流水线并发: 文本阶段提前为后续卡片构思，图片阶段同时渲染多张
+PIPELINE_MODE = True          # False 则回退到逐张串行
+TEXT_WORKERS = 2              # 同时请求文本 API 的线程数
+IMAGE_WORKERS = 3             # 同时请求图片 API 的线程数
+PREFETCH_CONCEPTS = 4         # 图片阶段之外最多预取多少张卡片的文案
+
+# 调度: 截止时间 / 请求预算 (None 为不限)。按实时吞吐估算剩余时间，来不及时跳过长退避的重试、不再开始新卡片，
+# 没做完的卡片留到下次运行 (命令行 --deadline 90m / 23:30、--budget 500)
+RUN_DEADLINE = None           # 本次运行最多多少秒
+REQUEST_BUDGET = None         # 本次运行最多发多少个 HTTP 请求 (软上限: 已在途的请求不会被打断)
+SCHEDULE_WINDOW = 20          # 吞吐与单张耗时按最近多少张卡片估算
+ETA_INTERVAL_SECONDS = 30     # 多久打印一次进度与预计完成时间
+
+# 分片生成: 多个 worker 从共享队列领取卡片。本机多进程共用输出目录里的 SQLite 队列；
+# 跨机器 (不同出口 IP) 则连接同一个 TCP 协调器，各自输出后用 merge 合并到一个目录
+SHARD_QUEUE_FILE = "queue.sqlite3"    # 位于输出目录内
+SHARD_COORDINATOR = "127.0.0.1:8765"  # 协调器默认监听/连接地址
+SHARD_TOKEN = ""                      # 非空时协调器只接受带相同口令的请求
+SHARD_LEASE_SECONDS = 90              # 领取的卡片超过该时间没有心跳就交还队列
+SHARD_HEARTBEAT_SECONDS = 20
+SHARD_CLAIM_BATCH = 6                 # 每次领取几张 (流水线有空位时按需领取)
+SHARD_POLL_SECONDS = 2                # 队列暂时领不到卡片 (都在别人手上) 时多久再看一次
+SHARD_MAX_ATTEMPTS = 3                # 一张卡片最多被领取失败几次
+
+# 牌组归档: 多个输出目录打包进一个 zip。图片按 SHA-256 存放 (重跑/不同目录里相同的图片只存一份)，
+# 不压缩直接存储；index.json 记录每个牌组每张卡片的文案、seed、引擎。读单张卡片按 zip 中央目录直接定位，无需解压
+ARCHIVE_FILE = "decks.zip"
 
 USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
@@ -25,27 +197,76 @@ USER_AGENTS = [
     "Mozilla/5.0 (iPhone; CPU iPhone OS 14_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Mobile/15E148 Safari/604.1"
 ]
 
-SESSION = requests.Session()
-
 # ================= 📝 日志系统 =================
+# LogRecord 自带的属性；其余属性来自 extra=，写入 JSON 日志
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    """每条记录一行 JSON: 时间、级别、线程、消息，以及 extra= 传入的字段 (如 card、url)"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": record.getMessage().strip(),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in _RECORD_FIELDS)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """入队时不格式化: %-风格的消息和参数原样交给监听线程 (同进程队列，无需序列化)"""
+
+    def prepare(self, record):
+        return record
+
+_LOG_LISTENER = None
+
+def stop_logging():
+    """停止后台日志线程 (先写完队列里剩余的记录)"""
+    global _LOG_LISTENER
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+        _LOG_LISTENER = None
+
+atexit.register(stop_logging)
+
 def setup_logging():
+    """给 DixitBot 日志器挂上文件与控制台输出 (命令行入口调用；作为库导入时不产生任何日志文件)"""
+    global _LOG_LISTENER
     logger = logging.getLogger("DixitBot")
     logger.setLevel(logging.INFO)
     logger.handlers = [] 
+    stop_logging()
     
-    file_handler = logging.FileHandler(LOG_FILE, encoding='utf-8')
-    file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8',
+    )
+    if LOG_JSON:
+        file_formatter = JsonFormatter()
+    else:
+        file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     file_handler.setFormatter(file_formatter)
 
     console_handler = logging.StreamHandler(sys.stdout)
     console_formatter = logging.Formatter('%(message)s')
     console_handler.setFormatter(console_formatter)
 
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    if LOG_ASYNC:
+        # 生成线程只负责入队；格式化和文件/控制台 I/O 都在监听线程里完成
+        log_queue = queue.SimpleQueue()
+        _LOG_LISTENER = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+        _LOG_LISTENER.start()
+        logger.addHandler(LazyQueueHandler(log_queue))
+    else:
+        logger.addHandler(file_handler)
+        logger.addHandler(console_handler)
     return logger
 
-logger = setup_logging()
+logger = logging.getLogger("DixitBot")
+logger.addHandler(logging.NullHandler())
 
 # ================= 📚 素材库 =================
 SUBJECTS1 = [
@@ -96,7 +317,6 @@ SUBJECTS2 = [
     "a house walking on chicken legs", "a window looking into the deep sea", "a keyhole peeping into a galaxy"
 ]
 
-SUBJECTS = SUBJECTS2
 
 ACTIONS1 = [
     "melting into colorful liquid", "shattering into glass fragments",
@@ -135,7 +355,6 @@ ACTIONS2 = [
     "drowning in a sea of stars", "anchored to a cloud by a rope"
 ]
 
-ACTIONS = ACTIONS2
 
 LOCATIONS1 = [
     "in the middle of a dry desert at night", "deep underwater in a coral reef",
@@ -178,7 +397,6 @@ LOCATIONS2 = [
     "inside a painting that is still drying", "at the intersection of day and night"
 ]
 
-LOCATIONS = LOCATIONS2
 
 RELATIONS1 = [
     "In the foreground, [A], while far away in the background, [B]",
@@ -227,7 +445,6 @@ RELATIONS2 = [
     "[A] is sculpting a statue of [B]"
 ]
 
-RELATIONS = RELATIONS2
 
 MOODS1 = [
     "whimsical", "melancholic", "eerie", "peaceful", "cyberpunk", 
@@ -258,7 +475,1008 @@ MOODS2 = [
     "intimate"        # 亲密的 (特写，柔和，私密空间)
 ]
 
-MOODS = MOODS2
+VOCAB_CATEGORIES = ("subjects", "actions", "locations", "relations", "moods")
+
+BUILTIN_PACKS = {
+    "builtin-v1": {"name": "builtin", "version": 1, "subjects": SUBJECTS1, "actions": ACTIONS1,
+                   "locations": LOCATIONS1, "relations": RELATIONS1, "moods": MOODS1},
+    "builtin-v2": {"name": "builtin", "version": 2, "subjects": SUBJECTS2, "actions": ACTIONS2,
+                   "locations": LOCATIONS2, "relations": RELATIONS2, "moods": MOODS2},
+}
+
+def build_alias_table(weights):
+    """Vose 别名法: 返回 (prob, alias) 两个数组，之后每次加权抽样只需两个随机数"""
+    n = len(weights)
+    total = sum(weights)
+    prob = array("d", [1.0] * n)
+    alias = array("l", range(n))
+    scaled = [w * n / total for w in weights]
+    small = [k for k, p in enumerate(scaled) if p < 1]
+    large = [k for k, p in enumerate(scaled) if p >= 1]
+    while small and large:
+        lo, hi = small.pop(), large.pop()
+        prob[lo], alias[lo] = scaled[lo], hi
+        scaled[hi] -= 1 - scaled[lo]
+        (small if scaled[hi] < 1 else large).append(hi)
+    # 剩下的 (含浮点误差) 概率都视为 1
+    return prob, alias
+
+def apportion_copies(weights):
+    """ShuffleBag 每轮每个素材的份数: 以最小权重为一个单位按最大余数法分配。
+    比例不是小整数时，逐步增加最小权重的份数 (至多 PLAN_BAG_MAX_COPIES)，直到各素材占比的相对误差
+    不超过 PLAN_BAG_TOLERANCE；都达不到时取误差最小的一种"""
+    if not weights:
+        return []
+    total = sum(weights)
+    ratios = [w / min(weights) for w in weights]
+    best = None
+    for unit in range(1, PLAN_BAG_MAX_COPIES + 1):
+        quotas = [r * unit for r in ratios]
+        counts = [int(q) for q in quotas]
+        by_remainder = sorted(range(len(quotas)), key=lambda k: counts[k] - quotas[k])
+        for k in by_remainder[:round(sum(quotas)) - sum(counts)]:
+            counts[k] += 1
+        size = sum(counts)
+        error = max(abs(c / size - w / total) * total / w for c, w in zip(counts, weights))
+        if best is None or error < best[0]:
+            best = (error, counts)
+        if error <= PLAN_BAG_TOLERANCE:
+            break
+    return best[1]
+
+class VocabTable:
+    """一类素材编译后的表: 文本元组、权重数组、文本到序号的索引和别名表"""
+
+    def __init__(self, items, weights):
+        self.items = tuple(items)
+        self.weights = array("d", weights)
+        self.ids = {text: k for k, text in enumerate(self.items)}
+        self.prob, self.alias = build_alias_table(self.weights)
+
+    def __len__(self):
+        return len(self.items)
+
+    def sample(self, rng):
+        k = int(rng.random() * len(self.items))
+        return k if rng.random() < self.prob[k] else self.alias[k]
+
+    def bag_items(self):
+        """ShuffleBag 每轮的内容: 每个序号按权重比例放入若干份 (至少一份，见 apportion_copies)"""
+        return [k for k, copies in enumerate(apportion_copies(self.weights)) for _ in range(copies)]
+
+class Template:
+    """关系模板预先切分成文本段和 [A]/[B] 占位符，填充时只做一次 join"""
+
+    SLOT = re.compile(r"\[([AB])\]")
+
+    def __init__(self, text):
+        parts = self.SLOT.split(text)
+        self.text = text
+        self.literals = parts[0::2]
+        self.slots = parts[1::2]
+        if set(self.slots) != {"A", "B"}:
+            raise ValueError(f"关系模板必须同时包含 [A] 和 [B]: {text}")
+
+    def fill(self, a, b):
+        values = {"A": a, "B": b}
+        out = [self.literals[0]]
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            out.append(values[slot])
+            out.append(literal)
+        return "".join(out)
+
+def _pack_digits(digits, radices):
+    n = 0
+    for digit, radix in zip(digits, radices):
+        n = n * radix + digit
+    return n
+
+def _unpack_digits(n, radices):
+    digits = []
+    for radix in reversed(radices):
+        n, digit = divmod(n, radix)
+        digits.append(digit)
+    return digits[::-1]
+
+class CombinationSpace:
+    """全部卡片骨架的混合进制编号: 先是所有经典聚焦骨架，再是所有双重叙事骨架。
+
+    经典: 氛围 × 地点 × 主语 × 动作
+    双重: 氛围 × 地点 × 主语1 × 主语2 (≠主语1) × 动作1 × 动作2 × 关系
+    编号与骨架一一对应，规划时用整数去重，也可以按编号枚举或随机访问整个空间。
+    """
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+        m, l, s, a, r = (len(vocab.tables[c]) for c in ("moods", "locations", "subjects", "actions", "relations"))
+        self.simple_radices = (m, l, s, a)
+        self.complex_radices = (m, l, s, max(s - 1, 1), a, a, r)
+        self.simple_size = m * l * s * a
+        self.complex_size = m * l * s * (s - 1) * a * a * r
+
+    def __len__(self):
+        return self.simple_size + self.complex_size
+
+    def encode(self, is_complex, mood, location, subjects, actions, relation=None):
+        """由各类素材的序号求骨架编号"""
+        if not is_complex:
+            return _pack_digits((mood, location, subjects[0], actions[0]), self.simple_radices)
+        s1, s2 = subjects
+        digits = (mood, location, s1, s2 if s2 < s1 else s2 - 1, actions[0], actions[1], relation)
+        return self.simple_size + _pack_digits(digits, self.complex_radices)
+
+    def index(self, card):
+        """规划里的卡片 (文本) -> 骨架编号"""
+        t = self.vocab.tables
+        return self.encode(
+            card["complex"], t["moods"].ids[card["mood"]], t["locations"].ids[card["location"]],
+            [t["subjects"].ids[x] for x in card["subjects"]], [t["actions"].ids[x] for x in card["actions"]],
+            t["relations"].ids[card["relation"]] if card["complex"] else None,
+        )
+
+    def __getitem__(self, n):
+        """骨架编号 -> 与规划相同格式的骨架字典"""
+        if not 0 <= n < len(self):
+            raise IndexError(n)
+        t = self.vocab.tables
+        if n < self.simple_size:
+            mood, location, subj, act = _unpack_digits(n, self.simple_radices)
+            return {"complex": False, "mood": t["moods"].items[mood], "location": t["locations"].items[location],
+                    "subjects": [t["subjects"].items[subj]], "actions": [t["actions"].items[act]], "relation": None}
+        mood, location, s1, s2, a1, a2, rel = _unpack_digits(n - self.simple_size, self.complex_radices)
+        s2 = s2 if s2 < s1 else s2 + 1
+        subjects = t["subjects"].items
+        actions = t["actions"].items
+        return {"complex": True, "mood": t["moods"].items[mood], "location": t["locations"].items[location],
+                "subjects": [subjects[s1], subjects[s2]], "actions": [actions[a1], actions[a2]],
+                "relation": t["relations"].items[rel]}
+
+class Vocabulary:
+    """合并、编译后的素材库: 每类一张 VocabTable，关系模板预解析，附带骨架编号空间"""
+
+    def __init__(self, packs, tables):
+        self.packs = packs
+        self.tables = tables
+        self.templates = {text: Template(text) for text in tables["relations"].items}
+        self.space = CombinationSpace(self)
+
+    def template(self, text):
+        # 旧规划里可能有当前素材包之外的关系，现场解析
+        return self.templates.get(text) or Template(text)
+
+    def fingerprint(self):
+        """素材、权重与复杂度比例的指纹。权重全为 1 且按 bag 抽样时与只看素材列表的旧指纹一致"""
+        payload = [list(self.tables[c].items) for c in VOCAB_CATEGORIES] + [COMPLEXITY_RATIO]
+        if any(w != 1 for c in VOCAB_CATEGORIES for w in self.tables[c].weights):
+            payload.append([list(self.tables[c].weights) for c in VOCAB_CATEGORIES])
+            if PLAN_SAMPLING == "bag":
+                # 每轮份数决定了规划 (分配规则或 PLAN_BAG_* 变了旧规划就不再对应)
+                payload.append([apportion_copies(self.tables[c].weights) for c in VOCAB_CATEGORIES])
+        if PLAN_SAMPLING != "bag":
+            payload.append(PLAN_SAMPLING)
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+def load_vocab_pack(ref):
+    """内置包名或文件路径 -> 包字典。文件格式 (JSON，或同样结构的 YAML):
+
+        {"name": "fantasy", "version": 3,
+         "subjects": ["a dragon", {"text": "a tiny castle", "weight": 2}],
+         "relations": ["[A] guarding [B]"], ...}
+
+    每类都可以省略，条目可以是字符串 (权重 1) 或带 weight 的对象。
+    """
+    if ref in BUILTIN_PACKS:
+        return BUILTIN_PACKS[ref]
+    with open(ref, "r", encoding="utf-8") as f:
+        if ref.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError("读取 YAML 素材包需要 PyYAML: pip install pyyaml") from None
+            pack = yaml.safe_load(f)
+        else:
+            pack = json.load(f)
+    unknown = set(pack) - set(VOCAB_CATEGORIES) - {"name", "version"}
+    if unknown:
+        raise ValueError(f"{ref}: 未知的字段 {', '.join(sorted(unknown))}")
+    return pack
+
+def compile_vocabulary(refs):
+    """按顺序合并素材包 (同名条目权重相加) 并编译"""
+    merged = {c: {} for c in VOCAB_CATEGORIES}
+    packs = []
+    for ref in refs:
+        ref, scale = ref if isinstance(ref, (tuple, list)) else (ref, 1.0)
+        pack = load_vocab_pack(ref)
+        packs.append({"ref": ref, "name": pack.get("name", ref), "version": pack.get("version", 1)})
+        for category in VOCAB_CATEGORIES:
+            for item in pack.get(category) or ():
+                if isinstance(item, str):
+                    text, weight = item, 1.0
+                else:
+                    text, weight = item["text"], float(item.get("weight", 1.0))
+                if weight <= 0:
+                    raise ValueError(f"{ref}: 权重必须为正数: {text}")
+                merged[category][text] = merged[category].get(text, 0) + weight * scale
+    missing = [c for c in VOCAB_CATEGORIES if not merged[c]]
+    if missing:
+        raise ValueError(f"素材包合并后缺少: {', '.join(missing)}")
+    if len(merged["subjects"]) < 2:
+        raise ValueError("双重叙事至少需要两个主语")
+    tables = {c: VocabTable(merged[c], merged[c].values()) for c in VOCAB_CATEGORIES}
+    return Vocabulary(packs, tables)
+
+_VOCABULARY = None
+_VOCABULARY_LOCK = threading.Lock()
+
+def get_vocabulary():
+    global _VOCABULARY
+    with _VOCABULARY_LOCK:
+        if _VOCABULARY is None:
+            _VOCABULARY = compile_vocabulary(VOCAB_PACKS)
+        return _VOCABULARY
+
+def print_vocab():
+    """素材包、各类素材数量与骨架空间大小"""
+    vocab = get_vocabulary()
+    print("📚 素材包: " + ", ".join(f"{p['name']} v{p['version']} ({p['ref']})" for p in vocab.packs))
+    for category in VOCAB_CATEGORIES:
+        table = vocab.tables[category]
+        weighted = "" if all(w == 1 for w in table.weights) else f" (权重合计 {sum(table.weights):g})"
+        print(f"   {category:<10} {len(table):>5}{weighted}")
+    space = vocab.space
+    print(f"   骨架空间: {len(space):,} (经典 {space.simple_size:,} + 双重 {space.complex_size:,})")
+
+# ================= 🚦 限流 =================
+
+class RateLimiter:
+    """单个主机的令牌桶限流器，所有线程共享。
+
+    429 时速率按 RATE_DECREASE_FACTOR 下调并暂停到 Retry-After 指定的时间，
+    每次成功则线性回升，直到 RATE_PROBE_CEILING 倍的初始速率，
+    从而尽量贴着服务端允许的速率运行。
+    """
+
+    def __init__(self, host, rate, burst):
+        self.host = host
+        self.rate = float(rate)
+        self.max_rate = float(rate) * RATE_PROBE_CEILING
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """阻塞直到拿到一个令牌，返回等待的秒数"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def has_spare(self):
+        """现在就有空余令牌 (未暂停且桶里至少一个)，对冲请求不会和排队的请求抢令牌"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            return now >= self.blocked_until and self.tokens >= 1
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_INCREASE_STEP)
+
+    def on_throttle(self, retry_after=None):
+        """收到 429: 降速，并暂停到 Retry-After (没有则按新速率暂停一个间隔)，返回暂停秒数"""
+        with self.lock:
+            self.rate = max(RATE_MIN_PER_SECOND, self.rate * RATE_DECREASE_FACTOR)
+            pause = retry_after if retry_after is not None else 1 / self.rate
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + pause)
+            self.tokens = 0.0
+            self.updated = now
+            rate = self.rate
+        logger.warning("   🚦 %s 触发限流，速率降至 %.3f 次/秒，暂停 %.1fs", self.host, rate, pause)
+        return pause
+
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+def get_rate_limiter(url):
+    """按 URL 的主机名取 (或创建) 限流器"""
+    host = urllib.parse.urlsplit(url).hostname or ""
+    with _RATE_LIMITERS_LOCK:
+        limiter = _RATE_LIMITERS.get(host)
+        if limiter is None:
+            rate, burst = RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT)
+            limiter = _RATE_LIMITERS[host] = RateLimiter(host, rate, burst)
+        return limiter
+
+def parse_retry_after(value):
+    """解析 Retry-After 头 (秒数或 HTTP 日期)，无法解析时返回 None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    import email.utils
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+def report_response(limiter, response):
+    """把响应反馈给限流器。429 时返回限流器的暂停秒数，否则返回 None"""
+    if response.status_code == 429:
+        return limiter.on_throttle(parse_retry_after(response.headers.get("Retry-After")))
+    if response.status_code < 400:
+        limiter.on_success()
+    return None
+
+# ================= ⏱️ 延迟统计 =================
+
+def percentile(values, q):
+    """q 分位数 (0-100，最近秩法)，空列表返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+class LatencyTracker:
+    """按端点 (主机名) 和请求类型记录最近 LATENCY_WINDOW 次成功请求的耗时，给出分位数、超时和对冲时机。
+    同一主机上的批量文本请求比单张慢得多，分开统计才不会拉高单张请求的超时和对冲延迟"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, kind=None):
+        with self.lock:
+            samples = self.samples.get((endpoint, kind))
+            if samples is None:
+                samples = self.samples[endpoint, kind] = collections.deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, endpoint, q, kind=None):
+        """最近样本的 q 分位数；样本不足 LATENCY_MIN_SAMPLES 时返回 None"""
+        with self.lock:
+            samples = list(self.samples.get((endpoint, kind), ()))
+        if len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        return percentile(samples, q)
+
+    def timeout(self, endpoint, default, kind=None):
+        """(连接, 读取) 超时: 读取超时取 p95 × TIMEOUT_P95_FACTOR，并限制在 [MIN_READ_TIMEOUT, 静态值] 内"""
+        p95 = self.percentile(endpoint, 95, kind)
+        if p95 is None:
+            return default
+        connect, read = default
+        return connect, min(read, max(MIN_READ_TIMEOUT, p95 * TIMEOUT_P95_FACTOR))
+
+    def hedge_delay(self, endpoint, kind=None):
+        """超过 p95 还没返回就值得发一个对冲请求；样本不足时返回 None"""
+        return self.percentile(endpoint, 95, kind)
+
+LATENCY = LatencyTracker()
+
+def endpoint_of(url):
+    return urllib.parse.urlsplit(url).hostname or ""
+
+# ================= 📊 指标 =================
+
+class Metrics:
+    """线程安全的计数器、直方图与 trace span 收集器。
+
+    计数器与直方图以 (名称, 排序后的标签) 为键；span 记录每张卡片各阶段的起止时间。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.spans = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {"buckets": [0] * (len(HISTOGRAM_BUCKETS) + 1), "sum": 0.0, "count": 0}
+            slot = next((k for k, bound in enumerate(HISTOGRAM_BUCKETS) if value <= bound), len(HISTOGRAM_BUCKETS))
+            hist["buckets"][slot] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """记录一段耗时: 同时写入 span 列表和 `<name>_seconds` 直方图。
+        块内可往 yield 出的字典里补充属性 (如 result)"""
+        start = time.time()
+        try:
+            yield attrs
+        except BaseException:
+            attrs.setdefault("result", "error")
+            raise
+        finally:
+            duration = time.time() - start
+            attrs.setdefault("result", "ok")
+            with self.lock:
+                self.spans.append({"name": name, "start": start, "duration": duration,
+                                   "thread": threading.current_thread().name, **attrs})
+            self.observe(f"{name}_seconds", duration, result=attrs["result"])
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "finished": time.time(),
+                "buckets": list(HISTOGRAM_BUCKETS),
+                "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self.counters.items())],
+                "histograms": [{"name": n, "labels": dict(l), **h} for (n, l), h in sorted(self.histograms.items())],
+                "spans": list(self.spans),
+            }
+
+    def export(self, directory):
+        """写出 run-<时间>-<pid>.json (含 span)、同名 .csv，并覆盖 latest.prom；返回 JSON 路径。
+
+        文件名带进程号，多个 worker 共用输出目录时各写各的；都先写临时文件再原子替换。
+        """
+        ensure_dir(directory)
+        snap = self.snapshot()
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(snap['started']))}-{os.getpid()}"
+        json_path = os.path.join(directory, f"run-{run_id}.json")
+        csv_path = os.path.join(directory, f"run-{run_id}.csv")
+        with open(json_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(snap, f, ensure_ascii=False)
+        os.replace(json_path + ".tmp", json_path)
+        with open(csv_path + ".tmp", "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["type", "name", "labels", "value", "count", "sum"])
+            for c in snap["counters"]:
+                writer.writerow(["counter", c["name"], json.dumps(c["labels"], ensure_ascii=False), c["value"], "", ""])
+            for h in snap["histograms"]:
+                writer.writerow(["histogram", h["name"], json.dumps(h["labels"], ensure_ascii=False), "", h["count"], f"{h['sum']:.6f}"])
+        os.replace(csv_path + ".tmp", csv_path)
+        tmp_path = os.path.join(directory, f"latest.prom.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(prometheus_text(snap))
+        os.replace(tmp_path, os.path.join(directory, "latest.prom"))
+        return json_path
+
+def prometheus_text(snap):
+    """Prometheus 文本格式 (可交给 node_exporter 的 textfile collector)"""
+    def fmt_labels(labels, extra=None):
+        items = list(labels.items()) + (extra or [])
+        if not items:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in items)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+    lines = []
+    typed = set()
+    for c in snap["counters"]:
+        name = f"dixit_{c['name']}_total"
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{fmt_labels(c['labels'])} {c['value']}")
+    for h in snap["histograms"]:
+        name = f"dixit_{h['name']}"
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        bounds = [str(b) for b in snap["buckets"]] + ["+Inf"]
+        for bound, count in zip(bounds, h["buckets"]):
+            cumulative += count
+            lines.append(f"{name}_bucket{fmt_labels(h['labels'], [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_sum{fmt_labels(h['labels'])} {h['sum']:.6f}")
+        lines.append(f"{name}_count{fmt_labels(h['labels'])} {h['count']}")
+    return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+def counter_total(snap, name, **match):
+    """快照里名为 name、且标签包含 match 的计数器之和"""
+    return sum(c["value"] for c in snap["counters"]
+               if c["name"] == name and all(c["labels"].get(k) == v for k, v in match.items()))
+
+def print_stats(path=None):
+    """汇总一次运行的指标 (默认取输出目录里最新的一次)"""
+    directory = os.path.join(OUTPUT_DIR, METRICS_DIR)
+    if path is None:
+        runs = sorted(n for n in os.listdir(directory) if n.startswith("run-") and n.endswith(".json")) if os.path.isdir(directory) else []
+        if not runs:
+            print(f"📊 {directory} 里还没有指标")
+            return
+        path = os.path.join(directory, runs[-1])
+    with open(path, "r", encoding="utf-8") as f:
+        snap = json.load(f)
+
+    def total(name, **match):
+        return counter_total(snap, name, **match)
+
+    elapsed = snap["finished"] - snap["started"]
+    print(f"📊 {os.path.basename(path)}: 运行 {elapsed / 60:.1f} 分钟")
+    done = total("cards", stage="image", result="ok")
+    failed = total("cards", stage="image", result="failed")
+    rate = done / (elapsed / 60) if elapsed > 0 else 0
+    print(f"   卡片: 完成 {done}, 失败 {failed}, 吞吐 {rate:.2f} 张/分钟")
+
+    for name in sorted({s["name"] for s in snap["spans"]}):
+        durations = [s["duration"] for s in snap["spans"] if s["name"] == name]
+        print(f"   阶段 {name:<8} n={len(durations):<5} p50={percentile(durations, 50):.2f}s "
+              f"p95={percentile(durations, 95):.2f}s max={max(durations):.2f}s")
+
+    statuses = {}
+    for c in snap["counters"]:
+        if c["name"] == "http_requests":
+            host = c["labels"].get("host", "")
+            statuses.setdefault(host, {})[c["labels"].get("status", "")] = c["value"]
+    for host, by_status in sorted(statuses.items()):
+        dist = ", ".join(f"{status}: {count}" for status, count in sorted(by_status.items()))
+        print(f"   {host}: {sum(by_status.values())} 次请求 ({dist})")
+
+    retries = {}
+    for c in snap["counters"]:
+        if c["name"] == "api_retries":
+            key = f"{c['labels'].get('api')}/{c['labels'].get('reason')}"
+            retries[key] = retries.get(key, 0) + c["value"]
+    if retries:
+        print("   重试: " + ", ".join(f"{k} {v}" for k, v in sorted(retries.items())))
+    print(f"   下载: {total('download_bytes') / 1024 / 1024:.1f} MB | "
+          f"文案缓存命中 {total('prompt_cache', result='hit')}/{total('prompt_cache')} | "
+          f"对冲请求 {total('hedged_requests')} 次 (胜出 {total('hedged_requests', winner='hedge')})")
+
+# ================= 🌐 HTTP 客户端 =================
+
+def get_proxies():
+    """获取代理配置"""
+    # 优先使用脚本里强制指定的代理
+    if USE_PROXY:
+        return {"http": PROXY_URL, "https": PROXY_URL}
+    
+    # 如果脚本里没指定，自动尝试读取系统的环境变量 (即你 export 的那些)
+    # requests 库默认会自动读取环境变量，所以这里返回 None 即可让它自动接管
+    return None
+
+def require_requests():
+    """按需导入 requests (只有访问网络的功能需要，导入本模块和离线命令都不加载它)"""
+    import requests
+    return requests
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def get_session():
+    """所有请求共用的会话: 每个 API 主机一个独立的 keep-alive 连接池，统一证书设置 (代理见 http_request)。
+
+    连接池大小按该主机的并发线程数 × 2 (对冲请求) 配置，重试由 request_with_retries 负责，
+    urllib3 自身不重试。
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            requests = require_requests()
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            for base, workers in ((TEXT_API_BASE, TEXT_WORKERS), (IMAGE_API_BASE, IMAGE_WORKERS), (HF_API_BASE, IMAGE_WORKERS)):
+                session.mount(base + "/", HTTPAdapter(pool_connections=1, pool_maxsize=max(2, workers * 2), max_retries=0))
+            session.verify = VERIFY_SSL
+            _SESSION = session
+        return _SESSION
+
+class RetryableResponse(Exception):
+    """状态码是 200 但内容不可用 (空文本/非图片/过小)，应退避后重试"""
+
+class RejectedResponse(Exception):
+    """状态码是 200 但内容确定不可用 (例如这个 seed 画出了空白图)，原样重试没有意义"""
+
+# 当前线程所属对冲尝试的"已在途"回调 (见 run_hedged)
+_IN_FLIGHT = threading.local()
+
+def http_request(method, url, timeout, kind=None, **kwargs):
+    """单次请求: 限流器取令牌 -> 共享会话发送 -> 反馈限流器 -> 成功时按 (主机, 请求类型 kind) 记录延迟"""
+    limiter = get_rate_limiter(url)
+    waited = limiter.acquire()
+    # 拿到令牌才算真正发出: 在限流器里排队的时间不计入对冲计时
+    notify = getattr(_IN_FLIGHT, "notify", None)
+    if notify is not None:
+        notify()
+    host = endpoint_of(url)
+    proxies = get_proxies()
+    if proxies is not None:
+        # 会话上的 proxies 会被环境变量 HTTP(S)_PROXY 覆盖，按请求传入才能保证 USE_PROXY / worker --proxy 生效
+        kwargs.setdefault("proxies", proxies)
+    if waited:
+        METRICS.observe("rate_limit_wait_seconds", waited, host=host)
+    if _SCHEDULER is not None:
+        _SCHEDULER.note_request()
+    start = time.monotonic()
+    try:
+        response = get_session().request(method, url, timeout=timeout, **kwargs)
+    except Exception as e:
+        METRICS.inc("http_requests", host=host, status=type(e).__name__)
+        raise
+    elapsed = time.monotonic() - start
+    report_response(limiter, response)
+    METRICS.inc("http_requests", host=host, status=response.status_code)
+    METRICS.observe("http_request_seconds", elapsed, host=host)
+    if response.status_code == 200:
+        LATENCY.record(host, elapsed, kind)
+    return response
+
+def hedged_request(method, urls, default_timeout, kind=None, **kwargs):
+    """请求 urls[0]；开启 HEDGE_DUPLICATES 且发出后超过该端点的 p95 仍未返回时，
+    再请求 urls[1] (通常只换了 seed)，返回先到的响应，另一个被放弃。
+    此时限流器没有空余令牌则不发对冲请求，以免与排队的请求抢令牌。
+
+    超时按该端点同类请求 (kind) 的观测延迟自适应。两个请求都抛异常时抛出最后一个异常。
+    """
+    endpoint = endpoint_of(urls[0])
+    timeout = LATENCY.timeout(endpoint, default_timeout, kind)
+    delay = LATENCY.hedge_delay(endpoint, kind) if HEDGE_DUPLICATES and len(urls) > 1 else None
+    if delay is None:
+        return http_request(method, urls[0], timeout, kind, **kwargs)
+
+    errors = []
+
+    def fetch(url, cancel, hedge=False):
+        if cancel.is_set() or (hedge and not hedge_allowed(url)):
+            return None
+        try:
+            return (http_request(method, url, timeout, kind, **kwargs),)
+        except Exception as e:
+            errors.append(e)
+            raise
+
+    winner, result = run_hedged(
+        [(0, functools.partial(fetch, urls[0])), (delay, functools.partial(fetch, urls[1], hedge=True))],
+        from_send=True,
+    )
+    if result is None:
+        raise errors[-1]
+    METRICS.inc("hedged_requests", host=endpoint, winner="hedge" if winner > 0 else "primary")
+    if winner > 0:
+        logger.info("   🔀 对冲请求先返回 (p95=%.1fs)", delay)
+    return result[0]
+
+def hedge_allowed(url):
+    """对冲前检查: 该主机的限流器没有空余令牌时放弃对冲"""
+    if get_rate_limiter(url).has_spare():
+        return True
+    METRICS.inc("hedged_requests", host=endpoint_of(url), winner="skipped")
+    return False
+
+def server_wait_hint(response):
+    """服务端建议的等待秒数: Retry-After 头，或 HF 冷启动 503 返回的 estimated_time"""
+    wait = parse_retry_after(response.headers.get("Retry-After"))
+    if wait is None and "json" in response.headers.get("Content-Type", ""):
+        try:
+            wait = float(response.json().get("estimated_time"))
+        except (ValueError, TypeError, AttributeError):
+            wait = None
+    return wait
+
+def request_with_retries(method, urls, label, max_retries, timeout, handle, cancel=None, **kwargs):
+    """所有 API 共用的重试循环，返回 (结果, 最后的失败原因)。
+
+    urls 为 [主 URL, 对冲 URL (可省略)]；kwargs 中的 kind 是延迟统计的请求类型 (见 LatencyTracker)。handle(response) 处理 200 响应并返回结果，
+    内容不可用时抛出 RetryableResponse。429 的等待交给限流器；其余可重试状态码
+    优先遵循服务端的等待建议，否则按 compute_backoff_seconds 退避。调度器认为来不及时不再重试。
+    cancel 被置位时抛出 DownloadCancelled。
+    """
+    requests = require_requests()
+    url = urls[0]
+    error = None
+    for attempt in range(max_retries):
+        if cancel is not None and cancel.is_set():
+            raise DownloadCancelled()
+        progress = f"({attempt+1}/{max_retries})"
+        wait = compute_backoff_seconds(attempt)
+        try:
+            response = hedged_request(method, urls, timeout, **kwargs)
+            if response.status_code == 200:
+                result = handle(response)
+                METRICS.inc("api_calls", api=label, result="ok")
+                return result, None
+            error = f"HTTP {response.status_code}"
+            METRICS.inc("api_retries", api=label, reason=f"http_{response.status_code}")
+            if response.status_code not in RETRY_STATUS_CODES:
+                logger.error("   ❌ %s状态码 %s，停止重试: %s", label, response.status_code, response.text[:200])
+                log_failed_url("失败URL", url)
+                response.close()
+                break
+            if response.status_code == 429:
+                # 暂停由共享的限流器负责，下一次 acquire 会等到 Retry-After 之后
+                log_failed_url("限流URL", url)
+                response.close()
+                wait = 0
+            else:
+                hint = server_wait_hint(response)
+                response.close()
+                if hint is not None:
+                    wait = hint
+                logger.warning("   ⚠️ %s状态码 %s，等待 %.1fs 后重试 %s...", label, response.status_code, wait, progress)
+                log_failed_url("失败URL", url)
+        except DownloadCancelled:
+            raise
+        except RejectedResponse as e:
+            error = str(e)
+            logger.warning("   🚫 %s%s，不再重试", label, e)
+            log_failed_url("不可用内容URL", url)
+            break
+        except RetryableResponse as e:
+            error = str(e)
+            METRICS.inc("api_retries", api=label, reason="invalid_content")
+            logger.warning("   ⚠️ %s%s，等待 %.1fs 后重试 %s...", label, e, wait, progress)
+            log_failed_url("无效内容URL", url)
+        except requests.exceptions.Timeout:
+            error = "超时"
+            METRICS.inc("api_retries", api=label, reason="timeout")
+            logger.warning("   🐢 %s超时 (服务器繁忙)，等待 %.1fs 后重试 %s...", label, wait, progress)
+            log_failed_url("超时URL", url)
+        except Exception as e:
+            error = f"连接异常: {e}"
+            METRICS.inc("api_retries", api=label, reason="network")
+            logger.warning("   ⚠️ %s网络异常: %s，等待 %.1fs 后重试 %s...", label, e, wait, progress)
+            log_failed_url("异常URL", url)
+        if attempt + 1 < max_retries:
+            if not retry_allowed(wait):
+                logger.warning("   ⏳ %s来不及重试 (截止时间/请求预算)，放弃 %s", label, progress)
+                break
+            if sleep_or_cancel(wait, cancel):
+                raise DownloadCancelled()
+    log_failed_url("最终失败URL", url)
+    METRICS.inc("api_calls", api=label, result="failed")
+    return None, error
+
+# ================= 💾 文案缓存 =================
+
+class PromptCache:
+    """(instruction, seed) -> description 的 SQLite 缓存，多线程共享一个连接。
+
+    每条记录按 instruction + description 的字节数计入总大小，
+    超过上限时按 last_used 从旧到新淘汰。
+    """
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS prompts ("
+                " key TEXT PRIMARY KEY, instruction TEXT, seed INTEGER, description TEXT,"
+                " size INTEGER, created REAL, last_used REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS prompts_last_used ON prompts (last_used)")
+
+    @staticmethod
+    def make_key(instruction, seed):
+        return hashlib.sha256(f"{seed}\0{instruction}".encode("utf-8")).hexdigest()
+
+    def get(self, instruction, seed):
+        key = self.make_key(instruction, seed)
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT description FROM prompts WHERE key = ?", (key,)).fetchone()
+            METRICS.inc("prompt_cache", result="miss" if row is None else "hit")
+            if row is None:
+                return None
+            self.conn.execute("UPDATE prompts SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, instruction, seed, description):
+        key = self.make_key(instruction, seed)
+        size = len(instruction.encode("utf-8")) + len(description.encode("utf-8"))
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO prompts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, instruction, seed, description, size, now, now),
+            )
+            self._evict()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM prompts").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        doomed = []
+        for key, size in self.conn.execute("SELECT key, size FROM prompts ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM prompts WHERE key = ?", doomed)
+
+_PROMPT_CACHE = None
+_PROMPT_CACHE_LOCK = threading.Lock()
+
+def get_prompt_cache():
+    global _PROMPT_CACHE
+    with _PROMPT_CACHE_LOCK:
+        if _PROMPT_CACHE is None:
+            _PROMPT_CACHE = PromptCache(PROMPT_CACHE_FILE, PROMPT_CACHE_MAX_BYTES)
+        return _PROMPT_CACHE
+
+def text_seed_for(instruction):
+    """文本 seed 由 instruction 决定，重跑时同一骨架能命中缓存"""
+    return int(hashlib.sha256(instruction.encode("utf-8")).hexdigest()[:8], 16) % 100000
+
+# ================= 🗺️ 牌组规划 =================
+
+class ShuffleBag:
+    """不放回抽取: 每轮把素材洗牌后依次取出，取完再洗，保证每个元素在重复之前都被用到一次"""
+
+    def __init__(self, items, rng):
+        self.items = list(items)
+        self.rng = rng
+        self.pool = []
+
+    def _refill(self):
+        fresh = self.items[:]
+        self.rng.shuffle(fresh)
+        # 新一轮放在栈底，先把本轮剩下的用完
+        self.pool = fresh + self.pool
+
+    def draw(self, exclude=()):
+        if not self.pool:
+            self._refill()
+        for _ in range(2):
+            for k in range(len(self.pool) - 1, -1, -1):
+                if self.pool[k] not in exclude:
+                    return self.pool.pop(k)
+            # 本轮剩下的全被排除，再开一轮
+            self._refill()
+        raise ValueError("素材库可选元素不足")
+
+class AliasSampler:
+    """严格按权重独立抽样 (别名法)，接口与 ShuffleBag 相同"""
+
+    def __init__(self, table, rng):
+        self.table = table
+        self.rng = rng
+
+    def draw(self, exclude=()):
+        for _ in range(1000):
+            k = self.table.sample(self.rng)
+            if k not in exclude:
+                return k
+        raise ValueError("素材库可选元素不足")
+
+def make_sampler(table, rng):
+    if PLAN_SAMPLING == "alias":
+        return AliasSampler(table, rng)
+    if PLAN_SAMPLING == "bag":
+        return ShuffleBag(table.bag_items(), rng)
+    raise ValueError(f"未知的 PLAN_SAMPLING: {PLAN_SAMPLING}")
+
+def vocab_fingerprint():
+    """素材库与复杂度比例的指纹，素材变了旧规划就不再对应"""
+    return get_vocabulary().fingerprint()
+
+def plan_deck(num_cards, master_seed):
+    """由 master_seed 确定性地排出整副牌。
+
+    主语/动作/地点/关系/氛围各用一个抽样器 (见 PLAN_SAMPLING)，抽的是素材序号；
+    骨架按 CombinationSpace 编号去重，编号相同的卡片会重抽。规划按顺序生成，
+    因此 plan_deck(n)[:m] == plan_deck(m)，扩大 NUM_CARDS 不会改变已有卡片。
+    """
+    rng = random.Random(master_seed)
+    vocab = get_vocabulary()
+    t = vocab.tables
+    subjects, actions, locations, relations, moods = (
+        make_sampler(t[c], rng) for c in ("subjects", "actions", "locations", "relations", "moods")
+    )
+
+    seen = set()
+    cards = []
+    for index in range(num_cards):
+        for _ in range(PLAN_MAX_REDRAWS):
+            is_complex = rng.random() < COMPLEXITY_RATIO
+            mood, location = moods.draw(), locations.draw()
+            if is_complex:
+                subj_1 = subjects.draw()
+                act_1 = actions.draw()
+                subj_ids = [subj_1, subjects.draw(exclude={subj_1})]
+                act_ids = [act_1, actions.draw()]
+                relation = relations.draw()
+            else:
+                subj_ids = [subjects.draw()]
+                act_ids = [actions.draw()]
+                relation = None
+            key = vocab.space.encode(is_complex, mood, location, subj_ids, act_ids, relation)
+            if key not in seen:
+                break
+        seen.add(key)
+        cards.append({
+            "index": index, "complex": is_complex, "mood": t["moods"].items[mood], "location": t["locations"].items[location],
+            "subjects": [t["subjects"].items[k] for k in subj_ids], "actions": [t["actions"].items[k] for k in act_ids],
+            "relation": None if relation is None else t["relations"].items[relation],
+            "image_seed": rng.randint(0, 999999),
+        })
+    return cards
+
+def coverage_report(cards):
+    """每类素材被用到的比例"""
+    used = {
+        "subjects": {s for c in cards for s in c["subjects"]},
+        "actions": {a for c in cards for a in c["actions"]},
+        "locations": {c["location"] for c in cards},
+        "relations": {c["relation"] for c in cards if c["relation"]},
+        "moods": {c["mood"] for c in cards},
+    }
+    tables = get_vocabulary().tables
+    return {name: (len(used[name]), len(tables[name])) for name in used}
+
+_DECK_PLAN = None
+_DECK_PLAN_LOCK = threading.Lock()
+
+def load_deck_plan():
+    """读取输出目录里保存的规划；不存在或卡数不够时重新规划并保存。
+
+    已保存的规划优先于当前配置: 主种子或素材库变了只给出警告，因为已生成的卡片对应的是旧规划。
+    """
+    path = os.path.join(OUTPUT_DIR, DECK_PLAN_FILE)
+    fingerprint = vocab_fingerprint()
+    saved = None
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved["master_seed"] != MASTER_SEED or saved["vocab"] != fingerprint:
+            logger.warning(f"⚠️ {path} 与当前的主种子/素材库不一致，继续沿用已保存的规划 (删除该文件可重新规划)")
+            if len(saved["cards"]) >= NUM_CARDS:
+                return saved["cards"]
+            raise ValueError(f"{path} 只规划了 {len(saved['cards'])} 张，且与当前配置不一致，无法扩展")
+        if len(saved["cards"]) >= NUM_CARDS:
+            return saved["cards"]
+
+    cards = plan_deck(NUM_CARDS, MASTER_SEED)
+    plan = {"version": 1, "master_seed": MASTER_SEED, "vocab": fingerprint, "packs": get_vocabulary().packs,
+            "num_cards": NUM_CARDS, "cards": cards}
+    ensure_dir(OUTPUT_DIR)
+    tmp_path = f"{path}.{os.getpid()}.tmp"   # 分片模式下多个进程可能同时写
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(plan, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+    coverage = ", ".join(f"{name} {used}/{total}" for name, (used, total) in coverage_report(cards).items())
+    logger.info(f"🗺️ 已规划 {NUM_CARDS} 张卡片 (主种子 {MASTER_SEED})，素材覆盖: {coverage}")
+    return cards
+
+def get_deck_plan():
+    global _DECK_PLAN
+    with _DECK_PLAN_LOCK:
+        if _DECK_PLAN is None:
+            _DECK_PLAN = load_deck_plan()
+        return _DECK_PLAN
 
 # ================= 🛠️ 核心逻辑 =================
 
@@ -273,14 +1491,104 @@ def compute_backoff_seconds(attempt):
     base_delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))
     return base_delay + random.uniform(0.5, 1.5)
 
+class DownloadCancelled(Exception):
+    """对冲请求中已有其他引擎先完成，本次下载被放弃"""
+
+_COMMIT_LOCK = threading.Lock()
+
+def sleep_or_cancel(seconds, cancel=None):
+    """等待 seconds 秒；cancel 事件在此期间被置位则提前返回 True"""
+    if cancel is None:
+        time.sleep(seconds)
+        return False
+    return cancel.wait(seconds)
+
+def stream_to_file(response, file_path, min_bytes=MIN_IMAGE_BYTES, cancel=None, validate=None):
+    """把响应体分块写入同目录的临时文件，校验通过后原子重命名为 file_path。
+
+    validate(临时文件路径) 在重命名前调用，抛出异常即放弃这次下载。
+
+    返回写入的字节数；内容过小返回 None。任何异常 (超时/断线/中断) 都会删除临时文件，
+    因此 file_path 要么不存在，要么是完整的文件，断点续传检查不会被半截图片骗过。
+    传入 cancel 事件时: 事件已置位则抛出 DownloadCancelled；
+    成功重命名的一方会置位该事件，保证对冲的多个请求里只有一个写入 file_path。
+    """
+    try:
+        declared = int(response.headers.get("Content-Length", ""))
+    except ValueError:
+        declared = None
+    if declared is not None and declared < min_bytes:
+        response.close()
+        return None
+
+    directory = os.path.dirname(file_path) or "."
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(file_path) + ".", suffix=".part", dir=directory)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                if cancel is not None and cancel.is_set():
+                    raise DownloadCancelled()
+                if chunk:
+                    f.write(chunk)
+                    size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        if size < min_bytes:
+            os.remove(tmp_path)
+            return None
+        if validate is not None:
+            validate(tmp_path)
+        with _COMMIT_LOCK:
+            if cancel is not None:
+                if cancel.is_set():
+                    raise DownloadCancelled()
+                cancel.set()
+            os.replace(tmp_path, file_path)
+        METRICS.inc("download_bytes", size, host=endpoint_of(response.url or ""))
+        return size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        response.close()
+
+def cleanup_partial_downloads(directory):
+    """删除上次崩溃遗留的 .part 临时文件"""
+    for name in os.listdir(directory):
+        if name.endswith(".part"):
+            os.remove(os.path.join(directory, name))
+
+_FAILED_URLS = collections.Counter()
+_FAILED_URLS_LOCK = threading.Lock()
+
+def shorten_url(url, limit=LOG_URL_MAX_CHARS):
+    """超长 URL (中间是百分号编码的 Prompt) 只保留开头和结尾"""
+    if len(url) <= limit:
+        return url
+    keep = max(1, (limit - 3) // 2)
+    return f"{url[:keep]}...{url[-keep:]}"
+
 def log_failed_url(reason, url):
-    logger.warning(f"   🔗 {reason}: {url}")
+    """记录失败的 URL: 截断过长的部分，同一 URL 反复失败时每 LOG_URL_REPEAT_EVERY 次记录一次。
+    JSON 日志里首次失败附带完整 URL"""
+    with _FAILED_URLS_LOCK:
+        if len(_FAILED_URLS) > 10000:
+            _FAILED_URLS.clear()
+        _FAILED_URLS[url] += 1
+        count = _FAILED_URLS[url]
+    if count > 1 and count % LOG_URL_REPEAT_EVERY:
+        return
+    logger.warning("   🔗 %s (第 %d 次): %s", reason, count, shorten_url(url),
+                   extra={"url": url} if count == 1 else None)
 
-def construct_concept(index):
-    """构建概念并获取 AI 描述 (修复了变量作用域bug + 增加了文本重试)"""
-    is_complex = random.random() < COMPLEXITY_RATIO
-    mood = random.choice(MOODS)
-    location = random.choice(LOCATIONS)
+def build_concept(index):
+    """按牌组规划取出骨架，返回 instruction (单张请求用)、brief (批量请求用) 和兜底 Prompt"""
+    card = get_deck_plan()[index]
+    is_complex = card["complex"]
+    mood = card["mood"]
+    location = card["location"]
     
     instruction = ""
     log_prefix = f"[{index+1}/{NUM_CARDS}]"
@@ -289,23 +1597,24 @@ def construct_concept(index):
     fallback_prompt = ""
 
     if is_complex:
-        subj_1, subj_2 = random.sample(SUBJECTS, 2)
-        act_1 = random.choice(ACTIONS)
-        act_2 = random.choice(ACTIONS)
-        relation_template = random.choice(RELATIONS)
+        subj_1, subj_2 = card["subjects"]
+        act_1, act_2 = card["actions"]
+        relation_template = get_vocabulary().template(card["relation"])
         
         phrase_1 = f"{subj_1} that is {act_1}"
         phrase_2 = f"{subj_2} that is {act_2}"
-        spatial_desc = relation_template.replace("[A]", phrase_1).replace("[B]", phrase_2)
+        spatial_desc = relation_template.fill(phrase_1, phrase_2)
         
-        logger.info(f"🤖 {log_prefix} 构思: 双重叙事 ({mood})")
-        logger.info(f"   -> 骨架: {spatial_desc} @ {location}")
+        logger.info("🤖 %s 构思: 双重叙事 (%s)", log_prefix, mood)
+        logger.info("   -> 骨架: %s @ %s", spatial_desc, location)
         
-        instruction = (
-            f"Generate a surreal Dixit card description. "
+        brief = (
             f"Setting: {location}. Mood: {mood}. "
             f"Composition/Story: {spatial_desc}. "
-            "Describe the visual contrast and connection between the two elements. "
+            "Describe the visual contrast and connection between the two elements."
+        )
+        instruction = (
+            f"Generate a surreal Dixit card description. {brief} "
             "Make it artistic, abstract, and poetic. "
             "Output ONLY the description."
         )
@@ -313,200 +1622,2321 @@ def construct_concept(index):
         fallback_prompt = f"Surreal art of {spatial_desc}, set in {location}, {mood} style"
         
     else:
-        subj = random.choice(SUBJECTS)
-        act = random.choice(ACTIONS)
+        subj, = card["subjects"]
+        act, = card["actions"]
         
-        logger.info(f"🤖 {log_prefix} 构思: 经典聚焦 ({mood})")
-        logger.info(f"   -> 骨架: {subj} + {act} @ {location}")
+        logger.info("🤖 %s 构思: 经典聚焦 (%s)", log_prefix, mood)
+        logger.info("   -> 骨架: %s + %s @ %s", subj, act, location)
         
-        instruction = (
-            f"Generate a surreal Dixit card description. "
+        brief = (
             f"Subject: {subj}. Action: {act}. Setting: {location}. Mood: {mood}. "
-            "Focus on the fine details, texture, and the surreal atmosphere. "
+            "Focus on the fine details, texture, and the surreal atmosphere."
+        )
+        instruction = (
+            f"Generate a surreal Dixit card description. {brief} "
             "Output ONLY the description."
         )
         # 修复点 1：在这里正确定义简单模式下的兜底词
         fallback_prompt = f"Surreal art of {subj} {act}, set in {location}, {mood} style"
 
-    # 请求 Text API (修复点 2：增加重试循环)
+    return {"instruction": instruction, "brief": brief, "fallback": fallback_prompt}
+
+def construct_concept(index, info=None):
+    """构建概念并获取 AI 描述 (修复了变量作用域bug + 增加了文本重试)
+
+    传入 info 字典时会填入 text_seed 和 source (api/cache/offline/fallback)。
+    """
+    info = {} if info is None else info
+    concept = build_concept(index)
+    instruction = concept["instruction"]
+    fallback_prompt = concept["fallback"]
+
+    seed = text_seed_for(instruction)
+    info["text_seed"] = seed
+    cache = get_prompt_cache()
+    cached = cache.get(instruction, seed)
+    if cached:
+        logger.info("   💾 命中文案缓存: %.60s...", cached)
+        info["source"] = "cache"
+        return cached
+    if TEXT_OFFLINE:
+        logger.info("   📴 离线模式且缓存未命中，使用兜底 Prompt")
+        info["source"] = "offline"
+        return fallback_prompt
+
+    # 请求 Text API (共享的重试循环)
     prompt_encoded = urllib.parse.quote(instruction)
-    seed = random.randint(0, 100000)
-    url = f"https://text.pollinations.ai/{prompt_encoded}?seed={seed}&model=openai"
-    
-    for attempt in range(TEXT_MAX_RETRIES):
-        try:
-            start_time = time.time()
-            headers = {"User-Agent": random.choice(USER_AGENTS)}
-            response = SESSION.get(url, headers=headers, timeout=(5, 30))
-            
-            if response.status_code == 200:
-                desc = clean_text(response.text)
-                if not desc:
-                    wait = compute_backoff_seconds(attempt)
-                    logger.warning(f"   ⚠️ 文本API返回空内容，等待 {wait:.1f}s 后重试 ({attempt+1}/{TEXT_MAX_RETRIES})...")
-                    log_failed_url("空内容URL", url)
-                    time.sleep(wait)
-                    continue
-                elapsed = time.time() - start_time
-                logger.info(f"   💡 获得灵感 (耗时 {elapsed:.2f}s): {desc[:60]}...")
-                return desc
-            if response.status_code not in RETRY_STATUS_CODES:
-                logger.error(f"   ❌ 文本API状态码 {response.status_code}，停止重试")
-                log_failed_url("失败URL", url)
-                break
-            else:
-                wait = compute_backoff_seconds(attempt)
-                logger.warning(f"   ⚠️ 文本API状态码 {response.status_code}，等待 {wait:.1f}s 后重试 ({attempt+1}/{TEXT_MAX_RETRIES})...")
-                log_failed_url("失败URL", url)
-                time.sleep(wait)
-                
-        except Exception as e:
-            wait = compute_backoff_seconds(attempt)
-            logger.warning(f"   ⚠️ 获取灵感网络异常: {e}，等待 {wait:.1f}s 后重试 ({attempt+1}/{TEXT_MAX_RETRIES})...")
-            log_failed_url("异常URL", url)
-            time.sleep(wait)
+    url = f"{TEXT_API_BASE}/{prompt_encoded}?seed={seed}&model=openai"
+    # 对冲请求换一个 seed，避免命中服务端同一个慢请求
+    hedge_url = f"{TEXT_API_BASE}/{prompt_encoded}?seed={seed + 1}&model=openai"
+
+    def handle(response):
+        desc = clean_text(response.text)
+        if not desc:
+            raise RetryableResponse("返回空内容")
+        # 对冲请求可能先返回: 记下实际生成这段文案的 seed
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(response.url).query)
+        return desc, int(query["seed"][0]) if query.get("seed") else seed
+
+    start_time = time.time()
+    headers = {"User-Agent": random.choice(USER_AGENTS)}
+    result, _ = request_with_retries(
+        "GET", [url, hedge_url], "文本API", TEXT_MAX_RETRIES, TEXT_TIMEOUT, handle, kind="text", headers=headers,
+    )
+    if result:
+        desc, used_seed = result
+        elapsed = time.time() - start_time
+        logger.info("   💡 获得灵感 (耗时 %.2fs): %.60s...", elapsed, desc)
+        # 缓存在实际的 seed 下: 对冲赢得的文案不能冒充主 seed 的结果
+        cache.put(instruction, used_seed, desc)
+        info["text_seed"] = used_seed
+        info["source"] = "api"
+        return desc
     
     # 如果多次重试都失败，使用我们提前准备好的 fallback_prompt
-    logger.error(f"   ❌ 多次尝试失败，启用兜底 Prompt")
-    log_failed_url("最终失败URL", url)
+    logger.error("   ❌ 多次尝试失败，启用兜底 Prompt")
+    info["source"] = "fallback"
     return fallback_prompt
 
-def generate_image(prompt, filename):
+def parse_description_array(text, count):
+    """从文本 API 的回复中解析出 count 条描述，缺失或格式不对的条目为 None"""
+    results = [None] * count
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end <= start:
+        return results
+    try:
+        items = json.loads(text[start:end + 1])
+    except ValueError:
+        return results
+    if not isinstance(items, list):
+        return results
+    for k, item in enumerate(items[:count]):
+        if isinstance(item, dict):
+            item = item.get("description")
+        if isinstance(item, str) and clean_text(item):
+            results[k] = clean_text(item)
+    return results
+
+def construct_concepts_batch(indices, infos=None):
+    """批量构思: 缓存未命中的卡片合并成一次文本请求，要求返回 JSON 数组。
+
+    每张卡片仍按自己的 (instruction, seed) 读写缓存，与单张模式互通；
+    回复里缺失或格式错误的条目各自退回兜底 Prompt。
+    """
+    infos = [{} for _ in indices] if infos is None else infos
+    concepts = [build_concept(index) for index in indices]
+    cache = get_prompt_cache()
+    results = [None] * len(indices)
+    misses = []
+    for k, concept in enumerate(concepts):
+        seed = text_seed_for(concept["instruction"])
+        infos[k]["text_seed"] = seed
+        cached = cache.get(concept["instruction"], seed)
+        if cached:
+            results[k] = cached
+            infos[k]["source"] = "cache"
+        elif TEXT_OFFLINE:
+            results[k] = concept["fallback"]
+            infos[k]["source"] = "offline"
+        else:
+            misses.append(k)
+    if len(misses) < len(indices):
+        logger.info("   💾 批量构思命中缓存 %d/%d 张", len(indices) - len(misses), len(indices))
+    if not misses:
+        return results
+
+    lines = [f"{n + 1}. {concepts[k]['brief']}" for n, k in enumerate(misses)]
+    instruction = (
+        f"Generate {len(misses)} surreal Dixit card descriptions, one for each numbered concept below. "
+        "Make each one artistic, abstract, and poetic. "
+        f"Output ONLY a JSON array of exactly {len(misses)} strings, in the same order.\n"
+        + "\n".join(lines)
+    )
+    seed = text_seed_for(instruction)
+    prompt_encoded = urllib.parse.quote(instruction)
+    url = f"{TEXT_API_BASE}/{prompt_encoded}?seed={seed}&model=openai"
+    hedge_url = f"{TEXT_API_BASE}/{prompt_encoded}?seed={seed + 1}&model=openai"
+
+    start_time = time.time()
+    headers = {"User-Agent": random.choice(USER_AGENTS)}
+    descriptions, _ = request_with_retries(
+        "GET", [url, hedge_url], "文本API", TEXT_MAX_RETRIES, TEXT_TIMEOUT,
+        lambda response: parse_description_array(response.text, len(misses)), kind="batch", headers=headers,
+    )
+    if descriptions is None:
+        descriptions = [None] * len(misses)
+    else:
+        elapsed = time.time() - start_time
+        parsed = sum(1 for d in descriptions if d)
+        logger.info("   💡 批量获得灵感 %d/%d 条 (耗时 %.2fs)", parsed, len(misses), elapsed)
+
+    for k, desc in zip(misses, descriptions):
+        concept = concepts[k]
+        if desc:
+            cache.put(concept["instruction"], infos[k]["text_seed"], desc)
+            results[k] = desc
+            infos[k]["source"] = "batch"
+        else:
+            logger.warning("   ⚠️ [%d/%d] 批量结果缺失，启用兜底 Prompt", indices[k] + 1, NUM_CARDS, extra={"card": indices[k] + 1})
+            results[k] = concept["fallback"]
+            infos[k]["source"] = "fallback"
+    return results
+
+def save_image_response(response, file_path, cancel=None, info=None):
+    """把 200 响应流式落盘；非图片或过小时抛出 RetryableResponse，未通过校验时见 gate_image"""
+    content_type = response.headers.get("Content-Type", "").lower()
+    if not content_type.startswith("image/"):
+        response.close()
+        raise RetryableResponse(f"返回内容非图片 (Content-Type: {content_type or 'unknown'})")
+    size = stream_to_file(response, file_path, cancel=cancel, validate=functools.partial(gate_image, info=info))
+    if size is None:
+        raise RetryableResponse(f"图片内容过小 (<{MIN_IMAGE_BYTES}B)")
+    return size
+
+def download_image(method, url, filename, info, label, cancel=None, **kwargs):
+    """两个引擎共用: 带重试地请求图片并原子写入 OUTPUT_DIR/filename"""
     file_path = os.path.join(OUTPUT_DIR, filename)
+    logger.info("   🎨 [%s] 正在绘制 %s ...", label, filename)
+    start_t = time.time()
+    try:
+        size, error = request_with_retries(
+            method, [url], label, IMAGE_MAX_RETRIES, IMAGE_TIMEOUT,
+            functools.partial(save_image_response, file_path=file_path, cancel=cancel, info=info),
+            cancel=cancel, kind="image", stream=True, **kwargs,
+        )
+    except DownloadCancelled:
+        info["error"] = "已被其他引擎抢先完成"
+        return False
+    if size is None:
+        info["error"] = error
+        logger.error("   ❌ %s 最终失败，跳过。", filename, extra={"error": error})
+        return False
+    elapsed = time.time() - start_t
+    logger.info("   ✅ 保存成功: %s (%.1fKB, 耗时 %.1fs)", filename, size / 1024, elapsed)
+    return True
+
+def generate_image(prompt, filename, info=None, cancel=None, seed=None):
+    """引擎 A: Pollinations"""
+    info = {} if info is None else info
     full_prompt = f"{prompt}, surreal masterpiece, Dixit board game style, vector art, soft colors, 8k resolution, highly detailed"
     encoded_prompt = urllib.parse.quote(full_prompt)
-    seed = random.randint(0, 999999)
-    url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?nologo=true&seed={seed}&width=1024&height=1024&model=flux-realism&enhance=true"
-
-    proxies = get_proxies()
+    if seed is None:
+        seed = random.randint(0, 999999)
+    url = f"{IMAGE_API_BASE}/prompt/{encoded_prompt}?nologo=true&seed={seed}&width=1024&height=1024&model=flux-realism&enhance=true"
+    info.update(seed=seed, model="flux-realism", url=url, error=None)
+    headers = {"User-Agent": random.choice(USER_AGENTS)}
+    return download_image("GET", url, filename, info, "Pollinations", cancel, headers=headers)
 
-    for attempt in range(IMAGE_MAX_RETRIES):
-        try:
-            logger.info(f"   🎨 正在绘制 (尝试 {attempt+1}/{IMAGE_MAX_RETRIES})...")
-            start_t = time.time()
-            
-            headers = {"User-Agent": random.choice(USER_AGENTS)}
-            r = SESSION.get(url, headers=headers, timeout=(10, 120))
-            
-            content_type = r.headers.get("Content-Type", "").lower()
-            if r.status_code == 200 and content_type.startswith("image/") and len(r.content) > 1024:
-                with open(file_path, 'wb') as f:
-                    f.write(r.content)
-                elapsed = time.time() - start_t
-                file_size = os.path.getsize(file_path) / 1024 
-                logger.info(f"   ✅ 保存成功: {filename} ({file_size:.1f}KB, 耗时 {elapsed:.1f}s)")
-                return True
-            if r.status_code not in RETRY_STATUS_CODES:
-                logger.error(f"   ❌ 图片服务器错误: {r.status_code}，停止重试")
-                log_failed_url("失败URL", url)
-                break
-            wait = compute_backoff_seconds(attempt)
-            if r.status_code == 200:
-                logger.warning(f"   ⚠️ 返回内容非图片 (Content-Type: {content_type or 'unknown'})，等待 {wait:.1f}s 后重试...")
-                log_failed_url("非图片URL", url)
-            else:
-                logger.warning(f"   ⚠️ 图片服务器错误: {r.status_code}，等待 {wait:.1f}s 后重试...")
-                log_failed_url("失败URL", url)
-            time.sleep(wait)
-                
-        except requests.exceptions.ReadTimeout:
-            wait = compute_backoff_seconds(attempt)
-            logger.warning(f"   🐢 生成超时 (服务器繁忙)，等待 {wait:.1f}s 后重试...")
-            log_failed_url("超时URL", url)
-            time.sleep(wait)
-        except Exception as e:
-            wait = compute_backoff_seconds(attempt)
-            logger.error(f"   ❌ 连接异常: {e}，等待 {wait:.1f}s 后重试...")
-            log_failed_url("异常URL", url)
-            time.sleep(wait)
-            
-    logger.error(f"   ❌ {filename} 最终失败，跳过。")
-    log_failed_url("最终失败URL", url)
-    return False
-
-def load_token(path="./.ai/HFTOKEN"):
-    """从文件读取 Token，去除空白符"""
-    if os.path.exists(path):
+def load_token(path="./.ai/HFTOKEN"):
+    """从文件读取 Token，去除空白符"""
+    if os.path.exists(path):
         try:
             with open(path, 'r', encoding='utf-8') as f:
                 token = f.read().strip()
                 if token:
-                    print(f"🔑 已加载 Token: {token[:4]}******")
+                    logger.info(f"🔑 已加载 Token: {token[:4]}******")
                     return token
         except Exception as e:
-            print(f"⚠️ 读取 Token 文件失败: {e}")
+            logger.warning(f"⚠️ 读取 Token 文件失败: {e}")
     else:
-        print(f"⚠️ 警告: 找不到 Token 文件: {path} (如果使用 Pollinations 可忽略)")
+        logger.warning(f"⚠️ 警告: 找不到 Token 文件: {path}")
     return ""
 
-HF_TOKEN = load_token()
-HF_MODEL = "stabilityai/stable-diffusion-xl-base-1.0"   # 推荐 FLUX，也可以用 "stabilityai/stable-diffusion-xl-base-1.0"
-USE_PROXY = True
+HF_TOKEN = None   # 第一次使用 HuggingFace 引擎时才读取 Token 文件
 
-def get_proxies():
-    """获取代理配置"""
-    # 优先使用脚本里强制指定的代理
-    if USE_PROXY:
-        return {"http": "http://127.0.0.1:7897", "https": "http://127.0.0.1:7897"}
-    
-    # 如果脚本里没指定，自动尝试读取系统的环境变量 (即你 export 的那些)
-    # requests 库默认会自动读取环境变量，所以这里返回 None 即可让它自动接管
-    return None
+def get_hf_token():
+    global HF_TOKEN
+    if HF_TOKEN is None:
+        HF_TOKEN = load_token()
+    return HF_TOKEN
+HF_MODEL = "stabilityai/stable-diffusion-xl-base-1.0"   # 推荐 FLUX，也可以用 "stabilityai/stable-diffusion-xl-base-1.0"
 
-def generate_huggingface(prompt, filename):
-    file_path = os.path.join(OUTPUT_DIR, filename)
-    """引擎 B: Hugging Face (新版 URL + SSL 修复)"""
-    if HF_TOKEN.startswith("hf_xx"):
-        print("   ❌ 错误: 请先在脚本顶部填入正确的 HF_TOKEN！")
-        return
+def generate_huggingface(prompt, filename, info=None, cancel=None, seed=None):
+    """引擎 B: Hugging Face (新版 router URL)。冷启动的 503 按 estimated_time 等待后有限次重试"""
+    info = {} if info is None else info
+    token = get_hf_token()
+    if not token or token.startswith("hf_xx"):
+        logger.error("   ❌ 错误: 请先在 ./.ai/HFTOKEN 填入正确的 HF Token！")
+        info["error"] = "HF_TOKEN 未配置"
+        return False
 
     # 【关键修改】这里换成了新的 router 域名
-    api_url = f"https://router.huggingface.co/hf-inference/models/{HF_MODEL}"
-    
-    headers = {"Authorization": f"Bearer {HF_TOKEN}"}
-    proxies = get_proxies()
+    api_url = f"{HF_API_BASE}/hf-inference/models/{HF_MODEL}"
+    info.update(seed=seed, model=HF_MODEL, url=api_url, error=None)
     
+    headers = {"Authorization": f"Bearer {token}"}
     payload = {
         "inputs": prompt,
         "parameters": {"width": 1024, "height": 1024}
     }
+    if seed is not None:
+        payload["parameters"]["seed"] = seed
+    return download_image("POST", api_url, filename, info, "HuggingFace", cancel, headers=headers, json=payload)
+
+# ================= 🖼️ 图片引擎 =================
 
-    print(f"   [HuggingFace] 正在请求 API: {filename} ...")
+class ImageBackend:
+    """图片引擎接口。
 
+    generate() 把图片原子写入 OUTPUT_DIR/filename，返回是否成功；seed 来自牌组规划，
+    引擎应尽量用它保证可复现；info 字典回填 seed/model/url/error；
+    cancel 事件被置位时应尽快放弃 (对冲中落败的一方)。
+    """
+
+    name = None
+
+    def generate(self, prompt, filename, info, cancel=None, seed=None):
+        raise NotImplementedError
+
+IMAGE_BACKENDS = {}
+
+def register_backend(cls):
+    """类装饰器: 以 cls.name 注册一个引擎实例"""
+    IMAGE_BACKENDS[cls.name] = cls()
+    return cls
+
+def default_backend():
+    """当前的主引擎: 未指定 IMAGE_BACKEND 时按输出目录决定 (在命令行覆盖 OUTPUT_DIR 之后才求值)"""
+    if IMAGE_BACKEND is not None:
+        return IMAGE_BACKEND
+    return "huggingface" if os.path.basename(os.path.normpath(OUTPUT_DIR)) == "stable" else "pollinations"
+
+def get_backend(name):
     try:
-        # verify=False 必须保留，否则代理会报错
-        response = requests.post(
-            api_url, 
-            headers=headers, 
-            json=payload, 
-            proxies=proxies, 
-            timeout=120, 
-            verify=False
+        return IMAGE_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"未知的图片引擎: {name} (可选: {', '.join(sorted(IMAGE_BACKENDS))})") from None
+
+@register_backend
+class PollinationsBackend(ImageBackend):
+    """引擎 A: image.pollinations.ai"""
+
+    name = "pollinations"
+
+    def generate(self, prompt, filename, info, cancel=None, seed=None):
+        delay = LATENCY.hedge_delay(endpoint_of(IMAGE_API_BASE), "image") if HEDGE_DUPLICATES else None
+        if delay is None:
+            return generate_image(prompt, filename, info, cancel, seed)
+
+        # 超过 p95 还没出图: 换一个 seed 再画一次，先完成的写入文件，另一个被取消
+        if seed is None:
+            seed = random.randint(0, 999999)
+        seeds = [seed, (seed + 1) % 1000000]
+        infos = [{}, {}]
+
+        def attempt(k, cancel):
+            if k > 0 and not hedge_allowed(IMAGE_API_BASE):
+                return False
+            return generate_image(prompt, filename, infos[k], cancel, seed=seeds[k])
+
+        winner, _ = run_hedged(
+            [(0, functools.partial(attempt, 0)), (delay, functools.partial(attempt, 1))],
+            cancel=cancel, from_send=True,
         )
-        
-        # 处理模型冷启动 (503)
-        if response.status_code == 503:
-            wait_time = response.json().get("estimated_time", 20)
-            print(f"   😴 模型正在启动中，需等待 {wait_time:.1f} 秒...")
-            time.sleep(wait_time)
-            # 递归重试
-            return generate_huggingface(prompt, filename)
-
-        if response.status_code == 200:
-            with open(file_path, "wb") as f:
-                f.write(response.content)
-            print(f"   ✅ 成功保存: {file_path}")
+        info.update(infos[0 if winner is None else winner])
+        if winner == 1:
+            logger.info("   🔀 %s 对冲请求先完成 (p95=%.1fs)", filename, delay)
+        return winner is not None
+
+@register_backend
+class HuggingFaceBackend(ImageBackend):
+    """引擎 B: Hugging Face router"""
+
+    name = "huggingface"
+
+    def generate(self, prompt, filename, info, cancel=None, seed=None):
+        return generate_huggingface(prompt, filename, info, cancel, seed)
+
+def run_hedged(attempts, cancel=None, from_send=False):
+    """对冲执行: attempts 为 [(启动延迟秒数, fn)]，fn(cancel) 返回真值表示成功。
+
+    延迟默认从开始执行时算起 (例如切换备用引擎看的是总耗时)；from_send 为真时从第一个尝试的请求
+    真正发出 (拿到限流令牌) 时算起，排队等令牌的时间不算，用于同一主机上的重复请求。
+    按延迟依次启动，某个尝试提前失败时立即启动下一个。返回第一个成功的 (下标, 结果)，
+    同时置位 cancel 让其余尝试放弃；全部失败返回 (None, None)。
+    传入外层的 cancel 事件可以让嵌套的对冲共享同一个"已完成"信号。
+    尝试跑在守护线程里，落败方若卡在阻塞的 HTTP 调用中也不会拖住主流程。
+    """
+    cancel = threading.Event() if cancel is None else cancel
+    results = queue.Queue()
+    start = None if from_send else time.monotonic()
+    launched = finished = 0
+    in_flight = threading.Event()
+    # 嵌套对冲: 内层第一个请求发出，也就是外层这次尝试已在途
+    parent = getattr(_IN_FLIGHT, "notify", None)
+
+    def sent():
+        if parent is not None:
+            parent()
+        if not in_flight.is_set():
+            in_flight.set()
+            results.put((None, None))
+
+    def run(k, fn):
+        _IN_FLIGHT.notify = sent if from_send and k == 0 else None
+        try:
+            value = fn(cancel)
+        except Exception as e:
+            logger.error("   ❌ 对冲请求 #%d 异常: %s", k + 1, e)
+            value = None
+        results.put((k, value))
+
+    def launch():
+        nonlocal launched
+        threading.Thread(target=run, args=(launched, attempts[launched][1]), daemon=True).start()
+        launched += 1
+
+    while finished < len(attempts):
+        elapsed = None if start is None else time.monotonic() - start
+        while launched < len(attempts) and (finished == launched or (elapsed is not None and attempts[launched][0] <= elapsed)):
+            launch()
+        timeout = attempts[launched][0] - elapsed if launched < len(attempts) and elapsed is not None else None
+        try:
+            k, value = results.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        if k is None:
+            start = time.monotonic()
+            continue
+        finished += 1
+        if value:
+            cancel.set()
+            return k, value
+    return None, None
+
+def render_image(prompt, filename, info, seed=None):
+    """按主引擎 (见 default_backend) 出图；配置了 FALLBACK_BACKENDS 时对冲请求，取最先完成的引擎"""
+    chain = [get_backend(name) for name in [default_backend(), *FALLBACK_BACKENDS]]
+    if len(chain) == 1:
+        info["backend"] = chain[0].name
+        return chain[0].generate(prompt, filename, info, seed=seed)
+
+    infos = [{} for _ in chain]
+
+    def attempt(k, cancel):
+        if k > 0:
+            logger.info("   🔀 %s 启动备用引擎 %s", filename, chain[k].name)
+        return chain[k].generate(prompt, filename, infos[k], cancel, seed)
+
+    attempts = [(k * HEDGE_AFTER_SECONDS, functools.partial(attempt, k)) for k in range(len(chain))]
+    winner, _ = run_hedged(attempts)
+    if winner is None:
+        info.update(infos[0])
+        info["backend"] = chain[0].name
+        info["error"] = "; ".join(f"{b.name}: {i.get('error')}" for b, i in zip(chain, infos))
+        return False
+    info.update(infos[winner])
+    info["backend"] = chain[winner].name
+    if winner > 0:
+        logger.info("   🏁 %s 由备用引擎 %s 完成", filename, chain[winner].name)
+    return True
+
+# ================= 📒 运行日志 =================
+
+STAGE_PENDING = "pending"                # 尚未开始
+STAGE_CONCEPT_DONE = "concept_done"      # 文案已就绪，等待绘图
+STAGE_CONCEPT_FAILED = "concept_failed"  # 构思阶段异常
+STAGE_IMAGE_DONE = "image_done"          # 图片已保存
+STAGE_IMAGE_FAILED = "image_failed"      # 绘图失败，文案可复用
+
+# 重跑时的优先级: 文案已就绪的卡片只差一次绘图，最先处理
+RESUME_PRIORITY = {
+    STAGE_IMAGE_FAILED: 0,
+    STAGE_CONCEPT_DONE: 0,
+    STAGE_PENDING: 1,
+    STAGE_CONCEPT_FAILED: 2,
+}
+
+JOURNAL_SCHEMA = {
+    "idx": "INTEGER PRIMARY KEY",
+    "filename": "TEXT",
+    "stage": "TEXT NOT NULL DEFAULT 'pending'",
+    "prompt": "TEXT",
+    "prompt_source": "TEXT",
+    "text_seed": "INTEGER",
+    "image_seed": "INTEGER",
+    "backend": "TEXT",
+    "model": "TEXT",
+    "url": "TEXT",
+    "error": "TEXT",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+    "variant": "INTEGER NOT NULL DEFAULT 0",
+    "concept_secs": "REAL",
+    "image_secs": "REAL",
+    "updated": "REAL",
+}
+
+def connect_readonly(path):
+    """只读打开 SQLite 文件: 不建表、不改 journal_mode，也不在目录里留下 -wal/-shm 文件。
+
+    有 -wal 文件说明可能有进程正在写 (或上次崩溃)，按 mode=ro 打开以读到最新内容；
+    没有时库已完整落盘、也没有写入方，按 immutable 打开 (只读目录里同样可用)。
+    """
+    import pathlib
+    uri = pathlib.Path(os.path.abspath(path)).as_uri()
+    if os.path.exists(path + "-wal"):
+        try:
+            conn = sqlite3.connect(f"{uri}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute("PRAGMA schema_version")
+            return conn
+        except sqlite3.OperationalError:
+            pass   # 只读目录里缺少 -shm 文件
+    return sqlite3.connect(f"{uri}?immutable=1", uri=True, check_same_thread=False)
+
+class Journal:
+    """每张卡片一行的 SQLite 运行日志，多线程共享一个连接 (WAL 模式，运行中也能查询状态)。
+    readonly 时只读打开 (status 命令用)，不会写入输出目录"""
+
+    def __init__(self, path, readonly=False):
+        self.lock = threading.Lock()
+        if readonly:
+            self.conn = connect_readonly(path)
+            self.conn.row_factory = sqlite3.Row
+            return
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            columns = ", ".join(f"{name} {decl}" for name, decl in JOURNAL_SCHEMA.items())
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS cards ({columns})")
+            # 旧版本创建的日志缺少新增列时补上
+            existing = {row[1] for row in self.conn.execute("PRAGMA table_info(cards)")}
+            for name, decl in JOURNAL_SCHEMA.items():
+                if name not in existing:
+                    self.conn.execute(f"ALTER TABLE cards ADD COLUMN {name} {decl}")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS cards_stage ON cards (stage)")
+
+    def get(self, index):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM cards WHERE idx = ?", (index,)).fetchone()
+        return dict(row) if row else None
+
+    def record(self, index, **fields):
+        """插入或更新一张卡片的若干字段"""
+        unknown = set(fields) - set(JOURNAL_SCHEMA)
+        if unknown:
+            raise ValueError(f"未知的日志字段: {sorted(unknown)}")
+        fields["updated"] = time.time()
+        fields.setdefault("filename", card_filename(index))
+        names = ", ".join(fields)
+        placeholders = ", ".join("?" for _ in fields)
+        updates = ", ".join(f"{name} = excluded.{name}" for name in fields)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT INTO cards (idx, {names}) VALUES (?, {placeholders}) "
+                f"ON CONFLICT (idx) DO UPDATE SET {updates}",
+                (index, *fields.values()),
+            )
+
+    def stage_counts(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT stage, COUNT(*) FROM cards GROUP BY stage").fetchall()
+        return {stage: count for stage, count in rows}
+
+    def failures(self, limit=20):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM cards WHERE stage IN (?, ?) ORDER BY idx LIMIT ?",
+                (STAGE_CONCEPT_FAILED, STAGE_IMAGE_FAILED, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def completed(self):
+        """所有已出图的卡片 (合并分片输出时使用)"""
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM cards WHERE stage = ? ORDER BY idx", (STAGE_IMAGE_DONE,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def resume_order(self, indices, defer_failed=False):
+        """按阶段优先级 (再按序号) 排列待处理的卡片。
+
+        defer_failed: 时间或请求有限时，上次失败过的卡片排到最后，先做更可能一次成功的。
+        """
+        with self.lock:
+            stages = dict(self.conn.execute("SELECT idx, stage FROM cards").fetchall())
+
+        def key(i):
+            stage = stages.get(i, STAGE_PENDING)
+            failed = defer_failed and stage in (STAGE_IMAGE_FAILED, STAGE_CONCEPT_FAILED)
+            return failed, RESUME_PRIORITY.get(stage, 1), i
+
+        return sorted(indices, key=key)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+_JOURNAL = None
+
+def get_journal():
+    global _JOURNAL
+    if _JOURNAL is None:
+        _JOURNAL = Journal(os.path.join(OUTPUT_DIR, JOURNAL_FILE))
+    return _JOURNAL
+
+def prepare_concepts(indices):
+    """构思阶段: 日志里已有文案 (上次绘图失败/中断) 的卡片直接复用，其余重新构思并记录。
+
+    剩余多于一张时走批量请求 (TEXT_BATCH_SIZE 决定调用方每次传入多少张)。
+    """
+    journal = get_journal()
+    prompts = {}
+    todo = []
+    for index in indices:
+        entry = journal.get(index)
+        if entry and entry["prompt"] and entry["stage"] in (STAGE_CONCEPT_DONE, STAGE_IMAGE_FAILED):
+            logger.info("📒 [%d/%d] 复用日志中的文案: %.60s...", index + 1, NUM_CARDS, entry["prompt"], extra={"card": index + 1})
+            prompts[index] = entry["prompt"]
+        else:
+            todo.append(index)
+    if not todo:
+        return [prompts[index] for index in indices]
+
+    start = time.time()
+    infos = [{} for _ in todo]
+    try:
+        with METRICS.span("concept", cards=[index + 1 for index in todo]):
+            if len(todo) == 1:
+                results = [construct_concept(todo[0], infos[0])]
+            else:
+                results = construct_concepts_batch(todo, infos)
+    except Exception as e:
+        for index in todo:
+            journal.record(index, stage=STAGE_CONCEPT_FAILED, error=f"构思异常: {e}")
+        METRICS.inc("cards", len(todo), stage="concept", result="failed")
+        raise
+    METRICS.inc("cards", len(todo), stage="concept", result="ok")
+    per_card = (time.time() - start) / len(todo)
+    for index, prompt, info in zip(todo, results, infos):
+        journal.record(
+            index, stage=STAGE_CONCEPT_DONE, prompt=prompt, prompt_source=info.get("source"),
+            text_seed=info.get("text_seed"), error=None, concept_secs=per_card,
+        )
+        prompts[index] = prompt
+    return [prompts[index] for index in indices]
+
+def print_status():
+    """只读运行日志，不扫描日志文件、也不逐个检查图片文件"""
+    path = os.path.join(OUTPUT_DIR, JOURNAL_FILE)
+    if not os.path.exists(path):
+        print(f"📒 {OUTPUT_DIR} 还没有运行日志")
+        return
+    journal = Journal(path, readonly=True)
+    try:
+        counts = journal.stage_counts()
+    except sqlite3.DatabaseError as e:
+        print(f"📒 无法读取运行日志 {path}: {e}")
+        journal.close()
+        return
+    done = counts.get(STAGE_IMAGE_DONE, 0)
+    print(f"📒 {OUTPUT_DIR}: 完成 {done}/{NUM_CARDS}")
+    for stage in (STAGE_PENDING, STAGE_CONCEPT_DONE, STAGE_CONCEPT_FAILED, STAGE_IMAGE_DONE, STAGE_IMAGE_FAILED):
+        print(f"   {stage:<15} {counts.get(stage, 0)}")
+    failures = journal.failures()
+    if failures:
+        print("   最近的失败:")
+        for entry in failures:
+            print(f"   - {entry['filename']} [{entry['stage']}] 尝试 {entry['attempts']} 次: {entry['error']}")
+    journal.close()
+
+# ================= 🔍 查重 =================
+
+def require_pil():
+    """按需导入 Pillow (只有查重/后处理等功能需要)"""
+    try:
+        from PIL import Image
+    except ImportError:
+        raise RuntimeError("该功能需要 Pillow: pip install pillow") from None
+    return Image
+
+def process_pool(workers):
+    """新建进程池。子进程用 forkserver (不支持时 spawn) 启动: 此时进程里已有线程 (日志、心跳、线程池)，
+    fork 会把它们持有的锁原样复制进子进程"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(method))
+
+# 32x32 DCT 只需要左上角 8x8 的低频系数
+_DCT_COS = [[math.cos((2 * x + 1) * u * math.pi / 64) for x in range(32)] for u in range(8)]
+
+def perceptual_hash(path):
+    """64 位 pHash: 灰度缩到 32x32，取 DCT 低频 8x8 系数，与 (去掉直流分量后的) 中位数比较"""
+    Image = require_pil()
+    with Image.open(path) as img:
+        img.draft("L", (64, 64))   # JPEG 解码时直接降采样，省掉大部分解码开销
+        pixels = img.convert("L").resize((32, 32), Image.LANCZOS).tobytes()
+    rows = [pixels[y * 32:(y + 1) * 32] for y in range(32)]
+    partial = [[sum(p * c for p, c in zip(row, cos_u)) for cos_u in _DCT_COS] for row in rows]
+    coeffs = [sum(partial[y][u] * _DCT_COS[v][y] for y in range(32)) for v in range(8) for u in range(8)]
+    median = sorted(coeffs[1:])[31]
+    bits = 0
+    for c in coeffs:
+        bits = (bits << 1) | (c > median)
+    return bits
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class BKTree:
+    """按汉明距离组织的 BK 树: 查询半径 r 时只需进入边长在 [d-r, d+r] 内的子树"""
+
+    def __init__(self):
+        self.root = None   # 节点: [hash, key, {距离: 子节点}]
+
+    def add(self, value, key):
+        if self.root is None:
+            self.root = [value, key, {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, key, {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """返回 [(距离, key)]，按距离从近到远"""
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= radius:
+                results.append((d, node[1]))
+            for edge, child in node[2].items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        return sorted(results)
+
+def card_index(filename):
+    """card_07.jpg -> 6"""
+    return int(filename[len("card_"):-len(".jpg")]) - 1
+
+def list_card_files(directory):
+    names = [n for n in os.listdir(directory) if n.startswith("card_") and n.endswith(".jpg")]
+    return sorted(names, key=card_index)
+
+class PerceptualIndex:
+    """输出目录的 pHash 索引 (JSON 持久化)，按 mtime/大小增量更新，线程安全"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, PHASH_INDEX_FILE)
+        self.entries = {}
+        self.tree = BKTree()
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for name, entry in json.load(f).items():
+                    entry["hash"] = int(entry["hash"], 16)
+                    self.entries[name] = entry
+
+    def refresh(self):
+        """为新增或改动过的卡片计算哈希 (多进程)，丢弃已不存在的卡片，然后重建 BK 树"""
+        names = list_card_files(self.directory)
+        stale = []
+        for name in names:
+            st = os.stat(os.path.join(self.directory, name))
+            entry = self.entries.get(name)
+            if not entry or entry["mtime"] != st.st_mtime or entry["size"] != st.st_size:
+                stale.append((name, st))
+        paths = [os.path.join(self.directory, name) for name, _ in stale]
+        if len(paths) > 32 and DEDUP_WORKERS > 1:
+            with process_pool(DEDUP_WORKERS) as pool:
+                hashes = list(pool.map(perceptual_hash, paths, chunksize=16))
         else:
-            # 打印详细错误信息以便排查
-            print(f"   ❌ 失败 (Code {response.status_code}): {response.text[:200]}")
+            hashes = [perceptual_hash(path) for path in paths]
+        with self.lock:
+            for (name, st), value in zip(stale, hashes):
+                self.entries[name] = {"hash": value, "mtime": st.st_mtime, "size": st.st_size}
+            present = set(names)
+            for name in list(self.entries):
+                if name not in present:
+                    del self.entries[name]
+            self.tree = BKTree()
+            for name in names:
+                self.tree.add(self.entries[name]["hash"], name)
+        if stale:
+            logger.info(f"🔍 计算了 {len(stale)} 张卡片的感知哈希 (共 {len(names)} 张)")
+
+    def add_if_unique(self, name):
+        """行内查重: 与已有卡片都不近似时才加入索引并返回 None，否则返回 (文件名, 距离)。
+        查询与加入在同一把锁内完成，并发出图的两张相似卡片只会有一张被留下"""
+        path = os.path.join(self.directory, name)
+        st = os.stat(path)
+        value = perceptual_hash(path)
+        with self.lock:
+            for distance, other in self.tree.search(value, DUPLICATE_MAX_DISTANCE):
+                if other != name and other in self.entries:
+                    return other, distance
+            self.entries[name] = {"hash": value, "mtime": st.st_mtime, "size": st.st_size}
+            self.tree.add(value, name)
+        return None
+
+    def discard(self, name):
+        """从索引中移除 (BK 树里的节点保留，nearest 会按 entries 过滤)"""
+        with self.lock:
+            self.entries.pop(name, None)
 
+    def find_duplicates(self):
+        """按卡片编号依次比对，后出现的近似卡片记为重复: [(重复卡, 原卡, 距离)]"""
+        tree = BKTree()
+        duplicates = []
+        with self.lock:
+            items = sorted(self.entries.items(), key=lambda item: card_index(item[0]))
+        for name, entry in items:
+            matches = tree.search(entry["hash"], DUPLICATE_MAX_DISTANCE)
+            if matches:
+                distance, original = matches[0]
+                duplicates.append((name, original, distance))
+            else:
+                tree.add(entry["hash"], name)
+        return duplicates
+
+    def save(self):
+        with self.lock:
+            data = {name: dict(entry, hash=f"{entry['hash']:016x}") for name, entry in self.entries.items()}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"   # 分片模式下多个进程可能同时写
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+_PHASH_INDEX = None
+_PHASH_INDEX_LOCK = threading.Lock()
+
+def get_phash_index():
+    global _PHASH_INDEX
+    with _PHASH_INDEX_LOCK:
+        if _PHASH_INDEX is None:
+            index = PerceptualIndex(OUTPUT_DIR)
+            index.refresh()
+            _PHASH_INDEX = index
+        return _PHASH_INDEX
+
+def variant_seed(seed, variant):
+    """第 variant 次重画使用的图片 seed (0 即规划里的原始 seed)"""
+    return (seed + variant * 104729) % 1000000
+
+def queue_regeneration(filename, reason):
+    """把卡片移到 duplicates/ 子目录，并在运行日志里标记为绘图失败、换下一个 seed，下次运行会重画"""
+    index = card_index(filename)
+    journal = get_journal()
+    entry = journal.get(index) or {}
+    dup_dir = os.path.join(OUTPUT_DIR, "duplicates")
+    ensure_dir(dup_dir)
+    variant = entry.get("variant") or 0
+    os.replace(os.path.join(OUTPUT_DIR, filename), os.path.join(dup_dir, f"{filename[:-4]}_v{variant}.jpg"))
+    journal.record(index, stage=STAGE_IMAGE_FAILED, error=reason, variant=variant + 1)
+
+def run_dedup(dry_run=False):
+    """扫描输出目录找出近似重复的卡片，并 (非 dry_run 时) 排队重画"""
+    index = PerceptualIndex(OUTPUT_DIR)
+    index.refresh()
+    duplicates = index.find_duplicates()
+    checked = len(index.entries)
+    for name, original, distance in duplicates:
+        print(f"👯 {name} ≈ {original} (汉明距离 {distance})")
+        if not dry_run:
+            queue_regeneration(name, f"与 {original} 近似重复 (距离 {distance})")
+            index.discard(name)
+    index.save()
+    action = "已移入 duplicates/ 并排队重画" if duplicates and not dry_run else "未做改动"
+    print(f"🔍 共检查 {checked} 张，发现 {len(duplicates)} 张近似重复，{action}")
+    return duplicates
+
+# ================= 🧪 出图校验 =================
+
+def validate_image(path, settings):
+    """校验一张图片 (在校验进程里运行)。通过返回 None，否则返回 (类别, 原因)。
+
+    类别 "retry": 截断、无法解码或是占位图，可能是传输/服务端的临时问题；
+    类别 "reject": 空白、信息量过低或分辨率不足，是这个 seed 的画面本身不可用。
+    """
+    Image = require_pil()
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+            img.draft("L", (128, 128))   # JPEG 按 1/8 等比例解码，截断的文件照样会报错
+            gray = img.convert("L")
     except Exception as e:
-        print(f"   ❌ 请求发生错误: {e}")
+        return "retry", f"无法完整解码: {e}"
+
+    min_size = settings["min_size"]
+    if min_size and (width < min_size[0] or height < min_size[1]):
+        return "reject", f"分辨率 {width}x{height} 低于 {min_size[0]}x{min_size[1]}"
+
+    histogram = gray.resize((64, 64)).histogram()
+    total = sum(histogram)
+    entropy = 0.0 - sum(c / total * math.log2(c / total) for c in histogram if c)
+    mean = sum(k * c for k, c in enumerate(histogram)) / total
+    stddev = math.sqrt(sum(c * (k - mean) ** 2 for k, c in enumerate(histogram)) / total)
+    if entropy < settings["min_entropy"] or stddev < settings["min_stddev"]:
+        return "reject", f"空白或信息量过低 (熵 {entropy:.2f}, 标准差 {stddev:.1f})"
+
+    if settings["placeholders"]:
+        bits = perceptual_hash(path)
+        for name, placeholder in settings["placeholders"]:
+            distance = hamming(bits, placeholder)
+            if distance <= settings["placeholder_distance"]:
+                return "retry", f"与占位图 {name} 近似 (距离 {distance})"
+    return None
+
+_VALIDATION = None
+_VALIDATION_LOCK = threading.Lock()
+
+def get_validation():
+    """(校验参数, 进程池) ；未开启校验或缺少 Pillow 时参数为 None。占位图的 pHash 只在这里算一次。
+    main / run_worker 在启动线程池之前调用，结束时由 close_validation 关闭进程池"""
+    global _VALIDATION
+    with _VALIDATION_LOCK:
+        if _VALIDATION is None:
+            settings = None
+            if VALIDATE_IMAGES:
+                try:
+                    require_pil()
+                except RuntimeError as e:
+                    logger.warning(f"⚠️ 出图校验已跳过: {e}")
+                else:
+                    placeholders = []
+                    if os.path.isdir(PLACEHOLDER_DIR):
+                        for name in sorted(os.listdir(PLACEHOLDER_DIR)):
+                            if name.startswith("."):
+                                continue
+                            try:
+                                placeholders.append((name, perceptual_hash(os.path.join(PLACEHOLDER_DIR, name))))
+                            except Exception as e:
+                                logger.warning(f"⚠️ 无法读取占位图 {name}: {e}")
+                    settings = {
+                        "min_size": VALIDATE_MIN_SIZE, "min_entropy": VALIDATE_MIN_ENTROPY,
+                        "min_stddev": VALIDATE_MIN_STDDEV, "placeholders": placeholders,
+                        "placeholder_distance": PLACEHOLDER_MAX_DISTANCE,
+                    }
+            pool = None
+            if settings is not None and VALIDATE_WORKERS > 0:
+                pool = process_pool(VALIDATE_WORKERS)
+            _VALIDATION = (settings, pool)
+        return _VALIDATION
+
+def close_validation():
+    """关闭校验进程池；下次 get_validation 重新创建"""
+    global _VALIDATION
+    with _VALIDATION_LOCK:
+        validation, _VALIDATION = _VALIDATION, None
+    if validation is not None and validation[1] is not None:
+        validation[1].shutdown()
+
+def gate_image(path, info=None):
+    """下载落盘前的校验门: 不通过时抛出 RetryableResponse 或 RejectedResponse (stream_to_file 随之删除临时文件)，
+    原因记入 info["invalid"]，render_card 据此换 seed 重画"""
+    settings, pool = get_validation()
+    if settings is None:
+        return
+    start = time.monotonic()
+    if pool is not None:
+        verdict = pool.submit(validate_image, path, settings).result()
+    else:
+        verdict = validate_image(path, settings)
+    METRICS.observe("validate_seconds", time.monotonic() - start)
+    if verdict is None:
+        return
+    kind, reason = verdict
+    METRICS.inc("images_invalid", kind=kind)
+    if info is not None:
+        info["invalid"] = reason
+    if kind == "reject":
+        raise RejectedResponse(f"图片不可用: {reason}")
+    raise RetryableResponse(f"图片未通过校验: {reason}")
+
+# ================= 🖨️ 后处理 =================
+
+EXPORT_VARIANTS = ("dixit", "thumbs", "print")
+
+def export_settings():
+    """传给工作进程的设置 (子进程不依赖主进程里改过的全局变量)"""
+    width_mm, height_mm = PRINT_SIZE_MM
+    px = lambda mm: round((mm + 2 * PRINT_BLEED_MM) / 25.4 * PRINT_DPI)
+    return {
+        "aspect": list(CARD_ASPECT),
+        "fit": CARD_FIT,
+        "thumb": THUMBNAIL_SIZE,
+        "print_px": [px(width_mm), px(height_mm)],
+        "dpi": PRINT_DPI,
+    }
+
+def save_jpeg_atomic(img, path, **params):
+    tmp_path = path + ".part"
+    img.save(tmp_path, "JPEG", **params)
+    os.replace(tmp_path, path)
+
+def postprocess_card(src_path, export_dir, settings):
+    """单张卡片的全部导出 (在工作进程中执行)，返回文件名"""
+    Image = require_pil()
+    from PIL import ImageOps
+    name = os.path.basename(src_path)
+    with Image.open(src_path) as img:
+        img = img.convert("RGB")
+    aspect_w, aspect_h = settings["aspect"]
+    if settings["fit"] == "pad":
+        size = (img.width, round(img.width * aspect_h / aspect_w))
+        if size[1] < img.height:
+            size = (round(img.height * aspect_w / aspect_h), img.height)
+        # 补边贴着哪两条边，就取那两条边缘条带 (约 2% 宽) 的平均色
+        if size[1] > img.height:
+            band = max(1, img.height // 50)
+            strips = [img.crop((0, 0, img.width, band)), img.crop((0, img.height - band, img.width, img.height))]
+        else:
+            band = max(1, img.width // 50)
+            strips = [img.crop((0, 0, band, img.height)), img.crop((img.width - band, 0, img.width, img.height))]
+        colors = [strip.resize((1, 1), Image.BOX).getpixel((0, 0)) for strip in strips]
+        edge = tuple(round(sum(channel) / len(colors)) for channel in zip(*colors))
+        card = ImageOps.pad(img, size, Image.LANCZOS, color=edge)
+    else:
+        size = (round(img.height * aspect_w / aspect_h), img.height)
+        if size[0] > img.width:
+            size = (img.width, round(img.width * aspect_h / aspect_w))
+        card = ImageOps.fit(img, size, Image.LANCZOS)
+    save_jpeg_atomic(card, os.path.join(export_dir, "dixit", name), quality=95)
+
+    thumb = card.copy()
+    thumb.thumbnail((settings["thumb"], settings["thumb"]), Image.LANCZOS)
+    save_jpeg_atomic(thumb, os.path.join(export_dir, "thumbs", name), quality=85, optimize=True)
+
+    # 印刷版: 卡面铺满 (裁切尺寸 + 出血)，超出裁切线的部分即出血区
+    printed = ImageOps.fit(card, tuple(settings["print_px"]), Image.LANCZOS)
+    save_jpeg_atomic(printed, os.path.join(export_dir, "print", name), quality=95, dpi=(settings["dpi"], settings["dpi"]))
+    return name
+
+class PostProcessor:
+    """增量后处理: manifest 记录每张源图的 mtime/大小和导出设置，只重做变化过的卡片"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.export_dir = os.path.join(directory, EXPORT_DIR)
+        self.manifest_path = os.path.join(self.export_dir, "manifest.json")
+        self.settings = export_settings()
+        self.settings_key = hashlib.sha256(json.dumps(self.settings, sort_keys=True).encode()).hexdigest()[:16]
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        for variant in EXPORT_VARIANTS:
+            ensure_dir(os.path.join(self.export_dir, variant))
+        self.pool = None
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        """创建进程池。行内后处理在启动线程池之前调用；否则 submit 时按需创建 (都不经 fork，见 process_pool)"""
+        with self.lock:
+            if self.pool is None:
+                self.pool = process_pool(POSTPROCESS_WORKERS)
+        return self
+
+    def source_key(self, name):
+        st = os.stat(os.path.join(self.directory, name))
+        return {"mtime": st.st_mtime, "size": st.st_size, "settings": self.settings_key}
+
+    def is_stale(self, name):
+        if self.manifest.get(name) != self.source_key(name):
+            return True
+        return not all(os.path.exists(os.path.join(self.export_dir, v, name)) for v in EXPORT_VARIANTS)
+
+    def submit(self, name):
+        """提交一张卡片 (线程安全)"""
+        key = self.source_key(name)
+        self.start()
+        with self.lock:
+            future = self.pool.submit(postprocess_card, os.path.join(self.directory, name), self.export_dir, self.settings)
+            self.futures.append((name, key, future))
+
+    def close(self):
+        """等待所有任务完成并保存 manifest，返回 (成功数, 失败数)"""
+        done = failed = 0
+        with self.lock:
+            futures, self.futures = self.futures, []
+        for name, key, future in futures:
+            try:
+                future.result()
+                self.manifest[name] = key
+                done += 1
+            except Exception as e:
+                logger.error(f"   ❌ 后处理 {name} 失败: {e}")
+                failed += 1
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+        return done, failed
+
+def run_postprocess(directory=None):
+    """对输出目录做一次增量后处理"""
+    directory = directory or OUTPUT_DIR
+    start = time.time()
+    processor = PostProcessor(directory)
+    names = list_card_files(directory)
+    stale = [name for name in names if processor.is_stale(name)]
+    for name in stale:
+        processor.submit(name)
+    done, failed = processor.close()
+    logger.info(
+        f"🖨️ 后处理完成: {done} 张已更新, {failed} 张失败, {len(names) - len(stale)} 张无变化 "
+        f"(耗时 {time.time() - start:.1f}s, 输出: {processor.export_dir})"
+    )
+    return done, failed
+
+# ================= 🧩 图集 =================
+
+def build_atlas(source_dir=None, out_dir=None):
+    """把目录里的卡片拼成若干页图集，并写出 atlas.json 坐标索引。
+
+    每页画布是一个内存映射的临时文件，卡片逐张解码、缩放后按行写入映射区，
+    再由 Pillow 直接在映射内存上编码输出，因此内存占用与牌组大小无关。
+    """
+    Image = require_pil()
+    from PIL import ImageOps
+    source_dir = source_dir or OUTPUT_DIR
+    out_dir = out_dir or os.path.join(OUTPUT_DIR, ATLAS_DIR)
+    ensure_dir(out_dir)
+    names = list_card_files(source_dir)
+    tile_w, tile_h = ATLAS_TILE
+    cols = max(1, ATLAS_MAX_SIZE // tile_w)
+    rows = max(1, ATLAS_MAX_SIZE // tile_h)
+    per_page = cols * rows
+    # PNG 用 RGBA (空格子透明)，JPEG 用 RGBX；两者都是 4 字节/像素，Pillow 可以直接映射而不复制
+    mode = "RGBA" if ATLAS_FORMAT == "png" else "RGBX"
+    ext = "png" if ATLAS_FORMAT == "png" else "jpg"
+
+    index = {"tile": [tile_w, tile_h], "format": ext, "pages": [], "cards": {}}
+    start = time.time()
+    for page, first in enumerate(range(0, len(names), per_page)):
+        batch = names[first:first + per_page]
+        width = min(cols, len(batch)) * tile_w
+        height = -(-len(batch) // cols) * tile_h
+        stride = width * 4
+        with tempfile.TemporaryFile(dir=out_dir) as canvas_file:
+            canvas_file.truncate(stride * height)
+            with mmap.mmap(canvas_file.fileno(), stride * height) as canvas:
+                for k, name in enumerate(batch):
+                    x, y = (k % cols) * tile_w, (k // cols) * tile_h
+                    with Image.open(os.path.join(source_dir, name)) as img:
+                        img.draft("RGB", (tile_w, tile_h))
+                        tile = ImageOps.fit(img.convert("RGB"), (tile_w, tile_h), Image.LANCZOS).convert(mode)
+                    data = tile.tobytes()
+                    for row in range(tile_h):
+                        offset = (y + row) * stride + x * 4
+                        canvas[offset:offset + tile_w * 4] = data[row * tile_w * 4:(row + 1) * tile_w * 4]
+                    index["cards"][name[:-len(".jpg")]] = {"page": page, "x": x, "y": y, "w": tile_w, "h": tile_h}
+                sheet = Image.frombuffer(mode, (width, height), canvas, "raw", mode, 0, 1)
+                filename = f"atlas_{page}.{ext}"
+                tmp_path = os.path.join(out_dir, filename + ".part")
+                sheet.save(tmp_path, "PNG" if ext == "png" else "JPEG", **({"quality": 90} if ext == "jpg" else {}))
+                os.replace(tmp_path, os.path.join(out_dir, filename))
+                # 释放对映射内存的引用后才能关闭 mmap
+                del sheet
+        index["pages"].append({"file": filename, "size": [width, height], "cards": len(batch)})
+
+    tmp_path = os.path.join(out_dir, "atlas.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, os.path.join(out_dir, "atlas.json"))
+    logger.info(f"🧩 图集完成: {len(names)} 张卡片, {len(index['pages'])} 页 (耗时 {time.time() - start:.1f}s, 输出: {out_dir})")
+    return index
+
+# ================= ⏳ 调度 =================
+
+def parse_deadline(text):
+    """命令行的截止时间，返回从现在起的秒数。
+
+    "90m" / "2h" / "3600" (秒) 表示从现在起多久；"23:30" 表示今天的该时刻 (已过则为明天)。
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smh]?)", text.strip())
+    if match:
+        return float(match[1]) * {"": 1, "s": 1, "m": 60, "h": 3600}[match[2]]
+    hour, minute = (int(part) for part in text.split(":"))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(text)
+    now = time.localtime()
+    target = time.mktime((now.tm_year, now.tm_mon, now.tm_mday, hour, minute, 0, 0, 0, -1))
+    if target <= time.time():
+        target += 24 * 3600
+    return target - time.time()
+
+def format_duration(seconds):
+    if seconds < 10:
+        return f"{max(0, seconds):.1f}s"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+class RunScheduler:
+    """按截止时间 / 请求预算安排一次运行: 用实时吞吐估算剩余时间，决定是否开始新卡片、失败后是否还值得重试。
+
+    deadline 为从现在起的秒数，budget 为 HTTP 请求数，都可为 None (不限，只统计进度和 ETA)。
+    按当前吞吐 (或每张卡片平均花掉的请求数) 在截止前做不完剩余卡片时进入"紧张"状态: 只放弃光等待就比
+    画一张新卡片还久的重试 (长退避)；剩余时间不够画完一张时不再开始新卡片。
+    被跳过的卡片保持原阶段，下次运行时继续。
+    """
+
+    def __init__(self, total, deadline=None, budget=None):
+        self.total = total
+        self.started = time.monotonic()
+        self.deadline = None if deadline is None else self.started + deadline
+        self.budget = budget
+        self.requests = 0
+        self.done = self.failed = 0
+        self.skipped = set()
+        self.stop_reason = None
+        self.finished = collections.deque(maxlen=SCHEDULE_WINDOW)   # 最近完成卡片的时间点
+        self.card_secs = collections.deque(maxlen=SCHEDULE_WINDOW)  # 最近每张卡片的绘图耗时
+        self.lock = threading.Lock()
+
+    @property
+    def constrained(self):
+        return self.deadline is not None or self.budget is not None
+
+    def note_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def card_finished(self, success, seconds):
+        with self.lock:
+            if success:
+                self.done += 1
+            else:
+                self.failed += 1
+            self.finished.append(time.monotonic())
+            self.card_secs.append(seconds)
+
+    def remaining_seconds(self):
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def remaining_cards(self):
+        with self.lock:
+            return max(0, self.total - self.done - self.failed - len(self.skipped))
+
+    def throughput(self):
+        """最近的处理速度 (张/秒，失败也算处理完)；还没有卡片完成时返回 None"""
+        now = time.monotonic()
+        with self.lock:
+            if not self.finished:
+                return None
+            if len(self.finished) < self.finished.maxlen:
+                count, elapsed = self.done + self.failed, now - self.started
+            else:
+                count, elapsed = len(self.finished) - 1, now - self.finished[0]
+        return count / elapsed if elapsed > 0 and count else None
+
+    def eta_seconds(self):
+        rate = self.throughput()
+        return self.remaining_cards() / rate if rate else None
+
+    def exhausted(self):
+        """截止时间已过或请求预算用完时返回原因，否则返回 None"""
+        remaining = self.remaining_seconds()
+        if remaining is not None and remaining <= 0:
+            return "截止时间已到"
+        if self.budget is not None and self.requests >= self.budget:
+            return "请求预算已用完"
+        return None
+
+    def tight(self):
+        """按目前的吞吐和每张卡片的请求数，截止前 / 预算内做不完剩余的卡片"""
+        left = self.remaining_cards()
+        if not left or not self.constrained:
+            return False
+        remaining, eta = self.remaining_seconds(), self.eta_seconds()
+        if remaining is not None and eta is not None and eta > remaining:
+            return True
+        with self.lock:
+            processed, requests = self.done + self.failed, self.requests
+        return self.budget is not None and processed > 0 and requests / processed * left > self.budget - requests
+
+    def may_start(self):
+        """还来得及开始一张新卡片吗；不行时记下原因"""
+        reason = self.exhausted()
+        remaining = self.remaining_seconds()
+        if reason is None and remaining is not None:
+            with self.lock:
+                typical = percentile(self.card_secs, 50)
+            if typical is not None and remaining < typical:
+                reason = f"距截止只剩 {format_duration(remaining)}，不够画完一张 (约 {format_duration(typical)})"
+        if reason is not None and self.stop_reason is None:
+            self.stop_reason = reason
+        return reason is None
+
+    def allow_retry(self, wait):
+        """失败后是否值得等 wait 秒再试一次。
+
+        重试的卡片已经付过构思等成本，通常比开始一张新卡片便宜，所以紧张时也只放弃等待超过一张卡片
+        中位耗时的重试；由限流器控制节奏 (wait 为 0，例如 429) 的重试从不因紧张而放弃。
+        截止时间已过、预算用完或等完就超过截止时间时一律放弃。
+        """
+        if self.exhausted():
+            return False
+        remaining = self.remaining_seconds()
+        if remaining is not None and wait >= remaining:
+            return False
+        if wait <= 0 or not self.tight():
+            return True
+        with self.lock:
+            typical = percentile(self.card_secs, 50)
+        return typical is None or wait <= typical
+
+    def skip(self, indices):
+        with self.lock:
+            self.skipped.update(indices)
+
+    def report(self):
+        """一行进度: 已处理 / 吞吐 / ETA，以及截止时间和预算的余量"""
+        with self.lock:
+            done, failed, requests = self.done, self.failed, self.requests
+        parts = [f"⏳ 进度 {done + failed}/{self.total} (成功 {done}, 失败 {failed})"]
+        rate = self.throughput()
+        if rate:
+            parts.append(f"{rate * 60:.1f} 张/分钟")
+        eta = self.eta_seconds()
+        if self.stop_reason is not None:
+            parts.append(f"已停止开始新卡片: {self.stop_reason}")
+        elif eta is not None and self.remaining_cards():
+            finish = time.strftime("%H:%M", time.localtime(time.time() + eta))
+            parts.append(f"预计剩余 {format_duration(eta)} ({finish} 完成)")
+        remaining = self.remaining_seconds()
+        if remaining is not None:
+            text = f"距截止 {format_duration(remaining)}"
+            if rate:
+                text += f"，预计还能处理 {min(self.remaining_cards(), int(rate * max(0, remaining)))} 张"
+            parts.append(text)
+        if self.budget is not None:
+            parts.append(f"请求 {requests}/{self.budget}")
+        if self.stop_reason is None and self.tight():
+            parts.append("来不及做完，跳过长退避的重试")
+        return " | ".join(parts)
+
+_SCHEDULER = None
+
+@contextlib.contextmanager
+def scheduled_run(total):
+    """with 块内按 RUN_DEADLINE / REQUEST_BUDGET 调度，并由后台线程每 ETA_INTERVAL_SECONDS 打印一次进度"""
+    global _SCHEDULER
+    scheduler = _SCHEDULER = RunScheduler(total, RUN_DEADLINE, REQUEST_BUDGET)
+    if scheduler.deadline is not None:
+        finish = time.strftime("%H:%M", time.localtime(time.time() + RUN_DEADLINE))
+        logger.info(f"⏳ 截止时间 {finish} (还有 {format_duration(RUN_DEADLINE)})")
+    if scheduler.budget is not None:
+        logger.info(f"⏳ 请求预算 {scheduler.budget} 次")
+    stop = threading.Event()
+
+    def reporter():
+        while not stop.wait(ETA_INTERVAL_SECONDS):
+            logger.info(scheduler.report())
+
+    thread = threading.Thread(target=reporter, name="eta", daemon=True)
+    thread.start()
+    try:
+        yield scheduler
+    finally:
+        stop.set()
+        _SCHEDULER = None
+        if scheduler.done + scheduler.failed:
+            logger.info(scheduler.report())
+        if scheduler.skipped:
+            logger.warning(f"⏳ {scheduler.stop_reason}: {len(scheduler.skipped)} 张卡片未开始，下次运行继续")
+
+def schedule_allows(indices, rest=()):
+    """调度器允许开始这些卡片时返回 True；否则把它们连同 rest (还没取出的卡片，只在叫停时才读取)
+    记为跳过 (保持原阶段，留给下次运行)"""
+    scheduler = _SCHEDULER
+    if scheduler is None or scheduler.may_start():
+        return True
+    skipped = [*indices, *rest]
+    scheduler.skip(skipped)
+    METRICS.inc("schedule_skips", value=len(skipped))
+    return False
+
+def retry_allowed(wait=0):
+    """没有调度器，或调度器认为等 wait 秒后重试仍来得及"""
+    scheduler = _SCHEDULER
+    if scheduler is None or scheduler.allow_retry(wait):
+        return True
+    METRICS.inc("retries_skipped")
+    return False
+
+# ================= 🔀 并发流水线 =================
+
+def card_filename(index):
+    return f"card_{index+1:02d}.jpg"
+
+def render_card(index, prompt):
+    """图片阶段: 通过引擎注册表出图，结果写入运行日志，返回是否成功"""
+    filename = card_filename(index)
+    journal = get_journal()
+    entry = journal.get(index) or {}
+    variant = entry.get("variant") or 0
+    seed = get_deck_plan()[index]["image_seed"]
+    start = time.time()
+    invalid_rerolls = duplicate_rerolls = 0
+    with METRICS.span("image", card=index + 1) as span:
+        while True:
+            info = {}
+            success = render_image(prompt, filename, info, seed=variant_seed(seed, variant))
+            if not success:
+                # 出图未通过校验 (空白/占位图等): 这个 seed 大概率画不好，换下一个
+                if info.get("invalid") and invalid_rerolls < VALIDATE_MAX_REROLLS and retry_allowed():
+                    invalid_rerolls += 1
+                    variant += 1
+                    logger.warning("   🧪 %s 未通过校验 (%s)，换 seed 重画", filename, info["invalid"])
+                    METRICS.inc("validation_rerolls")
+                    continue
+                break
+            if not DEDUP_INLINE:
+                break
+            # 行内查重: 与已有卡片近似就删掉，换下一个 seed 重画
+            match = get_phash_index().add_if_unique(filename)
+            if match is None:
+                break
+            os.remove(os.path.join(OUTPUT_DIR, filename))
+            logger.warning("   👯 %s 与 %s 近似重复 (距离 %d)，换 seed 重画", filename, match[0], match[1])
+            METRICS.inc("dedup_rerolls")
+            success = False
+            info["error"] = f"与 {match[0]} 近似重复 (距离 {match[1]})"
+            variant += 1
+            if duplicate_rerolls >= DEDUP_MAX_REROLLS or not retry_allowed():
+                break
+            duplicate_rerolls += 1
+        span.update(result="ok" if success else "failed", backend=info.get("backend"))
+    METRICS.inc("cards", stage="image", result="ok" if success else "failed")
+    journal.record(
+        index, stage=STAGE_IMAGE_DONE if success else STAGE_IMAGE_FAILED,
+        image_seed=info.get("seed"), backend=info.get("backend"), model=info.get("model"), url=info.get("url"),
+        error=None if success else info.get("error"), attempts=(entry.get("attempts") or 0) + 1,
+        variant=variant, image_secs=time.time() - start,
+    )
+    if _SCHEDULER is not None:
+        _SCHEDULER.card_finished(success, time.time() - start)
+    return success
+
+def leftover(source, indices):
+    """调度叫停时一并记为跳过的剩余卡片: 来源是列表时就是剩下的全部；惰性来源 (分片 worker) 不再往下取"""
+    return source if isinstance(indices, list) else ()
+
+def run_sequential(indices, on_done=None):
+    """原始模式: 构思 -> 绘图，一次只处理一张 (节奏由各主机的限流器控制)。
+
+    indices 可以是惰性的可迭代对象；on_done(序号, 是否成功) 在每张卡片绘图结束后调用。
+    开启 POSTPROCESS_INLINE 时出图成功的卡片立即交给后处理进程池，与后续卡片并行。
+    """
+    processor = PostProcessor(OUTPUT_DIR).start() if POSTPROCESS_INLINE else None
+    source = iter(indices)
+    try:
+        while True:
+            chunk = list(itertools.islice(source, max(1, TEXT_BATCH_SIZE)))
+            if not chunk or not schedule_allows(chunk, leftover(source, indices)):
+                return
+            # 1. 构思 (TEXT_BATCH_SIZE > 1 时整批一次请求)
+            prompts = prepare_concepts(chunk)
+            # 2. 绘图
+            for k, (i, prompt) in enumerate(zip(chunk, prompts)):
+                if not schedule_allows(chunk[k:], leftover(source, indices)):
+                    return
+                success = render_card(i, prompt)
+                if success and processor is not None:
+                    processor.submit(card_filename(i))
+                if on_done is not None:
+                    on_done(i, success)
+    finally:
+        if processor is not None:
+            done, failed = processor.close()
+            logger.info(f"🖨️ 行内后处理: {done} 张完成, {failed} 张失败")
+
+def run_pipeline(indices, on_done=None):
+    """流水线模式: 文本线程池为后续卡片预取文案，图片线程池并发渲染已有文案的卡片。
+
+    文本阶段按 TEXT_BATCH_SIZE 分批提交；在途卡片数 (文本 + 图片) 受信号量限制，避免文本阶段跑得太靠前；
+    实际请求速率由各主机的限流器统一控制。
+    indices 可以是惰性的可迭代对象: 先占到空位才取下一批，分片 worker 借此边领边做、流水线不必排空。
+    on_done(序号, 是否成功) 在每张卡片绘图结束后调用 (在图片线程里)；因调度叫停而没开始的卡片不调用。
+    """
+    size = max(1, TEXT_BATCH_SIZE)
+    in_flight = threading.BoundedSemaphore(max(IMAGE_WORKERS + PREFETCH_CONCEPTS, size))
+    processor = PostProcessor(OUTPUT_DIR).start() if POSTPROCESS_INLINE else None
+    text_pool = ThreadPoolExecutor(TEXT_WORKERS, thread_name_prefix="text")
+    image_pool = ThreadPoolExecutor(IMAGE_WORKERS, thread_name_prefix="image")
+
+    def finished(i, success):
+        if on_done is None:
+            return
+        try:
+            on_done(i, success)
+        except Exception as e:
+            logger.error("   ❌ [%d/%d] 汇报结果失败: %s", i + 1, NUM_CARDS, e, extra={"card": i + 1})
+
+    def image_stage(i, prompt):
+        success = False
+        try:
+            # 文案已记入运行日志；来不及出图时留给下次运行
+            if not schedule_allows([i]):
+                return False
+            success = render_card(i, prompt)
+            if success and processor is not None:
+                processor.submit(card_filename(i))
+        except Exception as e:
+            logger.error("   ❌ [%d/%d] 绘图阶段异常: %s", i + 1, NUM_CARDS, e, extra={"card": i + 1})
+        finally:
+            in_flight.release()
+        finished(i, success)
+        return success
+
+    def on_concepts(chunk, future):
+        try:
+            prompts = future.result()
+        except Exception as e:
+            logger.error("   ❌ [%d/%d] 构思阶段异常: %s", chunk[0] + 1, NUM_CARDS, e, extra={"card": chunk[0] + 1})
+            for i in chunk:
+                in_flight.release()
+                finished(i, False)
+            return
+        for i, prompt in zip(chunk, prompts):
+            try:
+                image_pool.submit(image_stage, i, prompt)
+            except RuntimeError:
+                # 线程池已关闭 (用户中断)
+                in_flight.release()
+
+    try:
+        source = iter(indices)
+        while True:
+            for _ in range(size):
+                in_flight.acquire()
+            chunk = list(itertools.islice(source, size))
+            for _ in range(size - len(chunk)):
+                in_flight.release()
+            if not chunk:
+                break
+            # 等到空位时可能已过截止时间 / 用完预算，之后的卡片都不再开始
+            if not schedule_allows(chunk, leftover(source, indices)):
+                for _ in chunk:
+                    in_flight.release()
+                break
+            future = text_pool.submit(prepare_concepts, chunk)
+            future.add_done_callback(functools.partial(on_concepts, chunk))
+        # 文本池先收尾，保证所有回调都已把图片任务提交出去
+        text_pool.shutdown(wait=True)
+        image_pool.shutdown(wait=True)
+    finally:
+        text_pool.shutdown(wait=False, cancel_futures=True)
+        image_pool.shutdown(wait=False, cancel_futures=True)
+        if processor is not None:
+            done, failed = processor.close()
+            logger.info(f"🖨️ 行内后处理: {done} 张完成, {failed} 张失败")
+
+# ================= 🛰️ 分片生成 =================
+
+QUEUE_PENDING = "pending"    # 可领取
+QUEUE_LEASED = "leased"      # 已被某个 worker 领取，租约到期前由它负责
+QUEUE_DONE = "done"
+QUEUE_FAILED = "failed"      # 失败次数达到 SHARD_MAX_ATTEMPTS，不再分配
+
+class WorkQueue:
+    """SQLite 任务队列: 每张卡片一行。领取时写入租约，worker 定期续租；
+    租约过期 (worker 崩溃或失联) 的卡片重新可领。多个进程可以共用同一个文件。"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks (idx INTEGER PRIMARY KEY, state TEXT NOT NULL, worker TEXT, "
+            "lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, updated REAL)"
+        )
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE 先拿写锁，避免两个进程领到同一张卡片
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def seed(self, indices, done=()):
+        """加入尚未入队的卡片；done 里的卡片 (输出目录已有图片) 直接标记完成"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO tasks (idx, state, updated) VALUES (?, ?, ?)",
+                             [(i, QUEUE_PENDING, now) for i in indices])
+            conn.executemany("UPDATE tasks SET state = ?, worker = NULL, updated = ? WHERE idx = ?",
+                             [(QUEUE_DONE, now, i) for i in done])
+
+    def claim(self, worker, n):
+        """领取最多 n 张卡片 (失败次数少的优先)，返回序号列表"""
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT idx FROM tasks WHERE state = ? OR (state = ? AND lease_until < ?) "
+                "ORDER BY attempts, idx LIMIT ?",
+                (QUEUE_PENDING, QUEUE_LEASED, now, n),
+            ).fetchall()
+            indices = [row[0] for row in rows]
+            conn.executemany(
+                "UPDATE tasks SET state = ?, worker = ?, lease_until = ?, updated = ? WHERE idx = ?",
+                [(QUEUE_LEASED, worker, now + SHARD_LEASE_SECONDS, now, i) for i in indices],
+            )
+        return indices
+
+    def heartbeat(self, worker, indices):
+        """为仍归该 worker 的卡片续租，返回续租成功的序号 (其余已被重新分配)"""
+        now = time.time()
+        with self._transaction() as conn:
+            held = [i for i in indices if conn.execute(
+                "SELECT 1 FROM tasks WHERE idx = ? AND state = ? AND worker = ?", (i, QUEUE_LEASED, worker),
+            ).fetchone()]
+            conn.executemany("UPDATE tasks SET lease_until = ?, updated = ? WHERE idx = ?",
+                             [(now + SHARD_LEASE_SECONDS, now, i) for i in held])
+        return held
+
+    def complete(self, worker, index, ok):
+        """汇报结果。成功总是记为完成 (图片已落盘)；失败则退回队列，次数用尽后标记失败"""
+        now = time.time()
+        with self._transaction() as conn:
+            if ok:
+                conn.execute("UPDATE tasks SET state = ?, worker = ?, updated = ? WHERE idx = ?",
+                             (QUEUE_DONE, worker, now, index))
+                return
+            conn.execute(
+                "UPDATE tasks SET attempts = attempts + 1, worker = NULL, updated = ?, "
+                "state = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END "
+                "WHERE idx = ? AND state = ? AND worker = ?",
+                (now, SHARD_MAX_ATTEMPTS, QUEUE_FAILED, QUEUE_PENDING, index, QUEUE_LEASED, worker),
+            )
+
+    def release(self, worker, indices):
+        """主动交还尚未完成的卡片 (不计失败次数)"""
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE tasks SET state = ?, worker = NULL, updated = ? WHERE idx = ? AND state = ? AND worker = ?",
+                [(QUEUE_PENDING, time.time(), i, QUEUE_LEASED, worker) for i in indices],
+            )
+
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
+
+    def info(self):
+        return plan_identity()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def plan_identity():
+    """决定牌组规划的配置；所有 worker 必须一致，否则同一序号会画出不同的卡片"""
+    return {"num_cards": NUM_CARDS, "master_seed": MASTER_SEED, "vocab": vocab_fingerprint()}
+
+def open_local_queue():
+    """打开输出目录里的队列，并按输出目录的现状补齐任务"""
+    ensure_dir(OUTPUT_DIR)
+    work_queue = WorkQueue(os.path.join(OUTPUT_DIR, SHARD_QUEUE_FILE))
+    existing = [i for i in range(NUM_CARDS) if os.path.exists(os.path.join(OUTPUT_DIR, card_filename(i)))]
+    work_queue.seed(range(NUM_CARDS), done=existing)
+    return work_queue
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+class RemoteWorkQueue:
+    """经 TCP 协调器访问的 WorkQueue，接口相同。每次调用发一行 JSON 请求、读一行 JSON 回复"""
+
+    def __init__(self, address):
+        self.address = parse_address(address)
+
+    def _call(self, op, **args):
+        with socket.create_connection(self.address, timeout=30) as sock, sock.makefile("rwb") as stream:
+            stream.write(json.dumps({"op": op, "token": SHARD_TOKEN, **args}).encode("utf-8") + b"\n")
+            stream.flush()
+            line = stream.readline()
+        if not line:
+            raise ConnectionError("协调器关闭了连接")
+        reply = json.loads(line)
+        if "error" in reply:
+            raise RuntimeError(f"协调器返回错误: {reply['error']}")
+        return reply["result"]
+
+    def claim(self, worker, n):
+        return self._call("claim", worker=worker, n=n)
+
+    def heartbeat(self, worker, indices):
+        return self._call("heartbeat", worker=worker, indices=indices)
+
+    def complete(self, worker, index, ok):
+        return self._call("complete", worker=worker, index=index, ok=ok)
+
+    def release(self, worker, indices):
+        return self._call("release", worker=worker, indices=indices)
+
+    def counts(self):
+        return self._call("counts")
+
+    def info(self):
+        return self._call("info")
+
+    def close(self):
+        pass
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    """协调器的连接处理: 把 JSON 请求转给本地 WorkQueue"""
+
+    OPS = ("claim", "heartbeat", "complete", "release", "counts", "info")
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if SHARD_TOKEN and request.pop("token", None) != SHARD_TOKEN:
+                    raise PermissionError("口令不正确")
+                request.pop("token", None)
+                op = request.pop("op", None)
+                if op not in self.OPS:
+                    raise ValueError(f"未知的操作: {op}")
+                reply = {"result": getattr(self.server.work_queue, op)(**request)}
+                if op == "complete":
+                    self.server.report_progress()
+            except Exception as e:
+                reply = {"error": str(e)}
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def report_progress(self):
+        counts = self.work_queue.counts()
+        done = counts.get(QUEUE_DONE, 0)
+        failed = counts.get(QUEUE_FAILED, 0)
+        logger.info("🛰️ 进度: 完成 %d/%d, 失败 %d, 进行中 %d", done, NUM_CARDS, failed, counts.get(QUEUE_LEASED, 0))
+        if done + failed >= NUM_CARDS:
+            logger.info("🎉 队列已全部处理完，可以用 merge 合并各 worker 的输出 (Ctrl+C 退出协调器)")
+
+def run_coordinator(address=None):
+    """TCP 协调器: 持有输出目录里的队列，供其他机器上的 worker 领取卡片"""
+    work_queue = open_local_queue()
+    server = CoordinatorServer(parse_address(address or SHARD_COORDINATOR), CoordinatorHandler)
+    server.work_queue = work_queue
+    host, port = server.server_address[:2]
+    logger.info(f"🛰️ 协调器已启动: {host}:{port} | {NUM_CARDS} 张 | 队列 {work_queue.counts()}")
+    if not SHARD_TOKEN and host not in ("127.0.0.1", "localhost"):
+        logger.warning("⚠️ 协调器对外监听但没有设置 SHARD_TOKEN，任何人都能领取/篡改任务")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.warning("🛑 协调器停止")
+    finally:
+        server.server_close()
+        work_queue.close()
+
+def run_worker(queue_address=None):
+    """分片 worker: 不断从队列领取卡片交给本进程的流水线，直到没有可领的卡片。
+
+    queue_address 为空时使用输出目录里的 SQLite 队列 (本机多个进程共用一个输出目录)，
+    否则连接该地址的协调器 (输出写在本机的 OUTPUT_DIR，完成后用 merge 合并)。
+    领取的卡片由后台线程定期续租；进程崩溃时租约过期，卡片自动交给其他 worker。
+    """
+    ensure_dir(OUTPUT_DIR)
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    if queue_address:
+        work_queue = RemoteWorkQueue(queue_address)
+        remote = work_queue.info()
+        if remote != plan_identity():
+            raise ValueError(f"本机的规划配置与协调器不一致: {plan_identity()} != {remote}")
+    else:
+        # 共用输出目录时不清理 .part 文件: 它们可能属于其他 worker 正在进行的下载
+        work_queue = open_local_queue()
+    get_journal()
+    get_deck_plan()
+    get_validation()   # 校验进程池在启动任何线程之前创建
+
+    held = set()
+    held_lock = threading.Lock()
+    stop = threading.Event()
+
+    def keep_alive():
+        while not stop.wait(SHARD_HEARTBEAT_SECONDS):
+            with held_lock:
+                indices = sorted(held)
+            if not indices:
+                continue
+            try:
+                lost = set(indices) - set(work_queue.heartbeat(worker, indices))
+            except Exception as e:
+                logger.warning("   💓 续租失败: %s", e)
+                continue
+            if lost:
+                logger.warning("   💓 %d 张卡片的租约已失效 (已交给其他 worker): %s", len(lost), sorted(lost))
+
+    heartbeat = threading.Thread(target=keep_alive, name="heartbeat", daemon=True)
+    heartbeat.start()
+    logger.info(f"🛰️ worker {worker} 已启动 | 队列: {queue_address or SHARD_QUEUE_FILE} | 输出: {OUTPUT_DIR}")
+    total_start = time.time()
+    done = failed = 0
+    progressed = threading.Event()
+
+    def finish(i, ok):
+        nonlocal done, failed
+        work_queue.complete(worker, i, ok)
+        with held_lock:
+            held.discard(i)
+            done += ok
+            failed += not ok
+        progressed.set()
+
+    def claimed():
+        """按需领取: 流水线有空位时才向队列要下一批，整个 worker 只用一条长期运行的流水线。
+        截止时间 / 预算用完后不再领取；已领取但没开始的卡片在 finally 里交还队列"""
+        while schedule_allows([]):
+            progressed.clear()
+            batch = work_queue.claim(worker, SHARD_CLAIM_BATCH)
+            if not batch:
+                if not work_queue.counts().get(QUEUE_LEASED):
+                    return
+                # 自己或其他 worker 手上还有卡片 (失败的会退回队列)；等它们完成或租约过期
+                progressed.wait(SHARD_POLL_SECONDS)
+                continue
+            with held_lock:
+                held.update(batch)
+            for i in batch:
+                if os.path.exists(os.path.join(OUTPUT_DIR, card_filename(i))):
+                    finish(i, True)
+                else:
+                    yield i
+
+    try:
+        counts = work_queue.counts()
+        with scheduled_run(counts.get(QUEUE_PENDING, 0) + counts.get(QUEUE_LEASED, 0)):
+            if PIPELINE_MODE:
+                run_pipeline(claimed(), on_done=finish)
+            else:
+                run_sequential(claimed(), on_done=finish)
+    except KeyboardInterrupt:
+        logger.warning("\n🛑 用户手动停止 worker")
+    finally:
+        stop.set()
+        with held_lock:
+            unfinished = sorted(held)
+        if unfinished:
+            try:
+                work_queue.release(worker, unfinished)
+            except Exception as e:
+                logger.warning(f"   ⚠️ 交还 {len(unfinished)} 张卡片失败 (租约到期后会自动交还): {e}")
+        work_queue.close()
+        close_validation()
+        if DEDUP_INLINE and _PHASH_INDEX is not None:
+            _PHASH_INDEX.save()
+        METRICS.export(os.path.join(OUTPUT_DIR, METRICS_DIR))
+        logger.info(f"🛰️ worker {worker} 结束: 完成 {done} 张, 失败 {failed} 张, 耗时 {(time.time() - total_start) / 60:.1f} 分钟")
+
+def merge_decks(sources):
+    """把各 worker 输出目录里已完成的卡片 (图片 + 运行日志记录) 合并进 OUTPUT_DIR。
+
+    来源的规划必须与当前配置一致；目标目录已有的卡片保持不变。
+    """
+    ensure_dir(OUTPUT_DIR)
+    fingerprint = vocab_fingerprint()
+    journal = get_journal()
+    merged = skipped = 0
+    for source in sources:
+        plan_path = os.path.join(source, DECK_PLAN_FILE)
+        journal_path = os.path.join(source, JOURNAL_FILE)
+        if not (os.path.exists(plan_path) and os.path.exists(journal_path)):
+            logger.error(f"❌ {source} 不是输出目录 (缺少 {DECK_PLAN_FILE} 或 {JOURNAL_FILE})，跳过")
+            continue
+        with open(plan_path, "r", encoding="utf-8") as f:
+            plan = json.load(f)
+        if plan["master_seed"] != MASTER_SEED or plan["vocab"] != fingerprint:
+            logger.error(f"❌ {source} 的规划 (主种子/素材库) 与当前配置不一致，跳过")
+            continue
+        source_journal = Journal(journal_path)
+        try:
+            entries = source_journal.completed()
+        finally:
+            source_journal.close()
+        for entry in entries:
+            index = entry.pop("idx")
+            entry.pop("updated", None)
+            src = os.path.join(source, entry["filename"])
+            dst = os.path.join(OUTPUT_DIR, entry["filename"])
+            if index >= NUM_CARDS or not os.path.exists(src) or os.path.exists(dst):
+                skipped += 1
+                continue
+            tmp_path = dst + ".merge.part"
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, dst)
+            journal.record(index, **entry)
+            merged += 1
+    logger.info(f"🧲 合并完成: 新增 {merged} 张，跳过 {skipped} 张 (已存在或缺少图片)，输出: {OUTPUT_DIR}")
+    return merged
+
+# ================= 🗃️ 牌组归档 =================
+
+ARCHIVE_FORMAT = 1
+ARCHIVE_INDEX = "index.json"
+# 从运行日志带进归档的字段
+ARCHIVE_CARD_FIELDS = ("prompt", "prompt_source", "text_seed", "image_seed", "backend", "model", "variant")
+CARD_FILE_PATTERN = re.compile(r"card_(\d+)\.(?:jpg|jpeg|png|webp)")
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def collect_deck(source):
+    """读取一个输出目录: 已有的卡片图片 + 运行日志里的文案/seed/引擎 + 规划里的骨架。
+
+    运行日志和规划都可以缺失 (早期版本只有图片)，对应字段为空。卡片的 path 是本地图片路径。
+    """
+    deck = {"source": os.path.abspath(source), "packed": time.time()}
+    skeletons = {}
+    plan_path = os.path.join(source, DECK_PLAN_FILE)
+    if os.path.exists(plan_path):
+        with open(plan_path, "r", encoding="utf-8") as f:
+            plan = json.load(f)
+        deck.update(master_seed=plan["master_seed"], vocab=plan["vocab"], packs=plan.get("packs"))
+        skeletons = {card["index"]: card for card in plan["cards"]}
+    entries = {}
+    journal_path = os.path.join(source, JOURNAL_FILE)
+    if os.path.exists(journal_path):
+        journal = Journal(journal_path)
+        try:
+            entries = {entry["idx"]: entry for entry in journal.completed()}
+        finally:
+            journal.close()
+
+    cards = []
+    for filename in os.listdir(source):
+        match = CARD_FILE_PATTERN.fullmatch(filename)
+        if not match:
+            continue
+        index = int(match[1]) - 1
+        entry = entries.get(index, {})
+        card = {"index": index, "filename": filename, "path": os.path.join(source, filename)}
+        card.update((key, entry.get(key)) for key in ARCHIVE_CARD_FIELDS)
+        if index in skeletons:
+            card["plan"] = {key: value for key, value in skeletons[index].items() if key != "index"}
+        cards.append(card)
+    deck["cards"] = sorted(cards, key=lambda card: card["index"])
+    return deck
+
+class DeckArchive:
+    """只读打开牌组归档 (见 pack_decks)。整个归档只占一个文件句柄；
+    读取单张卡片时按 zip 中央目录定位到对应图片，不解压其他内容。"""
+
+    def __init__(self, path):
+        import zipfile
+        self.path = path
+        self.zip = zipfile.ZipFile(path)
+        try:
+            self.index = json.loads(self.zip.read(ARCHIVE_INDEX))
+        except KeyError:
+            self.zip.close()
+            raise ValueError(f"{path} 不是牌组归档 (缺少 {ARCHIVE_INDEX})") from None
+        if self.index.get("format") != ARCHIVE_FORMAT:
+            self.zip.close()
+            raise ValueError(f"{path} 的归档格式 {self.index.get('format')} 不受支持")
+        self._cards = {name: {card["index"]: card for card in deck["cards"]} for name, deck in self.index["decks"].items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def decks(self):
+        return list(self.index["decks"])
+
+    def deck_name(self, deck=None):
+        """deck 为空且归档里只有一个牌组时返回它"""
+        if deck is None:
+            if len(self.index["decks"]) != 1:
+                raise KeyError(f"归档里有 {len(self.index['decks'])} 个牌组，请指定: {', '.join(self.decks())}")
+            return self.decks()[0]
+        if deck not in self.index["decks"]:
+            raise KeyError(f"归档里没有牌组 {deck} (可选: {', '.join(self.decks())})")
+        return deck
+
+    def deck(self, deck=None):
+        return self.index["decks"][self.deck_name(deck)]
+
+    def cards(self, deck=None):
+        return self.deck(deck)["cards"]
+
+    def card(self, index, deck=None):
+        """卡片元数据 (index 从 0 开始)，不存在时抛出 KeyError"""
+        cards = self._cards[self.deck_name(deck)]
+        if index not in cards:
+            raise KeyError(f"牌组 {self.deck_name(deck)} 里没有第 {index + 1} 张卡片")
+        return cards[index]
+
+    def open(self, index, deck=None):
+        """以文件对象读取卡片图片 (流式，不整体载入内存)"""
+        return self.zip.open(self.card(index, deck)["blob"])
+
+    def read(self, index, deck=None):
+        return self.zip.read(self.card(index, deck)["blob"])
+
+    def blobs(self):
+        return {info.filename: info.file_size for info in self.zip.infolist() if info.filename.startswith("blobs/")}
+
+def pack_decks(sources, archive_path=None):
+    """把输出目录打包进牌组归档，每个目录是一个牌组 (以目录名命名，同名的旧牌组被替换)。
+
+    归档已存在时保留其中的其他牌组；图片按 SHA-256 存为 blobs/<哈希>.<扩展名>，多个牌组共用。
+    先写临时文件再原子替换，打包中断不会损坏已有归档。返回归档里的牌组数。
+    """
+    import zipfile
+    archive_path = archive_path or ARCHIVE_FILE
+    previous = DeckArchive(archive_path) if os.path.exists(archive_path) else None
+    tmp_path = f"{archive_path}.{os.getpid()}.tmp"
+    fresh = {}
+    written = set()
+    try:
+        with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED) as zf:
+            for source in sources:
+                name = os.path.basename(os.path.normpath(source))
+                deck = collect_deck(source)
+                for card in deck["cards"]:
+                    path = card.pop("path")
+                    card["sha256"] = file_sha256(path)
+                    card["bytes"] = os.path.getsize(path)
+                    card["blob"] = f"blobs/{card['sha256']}{os.path.splitext(path)[1].lower()}"
+                    if card["blob"] not in written:
+                        zf.write(path, card["blob"])
+                        written.add(card["blob"])
+                fresh[name] = deck
+                logger.info(f"🗃️ {source} -> 牌组 {name}: {len(deck['cards'])} 张")
+            # 沿用旧归档里没有被替换的牌组 (保持原有顺序，新牌组排在后面)
+            decks = {}
+            for name, deck in (previous.index["decks"].items() if previous else ()):
+                if name in fresh:
+                    decks[name] = fresh.pop(name)
+                    continue
+                for card in deck["cards"]:
+                    if card["blob"] not in written:
+                        with previous.zip.open(card["blob"]) as src, zf.open(card["blob"], "w") as dst:
+                            shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+                        written.add(card["blob"])
+                decks[name] = deck
+            decks.update(fresh)
+            index = {"format": ARCHIVE_FORMAT, "updated": time.time(), "decks": decks}
+            zf.writestr(ARCHIVE_INDEX, json.dumps(index, ensure_ascii=False, indent=1), compress_type=zipfile.ZIP_DEFLATED)
+        if previous is not None:
+            previous.close()
+            previous = None
+        os.replace(tmp_path, archive_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if previous is not None:
+            previous.close()
+
+    card_bytes = sum(card["bytes"] for deck in decks.values() for card in deck["cards"])
+    with DeckArchive(archive_path) as archive:
+        blob_bytes = sum(archive.blobs().values())
+    logger.info(
+        f"🗃️ 已写入 {archive_path}: {len(decks)} 个牌组, {sum(len(d['cards']) for d in decks.values())} 张卡片, "
+        f"{len(written)} 份图片 ({blob_bytes / 1e6:.1f} MB，去重节省 {(card_bytes - blob_bytes) / 1e6:.1f} MB)"
+    )
+    return len(decks)
+
+def unpack_deck(deck=None, archive_path=None):
+    """把归档里的一个牌组导入 OUTPUT_DIR: 写出卡片图片并记入运行日志 (阶段为已出图)。
+
+    目标目录已有的卡片保持不变；牌组的规划与当前配置不一致时给出警告。返回导入的张数。
+    """
+    ensure_dir(OUTPUT_DIR)
+    journal = get_journal()
+    imported = skipped = 0
+    with DeckArchive(archive_path or ARCHIVE_FILE) as archive:
+        name = archive.deck_name(deck)
+        meta = archive.deck(name)
+        if meta.get("master_seed") is not None and (meta["master_seed"] != MASTER_SEED or meta["vocab"] != vocab_fingerprint()):
+            logger.warning(f"⚠️ 牌组 {name} 的规划 (主种子/素材库) 与当前配置不一致，继续生成时其余卡片按当前配置规划")
+        for card in archive.cards(name):
+            dst = os.path.join(OUTPUT_DIR, card["filename"])
+            if os.path.exists(dst):
+                skipped += 1
+                continue
+            tmp_path = dst + ".unpack.part"
+            with archive.open(card["index"], name) as src, open(tmp_path, "wb") as f:
+                shutil.copyfileobj(src, f, DOWNLOAD_CHUNK_SIZE)
+            os.replace(tmp_path, dst)
+            fields = {key: card.get(key) for key in ARCHIVE_CARD_FIELDS if card.get(key) is not None}
+            journal.record(card["index"], filename=card["filename"], stage=STAGE_IMAGE_DONE, error=None, **fields)
+            imported += 1
+    logger.info(f"📦 牌组 {name} 导入完成: 新增 {imported} 张，跳过 {skipped} 张 (已存在)，输出: {OUTPUT_DIR}")
+    return imported
+
+def print_archive(number=None, deck=None, save=None, archive_path=None):
+    """列出归档里的牌组；给出卡片编号 (从 1 开始) 时打印该卡片的元数据，save 为路径时另存图片"""
+    archive_path = archive_path or ARCHIVE_FILE
+    with DeckArchive(archive_path) as archive:
+        if number is None:
+            blobs = archive.blobs()
+            print(f"🗃️ {archive_path}: {len(archive.decks())} 个牌组, {len(blobs)} 份图片 ({sum(blobs.values()) / 1e6:.1f} MB)")
+            for name in archive.decks():
+                meta = archive.deck(name)
+                with_prompt = sum(1 for card in meta["cards"] if card.get("prompt"))
+                packed = time.strftime("%Y-%m-%d %H:%M", time.localtime(meta["packed"]))
+                print(f"   {name:<12} {len(meta['cards']):>4} 张 (有文案 {with_prompt}) | 打包于 {packed} | 来源 {meta['source']}")
+            return
+        card = archive.card(number - 1, deck)
+        print(json.dumps(card, ensure_ascii=False, indent=1))
+        if save:
+            with archive.open(number - 1, deck) as src, open(save, "wb") as f:
+                shutil.copyfileobj(src, f, DOWNLOAD_CHUNK_SIZE)
+            print(f"💾 已保存到 {save}")
+
+# ================= 🏁 基准测试 =================
+
+class StubHandler:
+    """模拟文本 API、Pollinations 图片 API 与 HF 推理 API，按 BENCH_PROFILE 注入延迟和故障。
+    与 http.server 的 BaseHTTPRequestHandler 组合使用 (见 start_stub_server)，http.server 只在基准测试时导入"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = urllib.parse.unquote(self.path)
+        if path.startswith("/prompt/"):
+            self.respond("image", path)
+        else:
+            self.respond("text", path)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.respond("hf", body.decode("utf-8", "replace"))
+
+    def respond(self, endpoint, request_key):
+        server = self.server
+        profile = BENCH_PROFILE[endpoint]
+        with server.lock:
+            median, sigma = profile["latency"]
+            delay = median * math.exp(server.rng.gauss(0, sigma))
+            roll = server.rng.random()
+        time.sleep(delay)
+
+        fault = None
+        for name in ("429", "5xx", "cold_start", "empty", "not_image", "blank"):
+            roll -= profile.get(name, 0)
+            if roll < 0:
+                fault = name
+                break
+        with server.lock:
+            server.served[f"{endpoint}/{fault or 'ok'}"] += 1
+
+        if fault == "429":
+            self.send_body(429, "text/plain", b"Too Many Requests", {"Retry-After": "1"})
+        elif fault == "5xx":
+            self.send_body(503, "text/plain", b"Service Unavailable")
+        elif fault == "cold_start":
+            self.send_body(503, "application/json", json.dumps({"estimated_time": 0.5}).encode())
+        elif fault == "empty":
+            self.send_body(200, "text/plain" if endpoint == "text" else "image/jpeg", b"")
+        elif fault == "not_image":
+            self.send_body(200, "text/html", b"<html>rate limited</html>")
+        elif fault == "blank":
+            self.send_body(200, "image/jpeg", stub_image_bytes(request_key, blank=True))
+        elif endpoint == "text":
+            match = re.search(r"JSON array of exactly (\d+)", request_key)
+            if match:
+                descriptions = [f"stub description {k} for {request_key[-24:]}" for k in range(int(match.group(1)))]
+                self.send_body(200, "text/plain", json.dumps(descriptions).encode())
+            else:
+                self.send_body(200, "text/plain", f"stub description for {request_key[-48:]}".encode())
+        else:
+            self.send_body(200, "image/jpeg", stub_image_bytes(request_key))
+
+    def send_body(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def stub_image_bytes(request_key, blank=False):
+    """每个请求一张不同的噪声图 (有 Pillow 时为真实 JPEG，查重/校验都能正常工作)；blank 时为纯色图"""
+    rng = random.Random(request_key)
+    try:
+        Image = require_pil()
+    except RuntimeError:
+        return b"\xff\xd8\xff\xe0" + bytes(rng.getrandbits(8) for _ in range(4 * MIN_IMAGE_BYTES))
+    if blank:
+        image = Image.new("RGB", (64, 64), (12, 12, 12))
+    else:
+        image = Image.frombytes("RGB", (64, 64), bytes(rng.getrandbits(8) for _ in range(64 * 64 * 3)))
+    buffer = io.BytesIO()
+    image.resize((256, 256)).save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+def start_stub_server():
+    """在随机端口启动桩服务器 (后台线程)，返回 server，地址为 http://127.0.0.1:<port>"""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    handler = type("StubHTTPHandler", (StubHandler, BaseHTTPRequestHandler), {})
+
+    class StubServer(ThreadingHTTPServer):
+        def handle_error(self, request, client_address):
+            # 对冲落败 / 被取消的下载会直接断开连接，这是预期行为，不打印回溯
+            if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError, ConnectionAbortedError)):
+                return
+            super().handle_error(request, client_address)
+
+    server = StubServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.rng = random.Random(BENCH_SEED)
+    server.served = collections.Counter()
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server
+
+def reset_runtime_state():
+    """关闭并丢弃按当前配置懒加载的单例 (连接、日志库、缓存、限流器、统计)，切换配置后重新创建"""
+    global _JOURNAL, _PROMPT_CACHE, _DECK_PLAN, _PHASH_INDEX, _SESSION, _VOCABULARY, LATENCY, METRICS
+    if _JOURNAL is not None:
+        _JOURNAL.close()
+    if _PROMPT_CACHE is not None:
+        _PROMPT_CACHE.conn.close()
+    if _SESSION is not None:
+        _SESSION.close()
+    close_validation()
+    _JOURNAL = _PROMPT_CACHE = _DECK_PLAN = _PHASH_INDEX = _SESSION = _VOCABULARY = None
+    _RATE_LIMITERS.clear()
+    LATENCY = LatencyTracker()
+    METRICS = Metrics()
+
+@contextlib.contextmanager
+def config_overrides(**values):
+    """临时覆盖配置区域的全局变量，退出时恢复"""
+    module = globals()
+    unknown = [name for name in values if name not in module]
+    if unknown:
+        raise KeyError(f"未知的配置项: {', '.join(unknown)}")
+    saved = {name: module[name] for name in values}
+    module.update(values)
+    try:
+        yield
+    finally:
+        module.update(saved)
+
+def bench_scenario(name, overrides, base_url, cards):
+    """在临时目录里用桩服务器跑一遍 main()，返回该场景的吞吐与延迟统计"""
+    with tempfile.TemporaryDirectory(prefix=f"dixit-bench-{name}-") as tmp, config_overrides(
+        NUM_CARDS=cards, OUTPUT_DIR=tmp, PROMPT_CACHE_FILE=os.path.join(tmp, PROMPT_CACHE_FILE),
+        TEXT_API_BASE=base_url, IMAGE_API_BASE=base_url, HF_API_BASE=base_url,
+        USE_PROXY=False, VERIFY_SSL=True, HF_TOKEN="hf_bench",
+        RATE_LIMITS={endpoint_of(base_url): BENCH_RATE_LIMIT}, **overrides,
+    ):
+        reset_runtime_state()
+        get_session().trust_env = False   # 不让环境变量里的代理接管本地请求
+        start = time.time()
+        try:
+            main()
+            elapsed = time.time() - start
+            snap = METRICS.snapshot()
+            journal = get_journal()
+            entries = [journal.get(i) or {} for i in range(cards)]
+        finally:
+            reset_runtime_state()
+
+    done = sum(1 for e in entries if e.get("stage") == STAGE_IMAGE_DONE)
+    per_card = [(e.get("concept_secs") or 0) + (e.get("image_secs") or 0)
+                for e in entries if e.get("stage") == STAGE_IMAGE_DONE]
+    calls = counter_total(snap, "api_calls")
+    retries = counter_total(snap, "api_retries")
+    return {
+        "scenario": name,
+        "overrides": overrides,
+        "cards": cards,
+        "done": done,
+        "seconds": round(elapsed, 2),
+        "cards_per_minute": round(done / (elapsed / 60), 2) if elapsed > 0 else 0,
+        "p50": percentile(per_card, 50),
+        "p99": percentile(per_card, 99),
+        "requests": counter_total(snap, "http_requests"),
+        "api_calls": calls,
+        "retries": retries,
+        "retry_overhead": round(retries / calls, 3) if calls else 0,
+    }
+
+def run_bench(cards=None, scenarios=None):
+    """离线基准测试: 依次跑各场景并打印对比表，结果写入 BENCH_RESULTS_FILE (JSON)"""
+    cards = cards or BENCH_CARDS
+    names = scenarios or list(BENCH_SCENARIOS)
+    unknown = [name for name in names if name not in BENCH_SCENARIOS]
+    if unknown:
+        raise KeyError(f"未知的场景: {', '.join(unknown)} (可选: {', '.join(BENCH_SCENARIOS)})")
+
+    server = start_stub_server()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    level = logger.level
+    logger.setLevel(logging.ERROR)   # 逐张日志会淹没结果，只保留错误
+    results = []
+    try:
+        for name in names:
+            print(f"🏁 场景 {name}: {cards} 张 ...", flush=True)
+            results.append(bench_scenario(name, BENCH_SCENARIOS[name], base_url, cards))
+    finally:
+        logger.setLevel(level)
+        server.shutdown()
+        server.server_close()
+
+    def fmt_secs(value):
+        return "-" if value is None else f"{value:.2f}s"
+
+    print(f"\n{'场景':<10}{'完成':>6}{'张/分钟':>10}{'p50':>9}{'p99':>9}{'请求':>7}{'重试率':>8}")
+    for r in results:
+        print(f"{r['scenario']:<12}{r['done']:>4}/{r['cards']:<3}{r['cards_per_minute']:>8.2f}"
+              f"{fmt_secs(r['p50']):>9}{fmt_secs(r['p99']):>9}{r['requests']:>7}{r['retry_overhead']:>8.1%}")
+    injected = ", ".join(f"{k} {v}" for k, v in sorted(server.served.items()))
+    print(f"   桩服务器响应: {injected}")
+
+    with open(BENCH_RESULTS_FILE, "w", encoding="utf-8") as f:
+        json.dump({"profile": BENCH_PROFILE, "seed": BENCH_SEED, "results": results,
+                   "served": dict(server.served)}, f, ensure_ascii=False, indent=2)
+    print(f"📄 结果已写入 {os.path.abspath(BENCH_RESULTS_FILE)}")
+    return results
 
 # ================= 🚀 主程序 =================
 
-def main():
+def main(regenerate=None):
+    """生成整副牌；regenerate 为卡片序号列表 (从 0 开始) 时只按规划重新生成这些卡片"""
+    invalid = [i for i in regenerate or () if not 0 <= i < NUM_CARDS]
+    if invalid:
+        raise ValueError(f"卡片序号超出 0..{NUM_CARDS - 1}: {invalid}")
     ensure_dir(OUTPUT_DIR)
+    cleanup_partial_downloads(OUTPUT_DIR)
     logger.info("=========================================")
     logger.info(f"   《画物语》终极生成器 (修复版)")
     logger.info(f"   目标: {NUM_CARDS} 张 | 输出: {OUTPUT_DIR}")
@@ -515,47 +3945,142 @@ def main():
     
     total_start = time.time()
     
+    journal = get_journal()
     try:
-        for i in range(NUM_CARDS):
-            filename = f"card_{i+1:02d}.jpg"
+        get_deck_plan()
+        get_validation()   # 校验进程池在启动任何线程之前创建
+        for i in regenerate or ():
+            file_path = os.path.join(OUTPUT_DIR, card_filename(i))
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            logger.info("♻️  [%d/%d] 按规划重新生成 %s", i + 1, NUM_CARDS, card_filename(i), extra={"card": i + 1})
+        pending = []
+        for i in (regenerate if regenerate else range(NUM_CARDS)):
+            filename = card_filename(i)
             file_path = os.path.join(OUTPUT_DIR, filename)
             
             # 断点续传检查
             if os.path.exists(file_path):
-                logger.info(f"⏭️  [{i+1}/{NUM_CARDS}] 跳过: {filename} 已存在")
+                logger.info("⏭️  [%d/%d] 跳过: %s 已存在", i + 1, NUM_CARDS, filename, extra={"card": i + 1})
+                entry = journal.get(i)
+                if not entry or entry["stage"] != STAGE_IMAGE_DONE:
+                    journal.record(i, stage=STAGE_IMAGE_DONE, error=None)
                 continue
-            
-            # 1. 构思
-            prompt = construct_concept(i)
-            
-            # 2. 绘图
-            success = False
-            if OUTPUT_DIR == "stable":
-                generate_huggingface(prompt, filename)
-            else:
-                generate_image(prompt, filename)
-            
-            # 3. 冷却
-            if success:
-                if i < NUM_CARDS - 1:
-                    wait = DELAY_SECONDS + random.randint(2, 6)
-                    logger.info(f"   ⏳ 冷却中... ({wait}s)\n")
-                    time.sleep(wait)
+            pending.append(i)
+        constrained = RUN_DEADLINE is not None or REQUEST_BUDGET is not None
+        pending = journal.resume_order(pending, defer_failed=constrained)
+
+        with scheduled_run(len(pending)):
+            if PIPELINE_MODE:
+                logger.info(f"🔀 流水线模式: 文本 {TEXT_WORKERS} 线程 | 图片 {IMAGE_WORKERS} 线程 | 预取 {PREFETCH_CONCEPTS} 张\n")
+                run_pipeline(pending)
             else:
-                logger.warning(f"   ⚠️ 本次生成失败，休息 5s 后继续\n")
-                time.sleep(5)
+                run_sequential(pending)
                 
     except KeyboardInterrupt:
         logger.warning("\n🛑 用户手动停止脚本")
     except Exception as e:
         logger.critical(f"\n☠️ 发生未捕获的异常: {e}")
     finally:
+        close_validation()
+        if DEDUP_INLINE and _PHASH_INDEX is not None:
+            _PHASH_INDEX.save()
+        metrics_path = METRICS.export(os.path.join(OUTPUT_DIR, METRICS_DIR))
         total_time = (time.time() - total_start) / 60
         logger.info("=========================================")
         logger.info(f"🎉 任务结束！总耗时: {total_time:.1f} 分钟")
         logger.info(f"📂 查看图片: {os.path.abspath(OUTPUT_DIR)}")
         logger.info(f"📝 查看详细日志: {os.path.abspath(LOG_FILE)}")
+        logger.info(f"📊 运行指标: {os.path.abspath(metrics_path)} (python dixitai.py stats)")
         logger.info("=========================================")
 
+# ================= ⌨️ 命令行 =================
+
+def card_number(text):
+    """命令行的卡片编号 (从 1 开始)；上限取决于 -n，由 cli 在应用全局选项后检查"""
+    number = int(text)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"卡片编号从 1 开始: {text}")
+    return number
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="dixitai.py", description="《画物语》Dixit 卡牌生成器")
+    parser.add_argument("-o", "--output", help=f"输出目录 (默认 {OUTPUT_DIR})")
+    parser.add_argument("-n", "--cards", type=int, help=f"整副牌的张数 (默认 {NUM_CARDS})")
+    parser.add_argument("--backend", help="图片引擎 (默认: 输出目录为 stable 时 huggingface，否则 pollinations)")
+    parser.add_argument("--deadline", type=parse_deadline, metavar="时长|HH:MM",
+                        help="截止时间: 90m / 2h / 3600 (秒) 或 23:30；来不及时跳过长退避的重试，剩余卡片留到下次")
+    parser.add_argument("--budget", type=int, metavar="次数", help="本次运行最多发多少个 HTTP 请求")
+    commands = parser.add_subparsers(dest="command", metavar="命令")
+
+    def command(name, func, help, logs=True):
+        sub = commands.add_parser(name, help=help, description=help)
+        sub.set_defaults(func=func, logs=logs)
+        return sub
+
+    command("generate", lambda args: main(), "生成整副牌 (默认命令，断点续传)")
+    sub = command("regen", lambda args: main(regenerate=[n - 1 for n in args.numbers]), "按规划重新生成指定卡片")
+    sub.add_argument("numbers", type=card_number, nargs="+", metavar="编号", help="卡片编号 (从 1 开始)")
+    command("status", lambda args: print_status(), "查看运行日志里各阶段的卡片数和最近的失败", logs=False)
+    sub = command("stats", lambda args: print_stats(args.path), "汇总一次运行的指标 (默认最近一次)", logs=False)
+    sub.add_argument("path", nargs="?", help="metrics/run-*.json")
+    command("vocab", lambda args: print_vocab(), "查看素材包与骨架空间", logs=False)
+    sub = command("dedup", lambda args: run_dedup(dry_run=args.dry_run), "用感知哈希找出近似重复的卡片并重画")
+    sub.add_argument("--dry-run", action="store_true", help="只列出重复，不删除")
+    command("export", lambda args: run_postprocess(), "生成缩略图 / 卡面 / 印刷版")
+    sub = command("atlas", lambda args: build_atlas(args.dir), "把整副牌拼成图集")
+    sub.add_argument("dir", nargs="?", help="来源目录 (默认输出目录)")
+    sub = command("bench", lambda args: run_bench(args.bench_cards, args.scenarios or None), "用本地桩服务器做离线基准测试")
+    sub.add_argument("--cards", dest="bench_cards", type=int, help=f"每个场景的张数 (默认 {BENCH_CARDS})")
+    sub.add_argument("scenarios", nargs="*", metavar="场景", help=f"可选: {', '.join(BENCH_SCENARIOS)}")
+    sub = command("worker", lambda args: run_worker(args.address), "分片 worker: 从共享队列领取卡片")
+    sub.add_argument("address", nargs="?", help="协调器地址 主机:端口 (省略则使用输出目录里的本地队列)")
+    sub.add_argument("--proxy", help="本 worker 使用的出口代理")
+    sub = command("coordinator", lambda args: run_coordinator(args.address), "启动分片队列的 TCP 协调器")
+    sub.add_argument("address", nargs="?", help=f"监听地址 (默认 {SHARD_COORDINATOR})")
+    sub = command("merge", lambda args: merge_decks(args.sources), "把各 worker 的输出合并进输出目录")
+    sub.add_argument("sources", nargs="+", metavar="目录")
+    sub = command("pack", lambda args: pack_decks(args.sources or [OUTPUT_DIR], args.file), "把输出目录打包进牌组归档 (图片按内容去重)")
+    sub.add_argument("sources", nargs="*", metavar="目录", help="每个目录一个牌组 (默认输出目录)")
+    sub.add_argument("-f", "--file", help=f"归档文件 (默认 {ARCHIVE_FILE})")
+    sub = command("unpack", lambda args: unpack_deck(args.deck, args.file), "把归档里的一个牌组导入输出目录")
+    sub.add_argument("deck", nargs="?", metavar="牌组", help="牌组名 (归档里只有一个牌组时可省略)")
+    sub.add_argument("-f", "--file", help=f"归档文件 (默认 {ARCHIVE_FILE})")
+    sub = command("archive", lambda args: print_archive(args.number, args.deck, args.save, args.file),
+                  "列出归档里的牌组，或查看/取出单张卡片", logs=False)
+    sub.add_argument("number", type=int, nargs="?", metavar="编号", help="卡片编号 (从 1 开始)")
+    sub.add_argument("--deck", metavar="牌组", help="牌组名 (归档里只有一个牌组时可省略)")
+    sub.add_argument("--save", metavar="文件", help="把该卡片的图片另存到此路径")
+    sub.add_argument("-f", "--file", help=f"归档文件 (默认 {ARCHIVE_FILE})")
+    return parser
+
+def cli(argv=None):
+    """命令行入口: 解析参数、应用全局选项，只在需要时初始化日志"""
+    global OUTPUT_DIR, NUM_CARDS, IMAGE_BACKEND, USE_PROXY, PROXY_URL, VERIFY_SSL, RUN_DEADLINE, REQUEST_BUDGET
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.output:
+        OUTPUT_DIR = args.output
+    if args.cards:
+        NUM_CARDS = args.cards
+    out_of_range = [n for n in getattr(args, "numbers", ()) if n > NUM_CARDS]
+    if out_of_range:
+        parser.error(f"卡片编号超出 1..{NUM_CARDS}: {', '.join(map(str, out_of_range))}")
+    if args.backend:
+        if args.backend not in IMAGE_BACKENDS:
+            raise SystemExit(f"未知的图片引擎: {args.backend} (可选: {', '.join(IMAGE_BACKENDS)})")
+        IMAGE_BACKEND = args.backend
+    if args.deadline is not None:
+        RUN_DEADLINE = args.deadline
+    if args.budget is not None:
+        REQUEST_BUDGET = args.budget
+    if getattr(args, "proxy", None):
+        USE_PROXY, PROXY_URL, VERIFY_SSL = True, args.proxy, False
+    if args.command is None:
+        args.func, args.logs = (lambda _: main()), True
+    if args.logs:
+        setup_logging()
+    return args.func(args)
+
 if __name__ == "__main__":
-    main()
+    cli()
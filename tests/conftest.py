@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dixitai  # noqa: E402
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    """按脚本依次返回响应: server.script[路径] 是 (状态码, 头, 正文[, 延迟秒数]) 列表，用完后重复最后一个。
+    每个请求记入 server.log (时间, 方法, 路径)。作为 HTTP 代理被访问时路径是完整 URL。"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.respond()
+
+    def respond(self):
+        server = self.server
+        with server.lock:
+            server.log.append((time.monotonic(), self.command, self.path))
+            steps = server.script.get(self.path) or server.script.get("*") or [(404, {}, b"")]
+            status, headers, body, *delay = steps.pop(0) if len(steps) > 1 else steps[0]
+        if delay:
+            time.sleep(delay[0])
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """本地桩服务器 + 指向它的配置 (不走代理、限流放宽)；返回 server，server.base 为地址"""
+    for name in ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "NO_PROXY", "http_proxy", "https_proxy", "all_proxy", "no_proxy"):
+        monkeypatch.delenv(name, raising=False)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ScriptedHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.script = {}
+    server.log = []
+    server.base = f"http://127.0.0.1:{server.server_port}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with dixitai.config_overrides(
+        TEXT_API_BASE=server.base, IMAGE_API_BASE=server.base, HF_API_BASE=server.base,
+        USE_PROXY=False, VERIFY_SSL=True, HEDGE_DUPLICATES=False,
+        RATE_LIMITS={"127.0.0.1": (100, 10)},
+    ):
+        dixitai.reset_runtime_state()
+        try:
+            yield server
+        finally:
+            dixitai.reset_runtime_state()
+            server.shutdown()
+            server.server_close()
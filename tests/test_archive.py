@@ -0,0 +1,55 @@
+import os
+
+import dixitai
+
+
+def write_card(directory, number, payload):
+    directory.mkdir(exist_ok=True)
+    (directory / f"card_{number:02d}.jpg").write_bytes(payload)
+
+
+def test_pack_unpack_round_trip_with_dedup(tmp_path):
+    shared, only_a, only_b = b"shared" * 500, b"a" * 3000, b"b" * 3000
+    write_card(tmp_path / "alpha", 1, shared)
+    write_card(tmp_path / "alpha", 2, only_a)
+    write_card(tmp_path / "beta", 1, shared)
+    write_card(tmp_path / "beta", 3, only_b)
+    journal = dixitai.Journal(str(tmp_path / "alpha" / dixitai.JOURNAL_FILE))
+    journal.record(1, stage=dixitai.STAGE_IMAGE_DONE, prompt="a lonely lighthouse", image_seed=42)
+    journal.close()
+    archive_path = str(tmp_path / "decks.zip")
+
+    assert dixitai.pack_decks([str(tmp_path / "alpha"), str(tmp_path / "beta")], archive_path) == 2
+    with dixitai.DeckArchive(archive_path) as archive:
+        assert archive.decks() == ["alpha", "beta"]
+        assert len(archive.blobs()) == 3   # 两个牌组共用同一张图
+        assert archive.read(2, "beta") == only_b
+        assert archive.card(1, "alpha")["prompt"] == "a lonely lighthouse"
+
+    out = tmp_path / "out"
+    with dixitai.config_overrides(OUTPUT_DIR=str(out)):
+        dixitai.reset_runtime_state()
+        try:
+            assert dixitai.unpack_deck("alpha", archive_path) == 2
+            assert dixitai.unpack_deck("alpha", archive_path) == 0   # 已存在的卡片保持不变
+            entry = dixitai.get_journal().get(1)
+        finally:
+            dixitai.reset_runtime_state()
+    assert (out / "card_01.jpg").read_bytes() == shared
+    assert (out / "card_02.jpg").read_bytes() == only_a
+    assert entry["stage"] == dixitai.STAGE_IMAGE_DONE
+    assert (entry["prompt"], entry["image_seed"]) == ("a lonely lighthouse", 42)
+    assert not [name for name in os.listdir(out) if name.endswith(".part")]
+
+
+def test_repacking_replaces_one_deck_and_keeps_the_others(tmp_path):
+    write_card(tmp_path / "alpha", 1, b"x" * 3000)
+    write_card(tmp_path / "beta", 1, b"y" * 3000)
+    archive_path = str(tmp_path / "decks.zip")
+    dixitai.pack_decks([str(tmp_path / "alpha"), str(tmp_path / "beta")], archive_path)
+    write_card(tmp_path / "alpha", 1, b"z" * 3000)
+    assert dixitai.pack_decks([str(tmp_path / "alpha")], archive_path) == 2
+    with dixitai.DeckArchive(archive_path) as archive:
+        assert archive.read(0, "alpha") == b"z" * 3000
+        assert archive.read(0, "beta") == b"y" * 3000
+        assert len(archive.blobs()) == 2   # alpha 的旧图不再被引用，不会带进新归档
@@ -0,0 +1,58 @@
+import pytest
+
+import dixitai
+
+
+@pytest.fixture(autouse=True)
+def restore_config():
+    with dixitai.config_overrides(
+        OUTPUT_DIR=dixitai.OUTPUT_DIR, NUM_CARDS=dixitai.NUM_CARDS, IMAGE_BACKEND=dixitai.IMAGE_BACKEND,
+    ):
+        yield
+
+
+@pytest.mark.parametrize("argv", [["regen", "0"], ["regen", "-3"], ["regen", "251"], ["-n", "10", "regen", "11"]])
+def test_regen_rejects_out_of_range_numbers(argv, capsys):
+    with pytest.raises(SystemExit) as exc:
+        dixitai.cli(argv)
+    assert exc.value.code == 2
+    assert "卡片编号" in capsys.readouterr().err
+
+
+def test_main_rejects_out_of_range_indices():
+    with pytest.raises(ValueError):
+        dixitai.main(regenerate=[-1])
+    with pytest.raises(ValueError):
+        dixitai.main(regenerate=[dixitai.NUM_CARDS])
+
+
+def test_output_dir_stable_defaults_to_huggingface(tmp_path):
+    dixitai.cli(["-o", str(tmp_path / "stable"), "status"])
+    assert dixitai.default_backend() == "huggingface"
+    dixitai.cli(["-o", str(tmp_path / "cheap"), "status"])
+    assert dixitai.default_backend() == "pollinations"
+    dixitai.cli(["-o", str(tmp_path / "stable"), "--backend", "pollinations", "status"])
+    assert dixitai.default_backend() == "pollinations"
+
+
+def snapshot(directory):
+    return {p.name: (p.stat().st_mtime_ns, p.stat().st_size) for p in directory.iterdir()}
+
+
+def test_status_does_not_write_to_output_dir(tmp_path, capsys):
+    journal = dixitai.Journal(str(tmp_path / dixitai.JOURNAL_FILE))
+    journal.record(0, stage=dixitai.STAGE_IMAGE_DONE)
+    journal.record(1, stage=dixitai.STAGE_IMAGE_FAILED, error="HTTP 500")
+    journal.close()
+    before = snapshot(tmp_path)
+    dixitai.cli(["-o", str(tmp_path), "-n", "2", "status"])
+    out = capsys.readouterr().out
+    assert "完成 1/2" in out
+    assert "HTTP 500" in out
+    assert snapshot(tmp_path) == before
+
+
+def test_status_without_journal(tmp_path, capsys):
+    dixitai.cli(["-o", str(tmp_path), "status"])
+    assert "还没有运行日志" in capsys.readouterr().out
+    assert list(tmp_path.iterdir()) == []
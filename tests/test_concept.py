@@ -0,0 +1,39 @@
+import urllib.parse
+
+import dixitai
+
+
+def test_hedge_win_is_cached_under_its_own_seed(stub, tmp_path):
+    with dixitai.config_overrides(
+        OUTPUT_DIR=str(tmp_path), PROMPT_CACHE_FILE=str(tmp_path / "cache.sqlite3"), HEDGE_DUPLICATES=True,
+    ):
+        instruction = dixitai.build_concept(0)["instruction"]
+        seed = dixitai.text_seed_for(instruction)
+        path = "/" + urllib.parse.quote(instruction)
+        stub.script[f"{path}?seed={seed}&model=openai"] = [(200, {}, "primary text", 1.0)]
+        stub.script[f"{path}?seed={seed + 1}&model=openai"] = [(200, {}, "hedge text")]
+        for _ in range(dixitai.LATENCY_MIN_SAMPLES):
+            dixitai.LATENCY.record("127.0.0.1", 0.05, "text")
+        info = {}
+        assert dixitai.construct_concept(0, info) == "hedge text"
+        assert info["text_seed"] == seed + 1
+        cache = dixitai.get_prompt_cache()
+        assert cache.get(instruction, seed) is None
+        assert cache.get(instruction, seed + 1) == "hedge text"
+
+
+def test_parse_description_array_tolerates_surrounding_text():
+    text = 'Sure! Here they are:\n["  A moon made of glass ", {"description": "a whale in a teacup"}]\nEnjoy.'
+    assert dixitai.parse_description_array(text, 2) == ["A moon made of glass", "a whale in a teacup"]
+
+
+def test_parse_description_array_marks_bad_entries_missing():
+    text = '["first", 42, "", {"title": "no description"}, "fifth", "extra"]'
+    assert dixitai.parse_description_array(text, 5) == ["first", None, None, None, "fifth"]
+    assert dixitai.parse_description_array('["only one"]', 3) == ["only one", None, None]
+
+
+def test_parse_description_array_without_json():
+    assert dixitai.parse_description_array("no array here", 2) == [None, None]
+    assert dixitai.parse_description_array("[not json]", 2) == [None, None]
+    assert dixitai.parse_description_array('{"a": [1]}', 1) == [None]
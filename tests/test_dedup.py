@@ -0,0 +1,55 @@
+import random
+
+from PIL import Image, ImageDraw, ImageFilter
+
+import dixitai
+
+
+def scene(path, seed, size=(512, 512), quality=90):
+    """随机色块拼成的测试图"""
+    rng = random.Random(seed)
+    img = Image.new("RGB", (256, 256), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(200), rng.randrange(200)
+        draw.ellipse((x, y, x + rng.randrange(20, 120), y + rng.randrange(20, 120)),
+                     fill=tuple(rng.randrange(256) for _ in range(3)))
+    img.resize(size).save(path, quality=quality)
+    return path
+
+
+def test_bktree_search_matches_brute_force():
+    rng = random.Random(1)
+    values = [rng.getrandbits(64) for _ in range(300)]
+    tree = dixitai.BKTree()
+    for k, value in enumerate(values):
+        tree.add(value, k)
+    for query in values[:20] + [rng.getrandbits(64) for _ in range(20)]:
+        for radius in (0, 6, 28):
+            expected = sorted((dixitai.hamming(query, v), k) for k, v in enumerate(values)
+                              if dixitai.hamming(query, v) <= radius)
+            assert tree.search(query, radius) == expected
+
+
+def test_perceptual_hash_survives_resize_and_recompression(tmp_path):
+    original = dixitai.perceptual_hash(scene(tmp_path / "a.jpg", 1))
+    resized = dixitai.perceptual_hash(scene(tmp_path / "b.jpg", 1, size=(300, 300), quality=60))
+    Image.open(tmp_path / "a.jpg").filter(ImageFilter.GaussianBlur(1)).save(tmp_path / "c.jpg")
+    blurred = dixitai.perceptual_hash(tmp_path / "c.jpg")
+    other = dixitai.perceptual_hash(scene(tmp_path / "d.jpg", 2))
+    assert dixitai.hamming(original, resized) <= dixitai.DUPLICATE_MAX_DISTANCE
+    assert dixitai.hamming(original, blurred) <= dixitai.DUPLICATE_MAX_DISTANCE
+    assert dixitai.hamming(original, other) > dixitai.DUPLICATE_MAX_DISTANCE
+
+
+def test_index_reports_later_near_duplicates(tmp_path):
+    scene(tmp_path / "card_01.jpg", 1)
+    scene(tmp_path / "card_02.jpg", 2)
+    scene(tmp_path / "card_03.jpg", 1, quality=50)
+    index = dixitai.PerceptualIndex(str(tmp_path))
+    index.refresh()
+    [(duplicate, original, distance)] = index.find_duplicates()
+    assert (duplicate, original) == ("card_03.jpg", "card_01.jpg")
+    assert index.add_if_unique("card_03.jpg")[0] == "card_01.jpg"
+    index.save()
+    assert dixitai.PerceptualIndex(str(tmp_path)).entries == index.entries
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+import dixitai
+
+
+class FakeResponse:
+    """按块返回正文；fail_after 块之后抛出异常 (模拟断线)，on_chunk(k) 在每块之前调用"""
+
+    def __init__(self, chunks, fail_after=None, on_chunk=None, content_length=None):
+        self.chunks = chunks
+        self.fail_after = fail_after
+        self.on_chunk = on_chunk
+        self.headers = {} if content_length is None else {"Content-Length": str(content_length)}
+        self.url = "http://img.invalid/x"
+        self.closed = False
+
+    def iter_content(self, size):
+        for k, chunk in enumerate(self.chunks):
+            if k == self.fail_after:
+                raise ConnectionError("connection reset")
+            if self.on_chunk is not None:
+                self.on_chunk(k)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+BODY = [b"a" * 1000, b"b" * 1000, b"c" * 1000]
+
+
+def leftovers(tmp_path):
+    return sorted(p.name for p in tmp_path.iterdir())
+
+
+def test_complete_download_is_renamed_into_place(tmp_path):
+    target = tmp_path / "card_01.jpg"
+    response = FakeResponse(BODY)
+    assert dixitai.stream_to_file(response, str(target)) == 3000
+    assert target.read_bytes() == b"".join(BODY)
+    assert leftovers(tmp_path) == ["card_01.jpg"]
+    assert response.closed
+
+
+def test_partial_body_leaves_nothing(tmp_path):
+    with pytest.raises(ConnectionError):
+        dixitai.stream_to_file(FakeResponse(BODY, fail_after=2), str(tmp_path / "card_01.jpg"))
+    assert leftovers(tmp_path) == []
+
+
+def test_cancel_mid_download_leaves_nothing(tmp_path):
+    cancel = threading.Event()
+    response = FakeResponse(BODY, on_chunk=lambda k: k == 1 and cancel.set())
+    with pytest.raises(dixitai.DownloadCancelled):
+        dixitai.stream_to_file(response, str(tmp_path / "card_01.jpg"), cancel=cancel)
+    assert leftovers(tmp_path) == []
+
+
+def test_loser_of_a_hedge_does_not_overwrite(tmp_path):
+    target = tmp_path / "card_01.jpg"
+    cancel = threading.Event()
+    assert dixitai.stream_to_file(FakeResponse(BODY), str(target), cancel=cancel) == 3000
+    assert cancel.is_set()
+    with pytest.raises(dixitai.DownloadCancelled):
+        dixitai.stream_to_file(FakeResponse([b"z" * 3000]), str(target), cancel=cancel)
+    assert target.read_bytes() == b"".join(BODY)
+    assert leftovers(tmp_path) == ["card_01.jpg"]
+
+
+def test_small_or_rejected_body_leaves_nothing(tmp_path):
+    target = str(tmp_path / "card_01.jpg")
+    assert dixitai.stream_to_file(FakeResponse([b"x" * 10]), target) is None
+    assert dixitai.stream_to_file(FakeResponse(BODY, content_length=10), target) is None
+
+    def reject(path):
+        raise dixitai.RetryableResponse("bad image")
+
+    with pytest.raises(dixitai.RetryableResponse):
+        dixitai.stream_to_file(FakeResponse(BODY), target, validate=reject)
+    assert leftovers(tmp_path) == []
@@ -0,0 +1,142 @@
+import json
+import time
+
+import dixitai
+
+
+def text_of(response):
+    if not response.text:
+        raise dixitai.RetryableResponse("返回内容为空")
+    return response.text
+
+
+def fetch(stub, path="/x", max_retries=3):
+    return dixitai.request_with_retries("GET", [stub.base + path], "测试", max_retries, (2, 5), text_of)
+
+
+def gaps(stub):
+    times = [t for t, _, _ in stub.log]
+    return [b - a for a, b in zip(times, times[1:])]
+
+
+def test_429_waits_for_retry_after_via_limiter(stub):
+    stub.script["/x"] = [(429, {"Retry-After": "1"}, b""), (200, {}, "ok")]
+    assert fetch(stub) == ("ok", None)
+    assert len(stub.log) == 2
+    assert gaps(stub)[0] >= 0.9
+    limiter = dixitai.get_rate_limiter(stub.base)
+    assert limiter.rate < 100
+
+
+def test_503_honours_retry_after_instead_of_backoff(stub):
+    stub.script["/x"] = [(503, {"Retry-After": "1"}, b""), (200, {}, "ok")]
+    assert fetch(stub) == ("ok", None)
+    # 退避至少 BACKOFF_BASE_SECONDS + 0.5 秒；遵循 Retry-After 则约 1 秒
+    assert 0.9 <= gaps(stub)[0] < dixitai.BACKOFF_BASE_SECONDS + 0.5
+
+
+def test_hf_cold_start_estimated_time(stub):
+    body = json.dumps({"error": "Model is loading", "estimated_time": 0.3})
+    stub.script["/x"] = [(503, {"Content-Type": "application/json"}, body), (200, {}, "ok")]
+    assert fetch(stub) == ("ok", None)
+    assert 0.25 <= gaps(stub)[0] < 1.5
+
+
+def test_503_retries_are_bounded(stub):
+    stub.script["/x"] = [(503, {"Retry-After": "0"}, b"")]
+    assert fetch(stub, max_retries=3) == (None, "HTTP 503")
+    assert len(stub.log) == 3
+
+
+def test_non_retryable_status_stops_immediately(stub):
+    stub.script["/x"] = [(400, {}, "bad request")]
+    assert fetch(stub) == (None, "HTTP 400")
+    assert len(stub.log) == 1
+
+
+def test_invalid_content_is_retried(stub):
+    stub.script["/x"] = [(200, {}, b""), (200, {}, "ok")]
+    with dixitai.config_overrides(BACKOFF_BASE_SECONDS=0, compute_backoff_seconds=lambda attempt: 0):
+        assert fetch(stub) == ("ok", None)
+    assert len(stub.log) == 2
+
+
+def test_configured_proxy_beats_environment(stub, monkeypatch):
+    # 环境变量里的代理不可达；USE_PROXY 时请求必须经 PROXY_URL (桩服务器充当 HTTP 代理)
+    monkeypatch.setenv("HTTP_PROXY", "http://127.0.0.1:1")
+    monkeypatch.setenv("http_proxy", "http://127.0.0.1:1")
+    stub.script["*"] = [(200, {}, "via proxy")]
+    target = "http://upstream.invalid/x"
+    with dixitai.config_overrides(USE_PROXY=True, PROXY_URL=stub.base):
+        response = dixitai.http_request("GET", target, (2, 5))
+    assert response.text == "via proxy"
+    assert stub.log[0][2] == target
+
+
+class TestRateLimiter:
+    def test_burst_then_paced(self):
+        limiter = dixitai.RateLimiter("h", rate=20, burst=2)
+        start = time.monotonic()
+        assert limiter.acquire() == 0
+        assert limiter.acquire() == 0
+        assert limiter.acquire() > 0
+        assert time.monotonic() - start >= 0.04
+
+    def test_throttle_halves_rate_and_pauses(self):
+        limiter = dixitai.RateLimiter("h", rate=10, burst=5)
+        assert limiter.on_throttle(retry_after=0.2) == 0.2
+        assert limiter.rate == 10 * dixitai.RATE_DECREASE_FACTOR
+        assert not limiter.has_spare()
+        start = time.monotonic()
+        limiter.acquire()
+        assert time.monotonic() - start >= 0.19
+
+    def test_throttle_without_retry_after_pauses_one_interval(self):
+        limiter = dixitai.RateLimiter("h", rate=4, burst=1)
+        assert limiter.on_throttle() == 1 / (4 * dixitai.RATE_DECREASE_FACTOR)
+
+    def test_rate_floor(self):
+        limiter = dixitai.RateLimiter("h", rate=dixitai.RATE_MIN_PER_SECOND, burst=1)
+        limiter.on_throttle(retry_after=0)
+        assert limiter.rate == dixitai.RATE_MIN_PER_SECOND
+
+    def test_success_recovers_up_to_ceiling(self):
+        limiter = dixitai.RateLimiter("h", rate=1, burst=1)
+        limiter.on_throttle(retry_after=0)
+        for _ in range(1000):
+            limiter.on_success()
+        assert limiter.rate == 1 * dixitai.RATE_PROBE_CEILING
+
+    def test_has_spare(self):
+        limiter = dixitai.RateLimiter("h", rate=0.01, burst=1)
+        assert limiter.has_spare()
+        limiter.acquire()
+        assert not limiter.has_spare()
+
+
+def test_fallback_backend_starts_while_primary_is_throttled(stub, tmp_path):
+    # 主引擎的限流器暂停 5 秒；切换备用引擎按总耗时计，不等主引擎拿到令牌
+    stub.script["*"] = [(200, {"Content-Type": "image/jpeg"}, b"x" * dixitai.MIN_IMAGE_BYTES)]
+    hf_base = stub.base.replace("127.0.0.1", "localhost")
+    with dixitai.config_overrides(
+        OUTPUT_DIR=str(tmp_path), IMAGE_BACKEND="pollinations", FALLBACK_BACKENDS=["huggingface"],
+        HEDGE_AFTER_SECONDS=0.5, HF_API_BASE=hf_base, HF_TOKEN="hf_test", VALIDATE_IMAGES=False,
+    ):
+        dixitai.get_rate_limiter(stub.base).on_throttle(5)
+        info = {}
+        start = time.monotonic()
+        assert dixitai.render_image("a cat", "card_01.jpg", info, seed=1)
+        elapsed = time.monotonic() - start
+    assert info["backend"] == "huggingface"
+    assert 0.4 <= elapsed < 3
+    assert (tmp_path / "card_01.jpg").exists()
+
+
+def test_latency_is_tracked_per_request_kind(stub):
+    stub.script["/x"] = [(200, {}, "ok", 0.3)]
+    stub.script["/y"] = [(200, {}, "ok")]
+    for _ in range(dixitai.LATENCY_MIN_SAMPLES):
+        dixitai.http_request("GET", stub.base + "/x", (2, 5), kind="batch")
+        dixitai.http_request("GET", stub.base + "/y", (2, 5), kind="text")
+    assert dixitai.LATENCY.hedge_delay("127.0.0.1", "batch") >= 0.3
+    assert dixitai.LATENCY.hedge_delay("127.0.0.1", "text") < 0.3
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+from PIL import Image
+
+import dixitai
+
+
+def fake_render(index, prompt):
+    Image.new("RGB", (300, 400), (40 * index, 90, 160)).save(os.path.join(dixitai.OUTPUT_DIR, dixitai.card_filename(index)))
+    return True
+
+
+@pytest.mark.parametrize("run", [dixitai.run_sequential, dixitai.run_pipeline])
+def test_inline_postprocess_in_both_modes(run, tmp_path):
+    with dixitai.config_overrides(
+        OUTPUT_DIR=str(tmp_path), POSTPROCESS_INLINE=True, POSTPROCESS_WORKERS=1, TEXT_BATCH_SIZE=1,
+        prepare_concepts=lambda chunk: [f"prompt {i}" for i in chunk], render_card=fake_render,
+    ):
+        done = []
+        run([0, 1], on_done=lambda i, ok: done.append((i, ok)))
+    assert sorted(done) == [(0, True), (1, True)]
+    for variant in dixitai.EXPORT_VARIANTS:
+        assert sorted(os.listdir(tmp_path / dixitai.EXPORT_DIR / variant)) == ["card_01.jpg", "card_02.jpg"]
+
+
+def test_worker_saves_inline_dedup_index(tmp_path):
+    def render_and_index(index, prompt):
+        fake_render(index, prompt)
+        return dixitai.get_phash_index().add_if_unique(dixitai.card_filename(index)) is None
+
+    with dixitai.config_overrides(
+        OUTPUT_DIR=str(tmp_path), NUM_CARDS=2, DEDUP_INLINE=True, VALIDATE_IMAGES=False,
+        prepare_concepts=lambda chunk: [f"prompt {i}" for i in chunk], render_card=render_and_index,
+    ):
+        dixitai.reset_runtime_state()
+        try:
+            dixitai.run_worker()
+        finally:
+            dixitai.reset_runtime_state()
+    index = dixitai.PerceptualIndex(str(tmp_path))
+    assert sorted(index.entries) == ["card_01.jpg", "card_02.jpg"]
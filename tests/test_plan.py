@@ -0,0 +1,29 @@
+import collections
+import random
+
+import pytest
+
+import dixitai
+
+
+@pytest.mark.parametrize("weights", [[1.0, 1.4, 0.6], [1, 2.5], [0.5, 0.5, 1.5], [1, 1, 1]])
+def test_bag_frequencies_follow_weights(weights):
+    table = dixitai.VocabTable([f"item{k}" for k in range(len(weights))], weights)
+    bag = dixitai.ShuffleBag(table.bag_items(), random.Random(7))
+    rounds = 50
+    draws = collections.Counter(bag.draw() for _ in range(rounds * len(table.bag_items())))
+    total = sum(draws.values())
+    for k, w in enumerate(weights):
+        share = w / sum(weights)
+        assert abs(draws[k] / total - share) <= share * dixitai.PLAN_BAG_TOLERANCE
+
+
+def test_bag_keeps_one_copy_per_round_for_equal_weights():
+    assert dixitai.apportion_copies([2.0, 2.0, 2.0]) == [1, 1, 1]
+    assert dixitai.apportion_copies([1.0, 1.4, 0.6]) == [5, 7, 3]
+
+
+def test_bag_copies_are_capped():
+    with dixitai.config_overrides(PLAN_BAG_MAX_COPIES=2):
+        copies = dixitai.apportion_copies([1.0, 1.01])
+    assert copies == [1, 1]
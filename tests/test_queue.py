@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+import dixitai
+
+
+@pytest.fixture
+def work_queue(tmp_path):
+    with dixitai.config_overrides(SHARD_LEASE_SECONDS=0.2, SHARD_MAX_ATTEMPTS=2):
+        q = dixitai.WorkQueue(str(tmp_path / "queue.sqlite3"))
+        q.seed(range(6), done=[5])
+        yield q
+        q.close()
+
+
+def test_claims_do_not_overlap(work_queue):
+    a = work_queue.claim("a", 3)
+    b = work_queue.claim("b", 3)
+    assert a == [0, 1, 2]
+    assert b == [3, 4]
+    assert work_queue.claim("c", 3) == []
+    assert work_queue.counts() == {dixitai.QUEUE_LEASED: 5, dixitai.QUEUE_DONE: 1}
+
+
+def test_expired_lease_is_reclaimed(work_queue):
+    assert work_queue.claim("crashed", 2) == [0, 1]
+    assert work_queue.claim("other", 10) == [2, 3, 4]
+    time.sleep(0.3)
+    # crashed 没有续租，租约过期后卡片交给其他 worker
+    assert work_queue.claim("rescuer", 10) == [0, 1, 2, 3, 4]
+    assert work_queue.heartbeat("crashed", [0, 1]) == []
+    work_queue.complete("rescuer", 0, True)
+    # 旧 worker 迟到的失败汇报不能把已改派的卡片退回队列
+    work_queue.complete("crashed", 1, False)
+    assert work_queue.heartbeat("rescuer", [1]) == [1]
+
+
+def test_heartbeat_keeps_lease(work_queue):
+    assert work_queue.claim("a", 1) == [0]
+    for _ in range(3):
+        time.sleep(0.1)
+        assert work_queue.heartbeat("a", [0]) == [0]
+    assert 0 not in work_queue.claim("b", 10)
+
+
+def test_failures_requeue_until_max_attempts(work_queue):
+    assert work_queue.claim("a", 1) == [0]
+    work_queue.complete("a", 0, False)
+    assert work_queue.claim("a", 1) == [1]   # 失败次数少的优先
+    work_queue.complete("a", 1, True)
+    claimed = work_queue.claim("a", 10)
+    assert claimed[-1] == 0
+    work_queue.complete("a", 0, False)
+    counts = work_queue.counts()
+    assert counts[dixitai.QUEUE_FAILED] == 1
+    assert counts[dixitai.QUEUE_DONE] == 2
+
+
+def test_release_returns_cards_without_counting_failure(work_queue):
+    assert work_queue.claim("a", 2) == [0, 1]
+    work_queue.release("a", [0, 1])
+    assert work_queue.claim("b", 2) == [0, 1]
+    work_queue.complete("b", 0, False)
+    work_queue.complete("b", 1, False)
+    assert dixitai.QUEUE_FAILED not in work_queue.counts()
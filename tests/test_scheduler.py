@@ -0,0 +1,30 @@
+import dixitai
+
+
+def tight_scheduler():
+    # 第一张卡片用了 6 个请求、耗时 5 秒；剩下 9 张按这个速度远超 12 个请求的预算
+    scheduler = dixitai.RunScheduler(10, deadline=1000, budget=12)
+    for _ in range(6):
+        scheduler.note_request()
+    scheduler.card_finished(True, 5.0)
+    assert scheduler.tight()
+    return scheduler
+
+
+def test_limiter_paced_retry_is_never_skipped_when_tight():
+    assert tight_scheduler().allow_retry(0)
+
+
+def test_tight_skips_only_backoffs_longer_than_a_card():
+    scheduler = tight_scheduler()
+    assert scheduler.allow_retry(4.0)
+    assert not scheduler.allow_retry(30.0)
+
+
+def test_retries_stop_when_exhausted_or_past_deadline():
+    scheduler = dixitai.RunScheduler(10, deadline=2)
+    assert scheduler.allow_retry(0)
+    assert not scheduler.allow_retry(5.0)
+    scheduler = dixitai.RunScheduler(10, budget=1)
+    scheduler.note_request()
+    assert not scheduler.allow_retry(0)
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+from PIL import Image
+
+import dixitai
+
+
+@pytest.fixture
+def settings(tmp_path):
+    with dixitai.config_overrides(
+        VALIDATE_IMAGES=True, VALIDATE_WORKERS=0, VALIDATE_MIN_SIZE=(256, 256), PLACEHOLDER_DIR=str(tmp_path / "none"),
+    ):
+        dixitai.close_validation()
+        yield dixitai.get_validation()[0]
+        dixitai.close_validation()
+
+
+def noise(path, size=(512, 512)):
+    Image.frombytes("L", size, os.urandom(size[0] * size[1])).convert("RGB").save(path, quality=90)
+    return str(path)
+
+
+def test_good_image_passes(tmp_path, settings):
+    assert dixitai.validate_image(noise(tmp_path / "ok.jpg"), settings) is None
+
+
+def test_truncated_image_is_retried(tmp_path, settings):
+    data = open(noise(tmp_path / "ok.jpg"), "rb").read()
+    (tmp_path / "cut.jpg").write_bytes(data[:len(data) // 2])
+    kind, _ = dixitai.validate_image(str(tmp_path / "cut.jpg"), settings)
+    assert kind == "retry"
+
+
+def test_blank_and_small_images_are_rejected(tmp_path, settings):
+    Image.new("RGB", (512, 512), (250, 250, 250)).save(tmp_path / "blank.jpg")
+    assert dixitai.validate_image(str(tmp_path / "blank.jpg"), settings)[0] == "reject"
+    assert dixitai.validate_image(noise(tmp_path / "small.jpg", (128, 128)), settings)[0] == "reject"
+
+
+def test_placeholder_lookalike_is_retried(tmp_path):
+    placeholders = tmp_path / "placeholders"
+    placeholders.mkdir()
+    noise(placeholders / "rate_limited.jpg")
+    with dixitai.config_overrides(VALIDATE_IMAGES=True, VALIDATE_WORKERS=0, PLACEHOLDER_DIR=str(placeholders)):
+        dixitai.close_validation()
+        try:
+            settings = dixitai.get_validation()[0]
+            Image.open(placeholders / "rate_limited.jpg").resize((400, 400)).save(tmp_path / "card.jpg", quality=70)
+            kind, reason = dixitai.validate_image(str(tmp_path / "card.jpg"), settings)
+        finally:
+            dixitai.close_validation()
+    assert kind == "retry"
+    assert "rate_limited.jpg" in reason
+
+
+def test_gate_uses_the_process_pool(tmp_path):
+    Image.new("RGB", (512, 512)).save(tmp_path / "blank.jpg")
+    with dixitai.config_overrides(VALIDATE_IMAGES=True, VALIDATE_WORKERS=1, PLACEHOLDER_DIR=str(tmp_path / "none")):
+        dixitai.close_validation()
+        try:
+            assert dixitai.get_validation()[1] is not None
+            dixitai.gate_image(noise(tmp_path / "ok.jpg"))
+            info = {}
+            with pytest.raises(dixitai.RejectedResponse):
+                dixitai.gate_image(str(tmp_path / "blank.jpg"), info)
+            assert "空白" in info["invalid"]
+        finally:
+            dixitai.close_validation()